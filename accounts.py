@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import os
+import time
+import logging
+import configparser
+import dateutil.tz
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import time as dtime
+
+from helpers import Helper
+from convertors import Convertor
+from remote import Remote
+from state import SyncState
+from cache import ResponseCache
+from ratelimit import RateLimitExhausted
+
+
+class Account:
+	"""A Fitbit and Google Fit account pair of a single user, and the objects needed to sync it. Every account
+	has its own sync state, response cache and Fitbit rate limit budget."""
+
+	def __init__(self, name, fitbitCredsFile, googleCredsFile, stateFile=None, cacheDir=None):
+		""" Intialize an account.
+
+		name -- name of the account, used in the output
+		fitbitCredsFile -- Fitbit credentials file
+		googleCredsFile -- Google Fits credentials file
+		stateFile -- sync state file of the account, no sync state if not given
+		cacheDir -- response cache directory of the account, no cache if not given
+		"""
+		self.name = name
+		self.fitbitCredsFile = fitbitCredsFile
+		self.googleCredsFile = googleCredsFile
+		self.stateFile = stateFile
+		self.cacheDir = cacheDir
+		self.remote = None
+
+	def Setup(self, params, dataTypes):
+		"""Logs in to Fitbit and Google Fit and creates the Google Fit data sources. Only done once per process.
+
+		params -- the [params] section of config.ini
+		dataTypes -- data types that will be synced
+		"""
+		if self.remote is not None:
+			return
+		helper = Helper(self.fitbitCredsFile, self.googleCredsFile, params.get('google_discovery_file'))
+		convertor = Convertor(self.googleCredsFile, params.get('project_number'), None,
+			dtime.fromisoformat(params.get('weigh_time')))
+		if self.stateFile:
+			# The sub directory of the account may not exist yet, see LoadAccounts
+			os.makedirs(os.path.dirname(os.path.abspath(self.stateFile)), exist_ok=True)
+		syncState = SyncState(self.stateFile, params.getint('finalize_after_days', 2)) if self.stateFile else None
+		responseCache = ResponseCache(self.cacheDir, params.getint('cache_max_mb', 500)*1024*1024,
+			os.path.abspath(self.fitbitCredsFile)) \
+			if self.cacheDir else None
+		fitbitClient = helper.GetFitbitClient()
+		remote = Remote.FromConfig(params, fitbitClient, helper.GetGoogleClient(), convertor, helper,
+			syncState, responseCache)
+		# Requests must not wait for the budget of this account to be reset, that would hold up a worker
+		remote.rateLimiter.block = False
+		remote.metrics.labels['account'] = self.name
+
+		tzinfo = dateutil.tz.gettz(remote.ReadFromFitbit(fitbitClient.user_profile_get)['user']['timezone'])
+		remote.UpdateTimezone(tzinfo)
+		convertor.UpdateTimezone(tzinfo)
+		for dataType in dataTypes:
+			remote.CreateGoogleFitDataSource(dataType)
+		self.remote = remote
+
+	def SyncDays(self, dataTypes, date_stamps, force=False):
+		"""Sync Fitbit data of the given types to Google fit for a list of days, until the Fitbit rate limit budget
+		of the account is used up. Returns a list of the (date_stamp, summaries) tuples of the synced days, and the
+		number of seconds until the budget is reset if it was used up, otherwise None.
+
+		dataTypes -- fitbit data types to sync
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to sync
+		force -- sync days again even if the sync state says they are final
+		"""
+		synced = []
+		try:
+			for day in self.remote.SyncFitbitDaysToGoogleFit(dataTypes, date_stamps, force=force):
+				synced.append(day)
+		except RateLimitExhausted as e:
+			# Data of the synced days may still be queued, it is written with the next days of the account
+			return synced, e.seconds
+		return synced, None
+
+
+class AccountPool:
+	"""Syncs many accounts in one process with a bounded number of worker threads. Accounts take turns, each turn
+	syncs a few days of one account, so that the backfill of one account does not hold up the others. An account
+	whose Fitbit budget is used up sits out until its budget is reset, without occupying a worker."""
+
+	def __init__(self, accounts, params, workers=4, daysPerTurn=7):
+		""" Intialize an account pool.
+
+		accounts -- accounts to sync
+		params -- the [params] section of config.ini
+		workers -- max number of accounts synced at the same time
+		daysPerTurn -- max number of days synced in one turn of an account
+		"""
+		self.accounts = accounts
+		self.params = params
+		self.workers = workers
+		self.daysPerTurn = daysPerTurn
+
+		# Seconds each account sat out waiting for the reset of its Fitbit budget
+		self.restSeconds = Counter()
+
+	def SyncRound(self, dataTypes, date_stamps, start_date, end_date, force=False, syncActivities=False):
+		"""Sync the given days of all accounts
+
+		dataTypes -- fitbit data types to sync
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to sync
+		start_date -- first day to sync activities of
+		end_date -- day after the last day to sync activities of
+		force -- sync days again even if the sync state says they are final
+		syncActivities -- sync the activities of the days too
+		"""
+		turns = [date_stamps[i:i+self.daysPerTurn] for i in range(0, len(date_stamps), self.daysPerTurn)]
+		if syncActivities:
+			turns.append(None)
+		dataSources = dataTypes + (['activity'] if syncActivities else [])
+		for account in self.accounts:
+			if account.remote is not None:
+				account.remote.uploadStats.clear()
+
+		# Accounts waiting for a worker, in the order they get one, with the turns they have left
+		waiting = deque((account, list(turns)) for account in self.accounts)
+		resting = [] # (ready at, account, turns) of accounts whose Fitbit budget is used up
+		running = {}
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			while waiting or resting or running:
+				now = time.monotonic()
+				for entry in [entry for entry in resting if entry[0] <= now]:
+					resting.remove(entry)
+					waiting.append(entry[1:])
+				while waiting and len(running) < self.workers:
+					account, left = waiting.popleft()
+					running[executor.submit(self._Turn, account, dataTypes, dataSources, left[0], start_date,
+						end_date, force)] = (account, left)
+
+				timeout = max(0, min(entry[0] for entry in resting) - now) if resting else None
+				done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+				for future in done:
+					account, left = running.pop(future)
+					try:
+						synced, seconds = future.result()
+					except Exception as e:
+						logging.exception("Sync of account %s failed", account.name)
+						print('[{}] sync failed - {}'.format(account.name, e))
+						continue
+					self._PrintDays(account, synced)
+					if seconds is not None and (left[0] is None or len(synced) < len(left[0])):
+						# The account resumes with the first day it did not finish
+						print('[{}] Fitbit rate limit reached, resuming in {:.0f} seconds'.format(account.name, seconds))
+						left = [left[0] and left[0][len(synced):]] + left[1:]
+						resting.append((time.monotonic() + seconds, account, left))
+						self.restSeconds[account.name] += seconds
+					elif len(left) > 1:
+						waiting.append((account, left[1:]))
+					else:
+						self._PrintTotals(account, dataTypes)
+
+	def _Turn(self, account, dataTypes, dataSources, date_stamps, start_date, end_date, force):
+		"""Runs a turn of an account: syncs its days, or its activities if date_stamps is None"""
+		try:
+			account.Setup(self.params, dataSources)
+			if date_stamps is None:
+				account.remote.SyncFitbitActivitiesToGoogleFit(start_date=start_date, end_date=end_date)
+				return [], None
+		except RateLimitExhausted as e:
+			return [], e.seconds
+		return account.SyncDays(dataTypes, date_stamps, force)
+
+	def _PrintDays(self, account, synced):
+		for date_stamp, summaries in synced:
+			print('[{}] {} - {}'.format(account.name, date_stamp, ', '.join(summaries)))
+
+	def _PrintTotals(self, account, dataTypes):
+		remote = account.remote
+		if remote.syncState:
+			print('[{}] final - {}'.format(account.name, '; '.join('{} {}'.format(
+				dataType, ', '.join(remote.syncState.FinalRanges(dataType)) or '-') for dataType in dataTypes)))
+		print('[{}] Google Fit uploads - {} sent, {} skipped as unchanged'.format(
+			account.name, remote.uploadStats['sent'], remote.uploadStats['skipped']))
+
+
+def LoadAccounts(path, params):
+	"""Returns the accounts of a directory or a manifest file. A directory has a sub directory per account, named
+	after the account, with the fitbit.json and google.json credentials of the account. The sync state and response
+	cache of an account are kept in its sub directory. A manifest is an ini file with a section per account, with
+	fitbit_creds and google_creds files. Credentials of several accounts may share a directory, so the sync state
+	and response cache of an account are kept in a sub directory named after the account next to its Fitbit
+	credentials, unless the section sets state_file and cache_dir. Accounts must not share a sync state or cache.
+
+	path -- accounts directory or manifest file
+	params -- the [params] section of config.ini
+	"""
+	if os.path.isdir(path):
+		entries = [(name, dict(fitbit_creds=os.path.join(path, name, 'fitbit.json'),
+			google_creds=os.path.join(path, name, 'google.json')), os.path.join(path, name))
+			for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name, 'fitbit.json'))]
+	else:
+		manifest = configparser.ConfigParser()
+		if not manifest.read(path):
+			raise ValueError("Accounts manifest {} not found".format(path))
+		entries = [(name, manifest[name], os.path.join(os.path.dirname(manifest[name]['fitbit_creds']), name))
+			for name in manifest.sections()]
+
+	accounts = []
+	owners = {}
+	for name, entry, accountDir in entries:
+		stateFile = entry.get('state_file') or (params.get('state_file') and
+			os.path.join(accountDir, os.path.basename(params.get('state_file'))))
+		cacheDir = entry.get('cache_dir') or (params.get('cache_dir') and
+			os.path.join(accountDir, os.path.basename(params.get('cache_dir'))))
+		for kind, accountPath in (('sync state', stateFile), ('cache', cacheDir)):
+			if not accountPath:
+				continue
+			owner = owners.setdefault((kind, os.path.abspath(accountPath)), name)
+			if owner != name:
+				raise ValueError("Accounts {} and {} share the {} {}".format(owner, name, kind, accountPath))
+		accounts.append(Account(name, entry['fitbit_creds'], entry['google_creds'], stateFile, cacheDir))
+	return accounts
@@ -5,17 +5,20 @@ Main class / entry point for the application
 __author__ = "Praveen Kumar Pendyala"
 __email__ = "mail@pkp.io"
 """
+import os
 import argparse
 import logging
-import dateutil.parser
 import configparser
-import json
+import dateutil.tz
 from datetime import time
+from sys import exit
+from time import sleep
 
-from helpers import Helper
+# The google, oauth and fitbit client libraries take a large part of the startup time. They are only
+# imported once it is clear that there is something to sync, see main().
 from convertors import Convertor
-from remote import DATE_FORMAT, Remote
-from sys import exit
+from state import DATE_FORMAT, SyncState
+from cache import ResponseCache
 
 VERSION = "0.3"
 
@@ -28,80 +31,178 @@ def main():
 	parser.add_argument("-e", "--end-date", default="", help="End data for sync in YYYY-MM-DD format")
 	parser.add_argument("-g", "--google-creds", default="auth/google.json", help="Google credentials file")
 	parser.add_argument("-f", "--fitbit-creds", default="auth/fitbit.json", help="Fitbit credentials file")
+	parser.add_argument("--force", help="Sync days again even if they were synced before", action="store_true")
+	parser.add_argument("-w", "--workers", type=int, default=1, help="Number of days and data types to sync in parallel")
+	parser.add_argument("--asyncio", help="Sync days with concurrent requests on an asyncio event loop", action="store_true")
+	parser.add_argument("--accounts", default="", help="Sync all accounts of a directory or manifest file")
+	parser.add_argument("--daemon", help="Keep running and sync again every sync_interval_minutes", action="store_true")
+	parser.add_argument("--daily", help="Sync daily totals of steps, distance and calories instead of intraday data. Days whose intraday data "
+		"was synced before are skipped, Google Fit would count them twice",
+		action="store_true")
+	parser.add_argument("--export", dest="export_dir", default="",
+		help="Export Fitbit data to an archive directory instead of syncing it to Google Fit")
+	parser.add_argument("--import", dest="import_dir", default="",
+		help="Sync data to Google Fit from an archive directory written by --export instead of from Fitbit")
+	parser.add_argument("--profile", nargs="?", const="profile", default="",
+		help="Profile the run per stage and data type, write the hotspots to PROFILE.txt and the raw profile to PROFILE.prof")
 	parser.add_argument("-v", "--version", help="Fitbit-GoogleFit migration tool version", action="store_true")
 	args = parser.parse_args()
 
 	# Show version information if required
 	if args.version:
 		print('         fitbit-googlefit version {}'.format(VERSION))
-		print('')
-
+		return
+	if args.export_dir and args.import_dir:
+		parser.error("--export and --import cannot be combined")
+	if (args.export_dir or args.import_dir) and (args.accounts or args.asyncio):
+		parser.error("--export and --import sync a single account without --asyncio")
+	if args.daily and (args.accounts or args.asyncio or args.export_dir or args.import_dir):
+		parser.error("--daily cannot be combined with --accounts, --asyncio, --export or --import")
+
+	if args.profile:
+		from metrics import Metrics
+		from profiling import Profiler
+		Metrics.profiler = Profiler()
+		Metrics.profiler.Start()
+		try:
+			sync(args)
+		finally:
+			Metrics.profiler.Stop()
+			Metrics.profiler.WriteReport(args.profile)
+			print('Profile written to {0}.txt and {0}.prof'.format(args.profile))
+	else:
+		sync(args)
+
+def sync(args):
 	# Reading configuration from config file
 	config = configparser.ConfigParser()
 	config.read(args.config)
 	params = config['params']
 
 	# Init objects
-	helper = Helper(args.fitbit_creds, args.google_creds)
 	weighTime = time.fromisoformat(params.get('weigh_time'))
 	convertor = Convertor(args.google_creds, params.get('project_number'), None, weighTime)
-	fitbitClient,googleClient = helper.GetFitbitClient(),helper.GetGoogleClient()
-	remote = Remote(fitbitClient, googleClient, convertor, helper, None)
-
-	# Get user's time zone info from Fitbit -- since Fitbit time stamps are not epoch and stored in user's timezone.
-	userProfile = remote.ReadFromFitbit(fitbitClient.user_profile_get)
-	tzinfo = dateutil.tz.gettz(userProfile['user']['timezone'])
-	remote.UpdateTimezone(tzinfo)
-	convertor.UpdateTimezone(tzinfo)
-
-	# setup Google Fit data sources for each data type supported
-	for dataType in ['steps', 'distance', 'weight', 'heart_rate', 'calories', 'activity', 'body_fat', 'sleep']:
-		remote.CreateGoogleFitDataSource(dataType)
+	syncState = SyncState(params.get('state_file'), params.getint('finalize_after_days', 2)) \
+		if params.get('state_file') else None
 
 	# Decide the start and end dates of sync
 	start_date_str = args.start_date if args.start_date != '' else params.get('start_date')
 	end_date_str = args.end_date if args.end_date != '' else params.get('end_date')
 	start_date = convertor.parseHumanReadableDate(start_date_str)
 	end_date = convertor.parseHumanReadableDate(end_date_str)
+	date_stamps = [single_date.strftime(DATE_FORMAT) for single_date in convertor.daterange(start_date, end_date)]
+
+	# Data types to sync, in the order they are reported for each day
+	dataTypes = [dataType for dataType,option in (('steps','sync_steps'), ('distance','sync_distance'),
+		('heart_rate','sync_heartrate'), ('weight','sync_weight'), ('body_fat','sync_body_fat'),
+		('calories','sync_calories'), ('sleep','sync_sleep')) if params.getboolean(option)]
+
+	# Daily totals are kept under data types of their own in the sync state and in Google Fit
+	syncTypes = [convertor.DailyDataType(dataType) for dataType in dataTypes] if args.daily else dataTypes
+
+	# Sync many accounts in one process, again and again with --daemon
+	if args.accounts:
+		from accounts import LoadAccounts, AccountPool
+		pool = AccountPool(LoadAccounts(args.accounts, params), params, params.getint('account_workers', 4),
+			params.getint('account_days_per_turn', 7))
+		while True:
+			pool.SyncRound(dataTypes, date_stamps, start_date, end_date, args.force, params.getboolean('sync_activities'))
+			if params.get('metrics_file') or params.get('report_file'):
+				from metrics import WriteReports
+				WriteReports([account.remote.metrics for account in pool.accounts if account.remote is not None],
+					params.get('metrics_file'), params.get('report_file'))
+			if not args.daemon:
+				return
+			sleep(params.getint('sync_interval_minutes', 60)*60)
+			start_date = convertor.parseHumanReadableDate(start_date_str)
+			end_date = convertor.parseHumanReadableDate(end_date_str)
+			date_stamps = [single_date.strftime(DATE_FORMAT)
+				for single_date in convertor.daterange(start_date, end_date)]
+
+	# Skip logging in to Fitbit and Google altogether if every day is final already
+	if syncState and not args.force and not args.export_dir and not params.getboolean('sync_activities') and all(
+			syncState.IsSynced(dataType, date_stamp) for dataType in syncTypes for date_stamp in date_stamps):
+		print('Nothing to sync - all {} days are final'.format(len(date_stamps)))
+		return
+
+	from helpers import Helper
+	from remote import Remote
+	helper = Helper(args.fitbit_creds, args.google_creds, params.get('google_discovery_file'))
+	# An export only reads from Fitbit, an import only writes to Google Fit
+	fitbitClient = None if args.import_dir else helper.GetFitbitClient()
+	googleClient = None if args.export_dir else helper.GetGoogleClient()
+	responseCache = ResponseCache(params.get('cache_dir'), params.getint('cache_max_mb', 500)*1024*1024,
+		os.path.abspath(args.fitbit_creds)) \
+		if params.get('cache_dir') else None
+	remote = Remote.FromConfig(params, fitbitClient, googleClient, convertor, helper, syncState, responseCache)
+	archive = None
+	if args.export_dir or args.import_dir:
+		from archive import Archive
+		archive = Archive(args.export_dir or args.import_dir)
+
+	# Get user's time zone info from Fitbit -- since Fitbit time stamps are not epoch and stored in user's timezone.
+	# An import uses the time zone recorded by the export instead.
+	if args.import_dir:
+		timezone = archive.Timezone()
+	else:
+		userProfile = remote.ReadFromFitbit(fitbitClient.user_profile_get)
+		timezone = userProfile['user']['timezone']
+	if args.export_dir:
+		archive.SetTimezone(timezone)
+	tzinfo = dateutil.tz.gettz(timezone)
+	remote.UpdateTimezone(tzinfo)
+	convertor.UpdateTimezone(tzinfo)
+
+	# setup Google Fit data sources for each data type to sync
+	if not args.export_dir:
+		for dataType in syncTypes + (['activity'] if params.getboolean('sync_activities') else []):
+			remote.CreateGoogleFitDataSource(dataType)
 
 	# Start syncing data for the given range
-	for single_date in convertor.daterange(start_date, end_date):
-		date_stamp = single_date.strftime(DATE_FORMAT)
+	if args.export_dir:
+		days = remote.ExportFitbitDaysToArchive(archive, dataTypes, date_stamps, force=args.force)
+	elif args.import_dir:
+		days = remote.ImportArchivedDaysToGoogleFit(archive, dataTypes, date_stamps, force=args.force)
+	elif args.daily:
+		days = remote.SyncFitbitDailyTotalsToGoogleFit(dataTypes, date_stamps, force=args.force)
+	elif args.asyncio:
+		from asyncremote import AsyncRemote
+		asyncRemote = AsyncRemote(remote, helper.GetGoogleCredentials(), params.getint('fitbit_concurrency', 4),
+			params.getint('google_concurrency', 8), params.getint('connection_pool_size', 16))
+		days = asyncRemote.SyncFitbitDaysToGoogleFit(dataTypes, date_stamps, force=args.force)
+	else:
+		days = remote.SyncFitbitDaysToGoogleFit(dataTypes, date_stamps, workers=args.workers, force=args.force)
+	for date_stamp,summaries in days:
 		print('------------------------------   {}  -------------------------'.format(date_stamp))
+		for summary in summaries:
+			print(summary)
+		print('')
 
-		#----------------------------------     steps      ------------------------
-		if params.getboolean('sync_steps'):
-			remote.SyncFitbitToGoogleFit('steps',date_stamp)
-		    
-		#----------------------------------     distance   ------------------------
-		if params.getboolean('sync_distance'):
-			remote.SyncFitbitToGoogleFit('distance',date_stamp)
-		    
-		#----------------------------------     heart rate ------------------------
-		if params.getboolean('sync_heartrate'):
-			remote.SyncFitbitToGoogleFit('heart_rate',date_stamp)
-
-		#----------------------------------     weight     ------------------------
-		if params.getboolean('sync_weight'):
-			remote.SyncFitbitToGoogleFit('weight',date_stamp)
-
-		#----------------------------------     body fat   ------------------------
-		if params.getboolean('sync_body_fat'):
-			remote.SyncFitbitToGoogleFit('body_fat',date_stamp)
-
-		#----------------------------------     calories   ------------------------
-		if params.getboolean('sync_calories'):
-			remote.SyncFitbitToGoogleFit('calories',date_stamp)
-
-		#----------------------------------     sleep   ------------------------
-		if params.getboolean('sync_sleep'):
-			remote.SyncFitbitToGoogleFit('sleep',date_stamp)
+	for dataType,(before,after) in sorted(remote.coalesceStats.items()):
+		print('coalesced {} - {} to {} data points ({:.1f}x)'.format(dataType, before, after, before/max(after, 1)))
+	if remote.coalesceStats:
+		print('')
 
+	if syncState and not args.export_dir:
+		for dataType in syncTypes:
+			print('{} final - {}'.format(dataType, ', '.join(syncState.FinalRanges(dataType)) or '-'))
+		print('Google Fit uploads - {} sent, {} skipped as unchanged'.format(
+			remote.uploadStats['sent'], remote.uploadStats['skipped']))
 		print('')
 
 	#----------------------------------  activity logs  ------------------------
-	if params.getboolean('sync_activities'):
-		remote.SyncFitbitActivitiesToGoogleFit(start_date=start_date)
+	if params.getboolean('sync_activities') and args.export_dir:
+		remote.ExportFitbitActivitiesToArchive(archive, start_date, end_date)
+	elif params.getboolean('sync_activities') and args.import_dir:
+		remote.SyncFitbitActivitiesToGoogleFit(start_date=start_date, end_date=end_date,
+			activities=remote.ArchivedActivities(archive, start_date, end_date))
+	elif params.getboolean('sync_activities'):
+		remote.SyncFitbitActivitiesToGoogleFit(start_date=start_date, end_date=end_date)
+
+	# Timings and counters of the run, for monitoring
+	if params.get('metrics_file') or params.get('report_file'):
+		from metrics import WriteReports
+		WriteReports([remote.metrics], params.get('metrics_file'), params.get('report_file'))
 
 if __name__ == '__main__':
 	try:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import os
+import json
+import logging
+import threading
+import numpy as np
+from datetime import date
+
+
+class Archive:
+	"""A local archive of Fitbit data, kept in compressed numpy files (.npz) of columns with one file per data type
+	and month, e.g. heart_rate/2016-08.npz. Data is kept as fetched from Fitbit, before any conversion, so it can be
+	converted and uploaded to Google Fit again without using up Fitbit API requests.
+
+	Days can be added to a month in any order, and replace the days already archived. Each file has the columns
+	days, exported and counts, with the archived days, the day each of them was exported and its number of rows,
+	followed by the columns of the data, e.g. second and value of intraday data. Only one month per data type is
+	held in memory; a month is written when days of another month of the same type are put, or on Flush."""
+
+	INTRADAY_TYPES = ('steps','distance','heart_rate','calories')
+	# Fields of the logs of each type that are archived, and their column types
+	LOG_COLUMNS = {
+		'weight': (('logId', np.int64), ('time', str), ('weight', np.float64)),
+		'body_fat': (('logId', np.int64), ('time', str), ('fat', np.float64)),
+		'sleep': (('logId', np.int64), ('startTime', str)),
+		'activity': (('logId', np.int64), ('startTime', str), ('duration', np.int64), ('activityName', str),
+			('logType', str)),
+	}
+	SLEEP_STAGE_COLUMNS = (('dateTime', str), ('level', str), ('seconds', np.int64))
+	DATE_FIELDS = {'weight': 'date', 'body_fat': 'date', 'sleep': 'dateOfSleep'} # Restored from the day of a log
+
+	def __init__(self, archiveDir):
+		""" Intialize an archive.
+
+		archiveDir -- directory of the archive, created if it does not exist
+		"""
+		self.archiveDir = archiveDir
+		self._months = {} # data type -> (month, {date_stamp: (exported, columns)}, modified)
+		self._lock = threading.Lock()
+		os.makedirs(archiveDir, exist_ok=True)
+
+	def _Path(self, dataType, month):
+		return os.path.join(self.archiveDir, dataType, month + '.npz')
+
+	def Timezone(self):
+		"""Returns the time zone of the Fitbit user of the archived data"""
+		with open(os.path.join(self.archiveDir, 'profile.json')) as f:
+			return json.load(f)['timezone']
+
+	def SetTimezone(self, timezone):
+		"""Records the time zone of the Fitbit user, needed to convert the archived data
+
+		timezone -- time zone name of the user's Fitbit profile, e.g. Europe/Berlin
+		"""
+		with open(os.path.join(self.archiveDir, 'profile.json'), 'w') as f:
+			json.dump(dict(timezone=timezone), f)
+
+	def Put(self, dataType, date_stamp, records, exported):
+		"""Adds the data of a given type for a day, replacing the archived data of the day if there is any
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		records -- fitbit logs of the day, or for intraday types, arrays of the seconds of the day and the values
+			of the data points
+		exported -- date on which the data was fetched from Fitbit
+		"""
+		columns = self._Encode(dataType, records)
+		with self._lock:
+			days = self._Month(dataType, date_stamp[:7], True)
+			days[date_stamp] = (exported.isoformat(), columns)
+
+	def Get(self, dataType, date_stamp):
+		"""Returns the archived data of a given type for a day in the form it was put, or None if the day is not
+		archived. Only the fields of LOG_COLUMNS are restored of logs.
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		"""
+		with self._lock:
+			entry = self._Month(dataType, date_stamp[:7]).get(date_stamp)
+		return None if entry is None else self._Decode(dataType, date_stamp, entry[1])
+
+	def IsFinal(self, dataType, date_stamp, finalAfterDays):
+		"""Returns True if the data of a given type for a day was exported at least finalAfterDays days later
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		finalAfterDays -- number of days after which Fitbit data is not expected to change anymore
+		"""
+		with self._lock:
+			entry = self._Month(dataType, date_stamp[:7]).get(date_stamp)
+		return entry is not None and (date.fromisoformat(entry[0]) - date.fromisoformat(date_stamp)).days >= finalAfterDays
+
+	def Flush(self):
+		"""Writes all months with new days to disk"""
+		with self._lock:
+			for dataType, (month, days, modified) in list(self._months.items()):
+				if modified:
+					self._Write(dataType, month, days)
+					self._months[dataType] = (month, days, False)
+
+	def _Month(self, dataType, month, modify=False):
+		"""Returns the days of a month as a dict of date_stamp -> (exported, columns). The month held in memory
+		before for the data type is written first if it has new days."""
+		loaded = self._months.get(dataType)
+		if loaded is None or loaded[0] != month:
+			if loaded is not None and loaded[2]:
+				self._Write(dataType, *loaded[:2])
+			loaded = (month, self._Read(dataType, month), False)
+		if modify:
+			loaded = loaded[:2] + (True,)
+		self._months[dataType] = loaded
+		return loaded[1]
+
+	def _Read(self, dataType, month):
+		try:
+			with np.load(self._Path(dataType, month)) as f:
+				columns = {name: f[name] for name in f.files}
+		except FileNotFoundError:
+			return {}
+		dayStamps,exported,counts = columns.pop('days').astype(str),columns.pop('exported').astype(str),columns.pop('counts')
+		offsets = np.r_[0, np.cumsum(counts)]
+		if dataType == 'sleep':
+			# Stages are kept in order of their logs, with the number of stages of each log
+			logStages = np.r_[0, np.cumsum(columns['stages'])]
+			stageOffsets = logStages[offsets]
+		days = {}
+		for i, date_stamp in enumerate(dayStamps):
+			days[date_stamp] = (exported[i], {name: column[stageOffsets[i]:stageOffsets[i+1]]
+				if name.startswith('stage_') else column[offsets[i]:offsets[i+1]] for name, column in columns.items()})
+		return days
+
+	def _Write(self, dataType, month, days):
+		dayStamps = sorted(days)
+		names = list(days[dayStamps[0]][1])
+		columns = dict(
+			days=np.array(dayStamps, dtype='datetime64[D]'),
+			exported=np.array([days[date_stamp][0] for date_stamp in dayStamps], dtype='datetime64[D]'),
+			counts=np.array([len(days[date_stamp][1][names[0]]) for date_stamp in dayStamps], dtype=np.int64))
+		for name in names:
+			columns[name] = np.concatenate([days[date_stamp][1][name] for date_stamp in dayStamps])
+
+		path = self._Path(dataType, month)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmpPath = path[:-len('.npz')] + '.tmp.npz'
+		np.savez_compressed(tmpPath, **columns)
+		os.replace(tmpPath, path)
+		logging.debug("Archived %d days of %s to %s", len(dayStamps), dataType, path)
+
+	def _Encode(self, dataType, records):
+		"""Returns the columns of the data of a day"""
+		if dataType in self.INTRADAY_TYPES:
+			seconds, values = records
+			values = np.asarray(values)
+			# Empty days must not turn the integer values of other days into floats
+			return dict(second=np.asarray(seconds, dtype=np.int32), value=values if len(values) else values.astype(np.int64))
+		columns = {field: np.array([record[field] for record in records], dtype=dtype)
+			for field, dtype in self.LOG_COLUMNS[dataType]}
+		if dataType == 'sleep':
+			stages = [stage for record in records for stage in record['levels']['data']]
+			columns['stages'] = np.array([len(record['levels']['data']) for record in records], dtype=np.int64)
+			columns.update({'stage_' + field: np.array([stage[field] for stage in stages], dtype=dtype)
+				for field, dtype in self.SLEEP_STAGE_COLUMNS})
+		return columns
+
+	def _Decode(self, dataType, date_stamp, columns):
+		"""Returns the data of a day from its columns"""
+		if dataType in self.INTRADAY_TYPES:
+			return columns['second'], columns['value']
+		fields = [field for field, _ in self.LOG_COLUMNS[dataType]]
+		records = [dict(zip(fields, row)) for row in zip(*(columns[field].tolist() for field in fields))]
+		for record in records:
+			if dataType in self.DATE_FIELDS:
+				record[self.DATE_FIELDS[dataType]] = date_stamp
+		if dataType == 'sleep':
+			stageFields = [field for field, _ in self.SLEEP_STAGE_COLUMNS]
+			stages = [dict(zip(stageFields, row)) for row in zip(*(columns['stage_' + field].tolist()
+				for field in stageFields))]
+			offset = 0
+			for record, count in zip(records, columns['stages'].tolist()):
+				record['levels'] = dict(data=stages[offset:offset+count])
+				offset += count
+		return records
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import asyncio
+import logging
+import httplib2
+from datetime import datetime
+
+import aiohttp
+
+from metrics import Metrics
+
+
+class AsyncRemote:
+	"""Runs the day by day sync of a Remote object on an asyncio event loop. Fitbit reads and Google Fit writes are
+	sent concurrently over a pool of keep-alive connections, with a separate concurrency limit for each API. Requests,
+	conversions, the rate limit budget, the response cache and the sync state are those of the Remote object."""
+
+	GFIT_RETRIES = 3 # Number of times google fit requests are retried after a server error or 429 response
+
+	def __init__(self, remote, googleCredentials, fitbitConcurrency=4, googleConcurrency=8, poolSize=16):
+		""" Intialize an async remote object.
+
+		remote -- a remote object to sync with
+		googleCredentials -- google oauth2 credentials
+		fitbitConcurrency -- max number of Fitbit requests in flight
+		googleConcurrency -- max number of Google Fit requests in flight
+		poolSize -- max number of open connections, for both APIs together
+		"""
+		self.remote = remote
+		self.fitbitClient = remote.fitbitClient
+		self.googleCredentials = googleCredentials
+		self.fitbitConcurrency = fitbitConcurrency
+		self.googleConcurrency = googleConcurrency
+		self.poolSize = poolSize
+		# Same endpoint as the google fit client of the remote, e.g. a local server set in google_discovery_file
+		self.googleFitUrl = remote.helper.GetGoogleFitUrl()
+
+	def SyncFitbitDaysToGoogleFit(self, dataTypes, date_stamps, force=False):
+		"""
+		Sync Fitbit data of the given types to Google fit for a list of days. Returns a generator of
+		(date_stamp, summaries) tuples in the order of the given days and types, like Remote.SyncFitbitDaysToGoogleFit.
+
+		dataTypes -- fitbit data types to sync
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to sync
+		force -- sync days again even if the sync state says they are final
+		"""
+		loop = asyncio.new_event_loop()
+		days = self.SyncFitbitDays(dataTypes, date_stamps, force)
+		try:
+			while True:
+				try:
+					yield loop.run_until_complete(days.__anext__())
+				except StopAsyncIteration:
+					break
+		finally:
+			loop.run_until_complete(days.aclose())
+			loop.close()
+
+	async def SyncFitbitDays(self, dataTypes, date_stamps, force=False):
+		"""Async generator behind SyncFitbitDaysToGoogleFit. Days are synced concurrently, but only a window of
+		fitbitConcurrency days ahead of the oldest unfinished day, so memory use does not grow with the range."""
+		self._fitbitSlots = asyncio.Semaphore(self.fitbitConcurrency)
+		self._googleSlots = asyncio.Semaphore(self.googleConcurrency)
+		self._fitbitRefresh = asyncio.Lock()
+		self._googleRefresh = asyncio.Lock()
+		connector = aiohttp.TCPConnector(limit=self.poolSize, keepalive_timeout=60)
+		async with aiohttp.ClientSession(connector=connector, raise_for_status=False) as self.session:
+			if self.remote.fetchLogRanges:
+				await asyncio.gather(*(self.PrefetchFitbitLogs(dataType, [date_stamp for date_stamp in date_stamps
+					if force or self.remote.syncState is None or not self.remote.syncState.IsSynced(dataType, date_stamp)])
+					for dataType in dataTypes))
+
+			window = []
+			try:
+				for date_stamp in date_stamps:
+					window.append((date_stamp, asyncio.ensure_future(asyncio.gather(
+						*(self.SyncFitbitDayToGoogleFit(dataType, date_stamp, force) for dataType in dataTypes)))))
+					if len(window) > self.fitbitConcurrency:
+						date_stamp, day = window.pop(0)
+						yield date_stamp, await day
+				while window:
+					date_stamp, day = window.pop(0)
+					yield date_stamp, await day
+			finally:
+				for _, day in window:
+					day.cancel()
+
+	async def SyncFitbitDayToGoogleFit(self, dataType, date_stamp, force=False):
+		"""
+		Sync Fitbit data to Google fit for a given day, unless the sync state says it is final.
+		Returns a one line summary of the sync.
+
+		dataType -- fitbit data type to sync
+		date_stamp -- timestamp in yyyy-mm-dd format of the day to sync
+		force -- sync the day even if it is final
+		"""
+		remote = self.remote
+		if remote.syncState is not None and not force and remote.syncState.IsSynced(dataType, date_stamp):
+			return "skipped {} - already synced".format(dataType)
+
+		with Metrics.DataType(dataType):
+			# Get the data of the day from fitbit, unless it was fetched ahead
+			records = remote.PrefetchedLogs(dataType, date_stamp)
+			if records is None:
+				fitbitResponse = await self.ReadFromFitbitCached(date_stamp, remote.FitbitDayUrl(dataType, date_stamp))
+				records = remote.FitbitDayRecords(dataType, fitbitResponse)
+
+			# Conversion is cpu bound, keep the event loop free for the requests of other days
+			dataSourceId,pointSets,sessions,summary = await asyncio.get_running_loop().run_in_executor(
+				None, remote.ConvertFitbitDay, dataType, date_stamp, records)
+
+			# Write a day of fitbit data to Google fit
+			await asyncio.gather(*(self.WriteSessionToGoogleFit(google_session) for google_session in sessions))
+			await asyncio.gather(*(self.WriteToGoogleFit(dataSourceId, googlePoints) for googlePoints in pointSets))
+		if remote.syncState is not None:
+			remote.syncState.MarkSynced(dataType, date_stamp, datetime.now(remote.tzinfo).date())
+		return summary
+
+	async def PrefetchFitbitLogs(self, dataType, date_stamps):
+		"""
+		Fetch the logs of a given type for a list of days with as few range requests as possible.
+		See Remote.PrefetchFitbitLogs.
+
+		dataType -- fitbit data type to fetch
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to fetch
+		"""
+		async def prefetch(url, window):
+			with Metrics.DataType(dataType):
+				fitbitResponse = await self.ReadFromFitbitCached(window[-1], url)
+			self.remote.StorePrefetchedLogs(dataType, window, fitbitResponse)
+		await asyncio.gather(*(prefetch(url, window)
+			for url, window in self.remote.FitbitLogRangeRequests(dataType, date_stamps)))
+
+	########################### Remote data read/write methods ############################
+
+	async def ReadFromFitbit(self, url):
+		"""Peforms a read request from Fitbit API. The request will be paused if the API rate limit budget
+		has been used up!
+
+		url -- url of the Fitbit API request
+		"""
+		rateLimiter,metrics = self.remote.rateLimiter,self.remote.metrics
+		refreshed = False
+		async with self._fitbitSlots:
+			while True:
+				seconds = rateLimiter.Reserve()
+				if seconds > 0:
+					rateLimiter.Waiting(seconds)
+					metrics.Count('rate_limit_wait_seconds', seconds)
+					await asyncio.sleep(seconds)
+					continue
+
+				token = self.fitbitClient.client.session.token
+				if self.remote.helper.FitbitTokenExpiring(self.fitbitClient):
+					await self._RefreshFitbitToken(token)
+					token = self.fitbitClient.client.session.token
+				headers = {'Authorization': 'Bearer {}'.format(token['access_token'])}
+				metrics.Count('fitbit_requests')
+				with metrics.Time('fetch'):
+					async with self.session.get(url, headers=headers) as response:
+						rateLimiter.Update(response.headers)
+						if response.status == 429:
+							# Budget was used up elsewhere, e.g. by another app of the same user
+							rateLimiter.Exhaust(int(response.headers.get('Retry-After', 3600)))
+						elif response.status == 401 and not refreshed:
+							await self._RefreshFitbitToken(token, force=True)
+							refreshed = True
+						else:
+							response.raise_for_status()
+							return await response.json()
+				metrics.Count('fitbit_retries')
+
+	async def ReadFromFitbitCached(self, date_stamp, url):
+		"""Peforms a read request from Fitbit API, unless the response cache has it. Shares the cache entries
+		of Remote.ReadFromFitbitCached.
+
+		date_stamp -- timestamp in yyyy-mm-dd format of the last day the request covers
+		url -- url of the Fitbit API request
+		"""
+		responseCache = self.remote.responseCache
+		if responseCache is None:
+			return await self.ReadFromFitbit(url)
+
+		key = responseCache.Key(self.fitbitClient.make_request.__name__, url)
+		resp = responseCache.Get(key, self.remote.FitbitCacheMaxAge(date_stamp))
+		if resp is None:
+			resp = await self.ReadFromFitbit(url)
+			responseCache.Put(key, resp)
+		else:
+			self.remote.metrics.Count('fitbit_cache_hits')
+		return resp
+
+	async def _RefreshFitbitToken(self, expiredToken, force=False):
+		async with self._fitbitRefresh:
+			# Another request may have refreshed the token in the meantime
+			if self.fitbitClient.client.session.token is expiredToken:
+				logging.debug("Refreshing Fitbit token")
+				await asyncio.get_running_loop().run_in_executor(
+					None, self.remote.helper.RefreshFitbitToken, self.fitbitClient, force)
+
+	async def WriteToGoogleFit(self, dataSourceId, data_points):
+		"""Write data to google fit
+
+		dataSourceId -- data source id for google fit
+		data_point -- google data points, as a list or an IntradayDataset
+		"""
+		dataType = self.remote.DataTypeOfSource(dataSourceId)
+		async def patch(datasetId, body, fingerprint, size):
+			with self.remote.metrics.Time('upload', dataType):
+				await self._GoogleRequest('PATCH', '{}/dataSources/{}/datasets/{}'.format(
+					self.googleFitUrl, dataSourceId, datasetId), body)
+			self.remote.CountUploaded(dataType, len(body['point']), size)
+			self.remote.RecordUpload(dataSourceId, datasetId, fingerprint)
+		await asyncio.gather(*(patch(datasetId, body, fingerprint, size)
+			for datasetId, body, fingerprint, size in self.remote.DatasetRequests(dataSourceId, data_points)
+			if not self.remote.IsUploaded(dataSourceId, datasetId, fingerprint)))
+
+	async def WriteSessionToGoogleFit(self, session_data):
+		"""Write data to google fit
+
+		session_data -- a session data
+		"""
+		dataType = self.remote.SessionDataType(session_data)
+		with self.remote.metrics.Time('upload', dataType):
+			await self._GoogleRequest('PUT', '{}/sessions/{}'.format(self.googleFitUrl, session_data['id']), session_data)
+		self.remote.metrics.Count('google_requests', dataType=dataType)
+		self.remote.metrics.Count('sessions_uploaded', dataType=dataType)
+
+	async def _GoogleRequest(self, method, url, body):
+		async with self._googleSlots:
+			for attempt in range(self.GFIT_RETRIES + 1):
+				if self.googleCredentials.access_token_expired:
+					await self._RefreshGoogleToken(self.googleCredentials.access_token)
+				token = self.googleCredentials.access_token
+				headers = {'Authorization': 'Bearer {}'.format(token)}
+				try:
+					async with self.session.request(method, url, json=body, headers=headers) as response:
+						if response.status == 401 and attempt < self.GFIT_RETRIES:
+							await self._RefreshGoogleToken(token)
+						elif response.status in (429, 500, 502, 503, 504) and attempt < self.GFIT_RETRIES:
+							logging.debug("Google Fit responded %d, retrying %s", response.status, url)
+							self.remote.metrics.Count('google_retries')
+							await asyncio.sleep(2 ** attempt)
+						else:
+							response.raise_for_status()
+							return await response.json()
+				except aiohttp.ClientConnectionError as e:
+					# Google Fit sometimes drops the connection, same as in Remote
+					if attempt == self.GFIT_RETRIES:
+						raise
+					logging.debug("Connection to Google Fit lost, retrying %s - %s", url, e)
+					self.remote.metrics.Count('google_retries')
+
+	async def _RefreshGoogleToken(self, expiredToken):
+		async with self._googleRefresh:
+			# Another request may have refreshed the token in the meantime
+			if self.googleCredentials.access_token == expiredToken:
+				logging.debug("Refreshing Google token")
+				await asyncio.get_running_loop().run_in_executor(None, self.googleCredentials.refresh, httplib2.Http())
@@ -133,8 +133,10 @@ def main():
         client_id=args.id,
         client_secret=args.secret,
         access_token=server.oauth.session.token['access_token'],
-        refresh_token=server.oauth.session.token['refresh_token'])
-    json.dump(credentials, open('fitbit.json', 'w'))
+        refresh_token=server.oauth.session.token['refresh_token'],
+        expires_at=server.oauth.session.token.get('expires_at'))
+    with open('fitbit.json', 'w') as f:
+        json.dump(credentials, f)
 
 if __name__ == '__main__':
     main()
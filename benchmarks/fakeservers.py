@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the Fitbit and Google Fit APIs, for load tests of the sync without using up any quota. The
+Fitbit server serves the endpoints Remote reads from with data of fixtures.py, and enforces a per-user request
+budget with Fitbit's rate limit headers and 429 responses. The Google Fit server accepts data sources, datasets,
+sessions and batch requests, and counts what it receives. Both can add latency, and the Google Fit server can
+drop connections half way through a request. Clients still sending the body see a BrokenPipeError, others a
+ConnectionResetError.
+"""
+import re
+import json
+import time
+import random
+import socket
+import threading
+import functools
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http.client import responses
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import fixtures
+
+DATE = r'(\d{4}-\d{2}-\d{2})'
+DETAIL_SECONDS = {'1sec': 1, '1min': 60, '5min': 300, '15min': 900}
+INTRADAY_TYPES = {'steps': 'steps', 'distance': 'distance', 'heart': 'heart_rate', 'calories': 'calories'}
+
+
+def DaysBetween(first, last):
+	"""Returns the timestamps in yyyy-mm-dd format of the days from first to last, both included"""
+	day, end = datetime.strptime(first, '%Y-%m-%d'), datetime.strptime(last, '%Y-%m-%d')
+	days = []
+	while day <= end:
+		days.append(day.strftime('%Y-%m-%d'))
+		day += timedelta(days=1)
+	return days
+
+@functools.lru_cache(maxsize=32)
+def IntradayBody(dataType, date_stamp, step):
+	"""Returns the encoded intraday response of a day. Generating 1sec days is slow, and accounts synced in
+	parallel usually ask for the same days, so recent ones are kept."""
+	return json.dumps(fixtures.IntradayResponse(dataType, date_stamp, step)).encode()
+
+
+class FakeServer(ThreadingHTTPServer):
+	"""An http server on a free local port, running in a background thread, with thread-safe request counters"""
+	daemon_threads = True
+
+	def __init__(self, handler, latency=0):
+		""" Intialize a fake server.
+
+		handler -- request handler class
+		latency -- seconds every request is delayed by
+		"""
+		super().__init__(('127.0.0.1', 0), handler)
+		self.latency = latency
+		self.stats = Counter()
+		self._lock = threading.Lock()
+		self._thread = None
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:{}'.format(self.server_port)
+
+	def Start(self):
+		"""Starts serving in a background thread, returns the server"""
+		self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def Stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def Count(self, **counts):
+		with self._lock:
+			self.stats.update(counts)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+	"""Request handler with keep-alive connections and json responses"""
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def Token(self):
+		return self.headers.get('Authorization', '').replace('Bearer ', '')
+
+	def ReadBody(self):
+		return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+	def SendJson(self, status, body, headers=None):
+		content = body if isinstance(body, bytes) else json.dumps(body).encode()
+		self.SendContent(status, 'application/json', content, headers)
+
+	def SendContent(self, status, contentType, content, headers=None):
+		self.send_response(status)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(content)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(content)
+
+
+class FitbitHandler(FakeHandler):
+
+	def do_GET(self):
+		server = self.server
+		time.sleep(server.latency)
+		allowed, remaining, reset = server.TakeRequest(self.Token())
+		headers = {'Fitbit-Rate-Limit-Limit': str(server.limit), 'Fitbit-Rate-Limit-Remaining': str(remaining),
+			'Fitbit-Rate-Limit-Reset': str(reset)}
+		if not allowed:
+			server.Count(rate_limited=1)
+			headers['Retry-After'] = str(reset)
+			return self.SendJson(429, dict(errors=[dict(errorType='system', message='Too Many Requests')]), headers)
+
+		url = urlsplit(self.path)
+		body = server.Respond(url.path, {name: values[0] for name, values in parse_qs(url.query).items()})
+		if body is None:
+			server.Count(not_found=1)
+			return self.SendJson(404, dict(errors=[dict(errorType='not_found', message=url.path)]), headers)
+		server.Count(requests=1, bytes_sent=len(body))
+		self.SendJson(200, body, headers)
+
+
+class FakeFitbitServer(FakeServer):
+	"""Serves the Fitbit endpoints used by Remote: the profile, intraday time series of a day, daily totals of a range
+	of days, weight and body fat
+	logs, v1.2 sleep logs and the activities list. Every access token has its own request budget of limit requests
+	per window, like Fitbit's hourly budget per user."""
+
+	def __init__(self, limit=150, window=3600, latency=0, exhaustRate=0, timezone='Europe/Berlin', activities=(),
+			seed=0):
+		""" Intialize a fake Fitbit server.
+
+		limit -- requests per window and access token
+		window -- seconds until the budget of all tokens is reset, windows start when the server is created
+		latency -- seconds every request is delayed by
+		exhaustRate -- chance of a request finding the budget used up, as if by another app of the user
+		timezone -- timezone in the profile of every user
+		activities -- activity logs of every user, oldest first
+		seed -- seed of the random faults
+		"""
+		super().__init__(FitbitHandler, latency)
+		self.limit = limit
+		self.window = window
+		self.exhaustRate = exhaustRate
+		self.timezone = timezone
+		self.activities = list(activities)
+		self._random = random.Random(seed)
+		self._started = time.monotonic()
+		self._budgets = {} # access token -> (window index, requests used)
+		self._routes = (
+			(re.compile(r'^/[\d.]+/user/-/profile\.json$'), self.Profile),
+			(re.compile(r'^/[\d.]+/user/-/activities/(steps|distance|heart|calories)/date/{}/1d/(\w+)\.json$'.format(DATE)),
+				self.Intraday),
+			(re.compile(r'^/[\d.]+/user/-/activities/(steps|distance|calories)/date/{}/{}\.json$'.format(DATE, DATE)),
+				self.DailyTotals),
+			(re.compile(r'^/[\d.]+/user/-/body/log/(weight|fat)/date/{}/{}\.json$'.format(DATE, DATE)), self.BodyLogs),
+			(re.compile(r'^/[\d.]+/user/-/sleep/date/{}(?:/{})?\.json$'.format(DATE, DATE)), self.Sleep),
+			(re.compile(r'^/1/user/-/activities/list\.json$'), self.ActivitiesList),
+		)
+
+	def TakeRequest(self, token):
+		"""Takes a request from the budget of a token. Returns whether it was allowed, the number of requests left
+		and the number of seconds until the budget is reset."""
+		elapsed = time.monotonic() - self._started
+		index = int(elapsed // self.window)
+		reset = max(1, int(round((index + 1) * self.window - elapsed)))
+		with self._lock:
+			budgetIndex, used = self._budgets.get(token, (index, 0))
+			if budgetIndex != index:
+				used = 0
+			if used < self.limit and self.exhaustRate and self._random.random() < self.exhaustRate:
+				used = self.limit
+			allowed = used < self.limit
+			self._budgets[token] = (index, used + 1 if allowed else used)
+		return allowed, max(0, self.limit - used - 1) if allowed else 0, reset
+
+	def Respond(self, path, query):
+		"""Returns the json body of a request, or None for unknown endpoints"""
+		for pattern, handler in self._routes:
+			match = pattern.match(path)
+			if match:
+				return handler(query, *match.groups())
+		return None
+
+	def Profile(self, query):
+		return dict(user=dict(displayName='Load Test', timezone=self.timezone, offsetFromUTCMillis=3600000))
+
+	def Intraday(self, query, resource, date_stamp, detail):
+		if detail not in DETAIL_SECONDS:
+			return None
+		return IntradayBody(INTRADAY_TYPES[resource], date_stamp, DETAIL_SECONDS[detail])
+
+	def DailyTotals(self, query, resource, first, last):
+		return fixtures.DailyTotalsResponse(resource, DaysBetween(first, last))
+
+	def BodyLogs(self, query, resource, first, last):
+		return fixtures.BodyLogs('weight' if resource == 'weight' else 'body_fat', DaysBetween(first, last))
+
+	def Sleep(self, query, first, last=None):
+		return dict(sleep=[fixtures.SleepLog(date_stamp, int(date_stamp.replace('-', '')))
+			for date_stamp in DaysBetween(first, last or first)])
+
+	def ActivitiesList(self, query):
+		afterDate, offset, limit = query.get('afterDate', ''), int(query.get('offset', 0)), int(query.get('limit', 20))
+		nextUrl = lambda offset: '{}/1/user/-/activities/list.json?afterDate={}&sort=asc&offset={}&limit={}'.format(
+			self.url, afterDate, offset, limit)
+		return fixtures.ActivitiesPage(self.activities, afterDate, offset, limit, nextUrl)
+
+
+class GoogleFitHandler(FakeHandler):
+
+	def do_GET(self):
+		self.Handle('GET')
+
+	def do_POST(self):
+		self.Handle('POST')
+
+	def do_PATCH(self):
+		self.Handle('PATCH')
+
+	def do_PUT(self):
+		self.Handle('PUT')
+
+	def Handle(self, method):
+		server = self.server
+		time.sleep(server.latency)
+		if method != 'GET' and server.DropConnection():
+			# Hang up without reading the body, like a server closing a stale keep-alive connection
+			server.Count(dropped=1)
+			self.connection.shutdown(socket.SHUT_RDWR)
+			self.close_connection = True
+			return
+
+		body = self.ReadBody()
+		server.Count(bytes_received=len(body))
+		path = urlsplit(self.path).path
+		if path.startswith('/batch'):
+			return self.HandleBatch(body)
+		status, response = server.Respond(method, path, self.Token(), body)
+		self.SendJson(status, response)
+
+	def HandleBatch(self, body):
+		"""Answers a multipart/mixed batch request with a part per request, like the google api client expects"""
+		server = self.server
+		server.Count(batches=1)
+		message = BytesParser().parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+		boundary = 'batch_{}'.format(random.getrandbits(64))
+		parts = []
+		for part in message.get_payload():
+			request = part.get_payload(decode=True) or part.get_payload().encode()
+			head, _, partBody = request.replace(b'\r\n', b'\n').partition(b'\n\n')
+			method, path = head.split(b'\n')[0].decode().split(' ')[:2]
+			status, response = server.Respond(method, urlsplit(path).path, self.Token(), partBody)
+			contentId = re.sub(r'\r?\n(?=[ \t])', '', part['Content-ID'])[1:-1]
+			parts.append('--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n'
+				'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n\r\n{}\r\n'.format(
+				boundary, contentId, status, responses[status], json.dumps(response)))
+		content = (''.join(parts) + '--{}--\r\n'.format(boundary)).encode()
+		self.SendContent(200, 'multipart/mixed; boundary={}'.format(boundary), content)
+
+
+class FakeGoogleFitServer(FakeServer):
+	"""Serves the Google Fit endpoints used by Remote and AsyncRemote: data source get and create, dataset patch,
+	session update and batch requests. Data sources are kept per access token, everything else is only counted."""
+
+	PREFIX = '/fitness/v1/users/me/'
+
+	def __init__(self, latency=0, dropRate=0, seed=0):
+		""" Intialize a fake Google Fit server.
+
+		latency -- seconds every request is delayed by
+		dropRate -- chance of a write request losing its connection before the body is read
+		seed -- seed of the random faults
+		"""
+		super().__init__(GoogleFitHandler, latency)
+		self.dropRate = dropRate
+		self._random = random.Random(seed)
+		self._dataTypes = defaultdict(set) # access token -> names of the data types of the created data sources
+
+	def DropConnection(self):
+		with self._lock:
+			return self.dropRate and self._random.random() < self.dropRate
+
+	def DiscoveryDocument(self, document):
+		"""Returns a Google Fit discovery document that points the google api client to this server
+
+		document -- the discovery document of the Google Fit API
+		"""
+		document = dict(document, rootUrl=self.url + '/')
+		document['baseUrl'] = document['rootUrl'] + document['servicePath']
+		return document
+
+	def Respond(self, method, path, token, body):
+		"""Returns the status and json body of a request"""
+		self.Count(**{'requests': 1, method.lower(): 1})
+		if not path.startswith(self.PREFIX):
+			return 404, dict(error=dict(code=404, message='Not found: ' + path))
+		path = [unquote(segment) for segment in path[len(self.PREFIX):].split('/')]
+		body = json.loads(body) if body else {}
+
+		if path[0] == 'dataSources' and len(path) == 2 and method == 'GET':
+			if path[1].split(':')[1] not in self._dataTypes[token]:
+				return 404, dict(error=dict(code=404, message='DataSourceId not found: ' + path[1]))
+			return 200, dict(dataStreamId=path[1])
+		if path[0] == 'dataSources' and len(path) == 1 and method == 'POST':
+			with self._lock:
+				self._dataTypes[token].add(body['dataType']['name'])
+			return 200, body
+		if path[0] == 'dataSources' and len(path) == 4 and path[2] == 'datasets' and method == 'PATCH':
+			self.Count(datasets=1, points=len(body.get('point', [])))
+			return 200, dict(dataSourceId=path[1], minStartTimeNs=body.get('minStartTimeNs'),
+				maxEndTimeNs=body.get('maxEndTimeNs'))
+		if path[0] == 'sessions' and len(path) == 2 and method == 'PUT':
+			self.Count(sessions=1)
+			return 200, body
+		return 404, dict(error=dict(code=404, message='Not found: ' + '/'.join(path)))
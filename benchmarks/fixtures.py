@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Synthetic Fitbit API payloads and fake API clients for the benchmarks. All data is generated from a seed, so
+every run converts and uploads exactly the same points.
+"""
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+# Intraday resources as they appear in Fitbit responses, and whether their values are floats
+INTRADAY_RESOURCES = {
+	'steps': ('activities-steps', False),
+	'distance': ('activities-distance', True),
+	'heart_rate': ('activities-heart', False),
+	'calories': ('activities-calories', True),
+}
+SLEEP_LEVELS = ('wake', 'light', 'deep', 'rem')
+
+
+def LocalTimes(date_stamp, tzinfo, step):
+	"""Returns the "hh:mm:ss" times of a day on the local clock, every step seconds. Times skipped by a DST
+	transition are left out and times repeated by one are only listed once, like Fitbit does.
+
+	date_stamp -- timestamp in yyyy-mm-dd format of the day
+	tzinfo -- timezone of the user, None for a day without transitions
+	step -- seconds between two times
+	"""
+	day = datetime.strptime(date_stamp, '%Y-%m-%d')
+	times = []
+	for second in range(0, 86400, step):
+		local = day + timedelta(seconds=second)
+		if tzinfo is not None:
+			# A time that does not exist on the local clock does not survive a round trip through UTC
+			roundTrip = local.replace(tzinfo=tzinfo).astimezone(timezone.utc).astimezone(tzinfo).replace(tzinfo=None)
+			if roundTrip != local:
+				continue
+		times.append('{:02d}:{:02d}:{:02d}'.format(second // 3600, second // 60 % 60, second % 60))
+	return times
+
+def IntradayPoints(dataType, date_stamp, step, tzinfo=None, zeroEvery=4, seed=0):
+	"""Returns the intraday points of a day, like the dataset of a Fitbit intraday response. Roughly one in
+	zeroEvery points is zero, in runs, like the hours of a night.
+
+	dataType -- steps, distance, heart_rate or calories
+	date_stamp -- timestamp in yyyy-mm-dd format of the day
+	step -- seconds between two points, 1 or 60
+	tzinfo -- timezone of the user, to leave out times skipped by DST
+	zeroEvery -- one in this many points is zero
+	seed -- seed of the generated values
+	"""
+	rand = random.Random('{}-{}-{}'.format(dataType, date_stamp, seed))
+	isFloat = INTRADAY_RESOURCES[dataType][1]
+	dataset = []
+	value = 0
+	for time in LocalTimes(date_stamp, tzinfo, step):
+		# Values change in runs, so some points repeat the previous value
+		if rand.random() < 0.3:
+			value = 0 if rand.random() < 1 / zeroEvery else (
+				round(rand.uniform(0.01, 0.2), 5) if isFloat else
+				rand.randint(55, 170) if dataType == 'heart_rate' else rand.randint(1, 140))
+		dataset.append(dict(time=time, value=value))
+	return dataset
+
+def IntradayResponse(dataType, date_stamp, step, tzinfo=None, seed=0):
+	"""Returns a Fitbit intraday time series response of a day
+
+	dataType -- steps, distance, heart_rate or calories
+	date_stamp -- timestamp in yyyy-mm-dd format of the day
+	step -- seconds between two points, 1 or 60
+	tzinfo -- timezone of the user, to leave out times skipped by DST
+	seed -- seed of the generated values
+	"""
+	resource = INTRADAY_RESOURCES[dataType][0]
+	dataset = IntradayPoints(dataType, date_stamp, step, tzinfo, seed=seed)
+	return {
+		resource: [dict(dateTime=date_stamp, value=str(sum(point['value'] for point in dataset)))],
+		resource + '-intraday': dict(dataset=dataset, datasetInterval=step if step < 60 else step // 60,
+			datasetType='second' if step < 60 else 'minute'),
+	}
+
+def DailyTotalsResponse(dataType, date_stamps, seed=0):
+	"""Returns a Fitbit time series response with the daily totals of a range of days, the sums of their 1min
+	intraday points
+
+	dataType -- steps, distance or calories
+	date_stamps -- timestamps in yyyy-mm-dd format of the days
+	seed -- seed of the generated values
+	"""
+	resource = INTRADAY_RESOURCES[dataType][0]
+	return {resource: [dict(dateTime=date_stamp, value=str(sum(point['value']
+		for point in IntradayPoints(dataType, date_stamp, 60, seed=seed)))) for date_stamp in date_stamps]}
+
+def SleepLog(date_stamp, logId, hours=8, seed=0):
+	"""Returns a Fitbit v1.2 sleep log with stages, starting the evening before a day
+
+	date_stamp -- timestamp in yyyy-mm-dd format of the day the sleep ends on
+	logId -- id of the log
+	hours -- length of the sleep
+	seed -- seed of the generated stages
+	"""
+	rand = random.Random('sleep-{}-{}'.format(date_stamp, seed))
+	start = datetime.strptime(date_stamp, '%Y-%m-%d') - timedelta(hours=rand.uniform(1, 2.5))
+	end = start + timedelta(hours=hours)
+	data, shortData = [], []
+	moment = start
+	while moment < end:
+		seconds = min(int((end - moment).total_seconds()), 30 * rand.randint(2, 60))
+		data.append(dict(dateTime=moment.strftime('%Y-%m-%dT%H:%M:%S.000'), level=rand.choice(SLEEP_LEVELS),
+			seconds=seconds))
+		if rand.random() < 0.2:
+			shortData.append(dict(dateTime=moment.strftime('%Y-%m-%dT%H:%M:%S.000'), level='wake', seconds=30))
+		moment += timedelta(seconds=seconds)
+	return dict(
+		dateOfSleep=date_stamp, duration=hours * 3600000, isMainSleep=True, logId=logId, type='stages',
+		startTime=start.strftime('%Y-%m-%dT%H:%M:%S.000'), endTime=end.strftime('%Y-%m-%dT%H:%M:%S.000'),
+		levels=dict(data=data, shortData=shortData, summary={level: dict(count=0, minutes=0) for level in SLEEP_LEVELS}))
+
+def BodyLogs(dataType, date_stamps, seed=0):
+	"""Returns a Fitbit body log response with a log per day
+
+	dataType -- weight or body_fat
+	date_stamps -- timestamps in yyyy-mm-dd format of the days
+	seed -- seed of the generated values
+	"""
+	rand = random.Random('{}-{}'.format(dataType, seed))
+	if dataType == 'weight':
+		return dict(weight=[dict(bmi=23.5, date=date_stamp, logId=1000 + i, source='Aria', time='07:{:02d}:00'.format(i % 60),
+			weight=round(rand.uniform(150, 160), 1)) for i, date_stamp in enumerate(date_stamps)])
+	return dict(fat=[dict(date=date_stamp, fat=round(rand.uniform(18, 22), 2), logId=2000 + i, source='Aria',
+		time='07:{:02d}:00'.format(i % 60)) for i, date_stamp in enumerate(date_stamps)])
+
+def Activities(count, start_date, seed=0):
+	"""Returns a list of Fitbit activity logs, about two a day from a given day on
+
+	count -- number of activities
+	start_date -- date of the first activity
+	seed -- seed of the generated activities
+	"""
+	rand = random.Random('activities-{}'.format(seed))
+	names = ('Walk', 'Run', 'Biking', 'Swim', 'Workout', 'Hike', 'Tennis', 'Elliptical', 'Yoga')
+	activities = []
+	for i in range(count):
+		day = start_date + timedelta(days=i // 2)
+		activities.append(dict(
+			activityName=rand.choice(names), duration=rand.randint(10, 120) * 60000, logId=10**9 + i,
+			logType=rand.choice(('auto_detected', 'manual', 'tracker')),
+			startTime='{}T{:02d}:{:02d}:00.000+01:00'.format(day, 7 + 9 * (i % 2), rand.randint(0, 59))))
+	return activities
+
+def ActivitiesPage(activities, afterDate, offset, limit, nextUrl):
+	"""Returns a page of a Fitbit activities list response
+
+	activities -- all activities, oldest first
+	afterDate -- day the listed activities start on
+	offset -- index of the first activity of the page
+	limit -- max number of activities of the page
+	nextUrl -- function that returns the url of the page at a given offset
+	"""
+	listed = [activity for activity in activities if activity['startTime'][:10] >= afterDate[:10]]
+	page = listed[offset:offset + limit]
+	return dict(activities=page, pagination=dict(afterDate=afterDate, limit=limit, offset=offset, sort='asc',
+		next=nextUrl(offset + limit) if offset + limit < len(listed) else '', previous=''))
+
+
+class FakeRequest:
+	"""A google api request that only records itself when executed"""
+
+	def __init__(self, client, method, kwargs):
+		self.client, self.method, self.kwargs = client, method, kwargs
+
+	def execute(self, http=None):
+		self.client.requests.append((self.method, self.kwargs))
+		self.client.bytesSent += len(json.dumps(self.kwargs.get('body', {})))
+		return {}
+
+
+class FakeBatch:
+	"""A google api batch request that executes its requests one by one"""
+
+	def __init__(self, callback):
+		self.callback, self.requests = callback, []
+
+	def add(self, request, callback=None, request_id=None):
+		self.requests.append((request, callback or self.callback, request_id))
+
+	def execute(self, http=None):
+		for request, callback, request_id in self.requests:
+			callback(request_id, request.execute(), None)
+
+
+class FakeResource:
+	"""A google api resource, e.g. users().dataSources(), whose methods return FakeRequests"""
+
+	def __init__(self, client, path):
+		self._client, self._path = client, path
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		if name in ('get', 'create', 'patch', 'update', 'list', 'delete'):
+			return lambda **kwargs: FakeRequest(self._client, '.'.join(self._path + [name]), kwargs)
+		return lambda **kwargs: FakeResource(self._client, self._path + [name])
+
+
+class FakeGoogleClient(FakeResource):
+	"""Stands in for the google fit client built by googleapiclient, without any network access. All requests
+	are recorded, along with the number of body bytes they would have sent."""
+
+	def __init__(self):
+		super().__init__(self, [])
+		self.requests = []
+		self.bytesSent = 0
+
+	def new_batch_http_request(self, callback=None):
+		return FakeBatch(callback)
+
+
+class FakeSession:
+	def __init__(self):
+		self.hooks = dict(response=[])
+		self.token = dict(access_token='fake', refresh_token='fake')
+
+
+class FakeFitbitClient:
+	"""Stands in for the python-fitbit client. Only used by code that builds urls or registers response hooks,
+	it has no request methods. Benchmarks that read from Fitbit use FakeFitbitServer of fakeservers.py."""
+	API_ENDPOINT = 'https://api.fitbit.com'
+	API_VERSION = 1.2
+
+	def __init__(self):
+		self.client = type('FakeOauth2Client', (), {})()
+		self.client.session = FakeSession()
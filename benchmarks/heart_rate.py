@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Compares the upload size of a day of heart rate data at the supported detail levels.
+Run from the repository root: python3 benchmarks/heart_rate.py
+"""
+import os
+import sys
+import json
+import time
+import math
+import dateutil.tz
+from datetime import time as dtime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from convertors import Convertor
+from remote import Remote
+
+
+def fitbit_day(seconds_step):
+	"""Returns a synthetic day of Fitbit heart rate points. Fitbit averages coarser detail levels itself."""
+	bpm = lambda s: int(70 + 25 * math.sin(s / 3600.0) + (s * 7919) % 9)
+	return [dict(time='{:02d}:{:02d}:{:02d}'.format(s // 3600, s // 60 % 60, s % 60),
+		value=round(sum(bpm(t) for t in range(s, s + seconds_step)) / seconds_step))
+		for s in range(0, 86400, seconds_step)]
+
+def request_bodies(points):
+	"""Serialised request bodies of a dataset, split the same way WriteToGoogleFit does"""
+	if len(points) >= Remote.GFIT_MAX_POINTS_PER_UPDATE:
+		half = int(len(points)/2)
+		return request_bodies(points[:half]) + request_bodies(points[half:])
+	return [json.dumps(dict(dataSourceId='raw:com.google.heart_rate.bpm', maxEndTimeNs=points.MaxEndTimeNanos(),
+		minStartTimeNs=points.MinStartTimeNanos(), point=points.Points()), sort_keys=True)]
+
+def main():
+	convertor = Convertor(None, '0', dateutil.tz.gettz('Europe/Berlin'), dtime(23, 59, 59))
+	for detail, bucketNanos in Remote.HEART_RATE_DETAIL_NANOS.items():
+		data = fitbit_day(bucketNanos // 10**9)
+
+		start = time.perf_counter()
+		points = convertor.ConvertFitbitIntraday('2021-06-01', data, 'heart_rate').NonZero()
+		bodies = request_bodies(points)
+		elapsed = time.perf_counter() - start
+
+		print('{:<5} {:>6} points  {:>3} requests  {:>9.1f} KiB  {:7.3f}s'.format(
+			detail, len(points), len(bodies),
+			sum(len(body) for body in bodies) / 1024, elapsed))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compares the per-point dict conversion of a day of Fitbit intraday data with the array-backed
+IntradayDataset path. Run from the repository root: python3 benchmarks/intraday.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+import argparse
+import dateutil.tz
+from datetime import time as dtime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from convertors import Convertor
+
+
+def fitbit_day(seconds_step, zero_every=4):
+	"""Returns a synthetic day of Fitbit intraday points, every zero_every-th point being zero"""
+	return [dict(time='{:02d}:{:02d}:{:02d}'.format(s // 3600, s // 60 % 60, s % 60),
+		value=0 if (s // seconds_step) % zero_every == 0 else 60 + s % 40)
+		for s in range(0, 86400, seconds_step)]
+
+def dict_path(convertor, date_stamp, data, dataType):
+	googlePoints = [convertor.ConvertFibitPoint(date_stamp,point,dataType) for point in data]
+	nonZeroPoints = [
+		point for point in googlePoints if not all(
+			('intVal' in v and v['intVal'] == 0) or ('fpVal' in v and v['fpVal'] == 0) for v in point['value'])]
+	return nonZeroPoints
+
+def dataset_path(convertor, date_stamp, data, dataType):
+	nonZeroPoints = convertor.ConvertFitbitIntraday(date_stamp,data,dataType).NonZero()
+	# points are only materialised per request body, in chunks
+	for i in range(0, len(nonZeroPoints), 8000):
+		nonZeroPoints[i:i+8000].Points()
+	return nonZeroPoints
+
+def measure(fn, *args):
+	start = time.perf_counter()
+	fn(*args)
+	elapsed = time.perf_counter() - start
+	# peak memory is measured on a separate run, tracemalloc slows everything down
+	tracemalloc.start()
+	result = fn(*args)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return result, elapsed, peak
+
+def main():
+	parser = argparse.ArgumentParser("Intraday conversion benchmark")
+	parser.add_argument("-n", "--days", type=int, default=3, help="Number of days to convert")
+	args = parser.parse_args()
+
+	convertor = Convertor(None, '0', dateutil.tz.gettz('Europe/Berlin'), dtime(23, 59, 59))
+	for dataType, step in (('heart_rate', 1), ('steps', 60), ('distance', 60), ('calories', 60)):
+		data = fitbit_day(step)
+		dict_s = dataset_s = dict_peak = dataset_peak = 0
+		for day in range(args.days):
+			date_stamp = '2021-03-{:02d}'.format(26 + day)
+			old, elapsed, peak = measure(dict_path, convertor, date_stamp, data, dataType)
+			dict_s, dict_peak = dict_s + elapsed, max(dict_peak, peak)
+			new, elapsed, peak = measure(dataset_path, convertor, date_stamp, data, dataType)
+			dataset_s, dataset_peak = dataset_s + elapsed, max(dataset_peak, peak)
+			assert old == new.Points(), 'conversion mismatch for {} on {}'.format(dataType, date_stamp)
+		print('{:<11} {:>6} pts/day  dicts: {:7.3f}s {:8.1f} KiB peak   dataset: {:7.3f}s {:8.1f} KiB peak  ({:.1f}x, {:.1f}x)'.format(
+			dataType, len(data), dict_s, dict_peak / 1024, dataset_s, dataset_peak / 1024,
+			dict_s / dataset_s, dict_peak / dataset_peak))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Load test of the multi-account sync against the local fake Fitbit and Google Fit servers of fakeservers.py. Every
+account gets its own credentials and Fitbit budget, the sync itself is the AccountPool of app.py --accounts, or with
+--asyncio the asyncio engine of app.py --asyncio, one account after another.
+Reports wall time, requests per second and the time accounts sat out waiting for their Fitbit budget.
+
+Fitbit's budget is 150 requests an hour, scale the window down to keep multi-year runs short, e.g.
+	python3 benchmarks/loadtest.py --accounts 4 --days 730 --window 30 --drop-rate 0.01
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import configparser
+import contextlib
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fitbit
+from oauth2client.client import OAuth2Credentials
+from googleapiclient.discovery_cache import get_static_doc
+from accounts import LoadAccounts, AccountPool
+import fixtures
+from fakeservers import FakeFitbitServer, FakeGoogleFitServer
+
+EXPIRES = datetime(2100, 1, 1) # Tokens are never refreshed during a load test
+
+
+def write_accounts(accountsDir, count, googleUrl):
+	"""Writes the Fitbit and Google credentials of count accounts, each with its own access tokens"""
+	for i in range(count):
+		name = 'user{:03d}'.format(i)
+		os.makedirs(os.path.join(accountsDir, name))
+		with open(os.path.join(accountsDir, name, 'fitbit.json'), 'w') as f:
+			json.dump(dict(client_id='loadtest', client_secret='loadtest', access_token='fitbit-' + name,
+				refresh_token='fitbit-refresh-' + name, expires_at=EXPIRES.timestamp()), f)
+		credentials = OAuth2Credentials('google-' + name, 'loadtest', 'loadtest', 'google-refresh-' + name,
+			EXPIRES, googleUrl + '/token', None)
+		with open(os.path.join(accountsDir, name, 'google.json'), 'w') as f:
+			f.write(credentials.to_json())
+
+def load_test_params(tmpdir, googleServer, args):
+	"""Returns the [params] section of the load test config, with the Google Fit discovery document pointing to
+	the fake Google Fit server"""
+	discoveryFile = os.path.join(tmpdir, 'fitness.v1.json')
+	with open(discoveryFile, 'w') as f:
+		json.dump(googleServer.DiscoveryDocument(json.loads(get_static_doc('fitness', 'v1'))), f)
+	config = configparser.ConfigParser()
+	config.read_dict(dict(params=dict(
+		state_file='sync_state.db', finalize_after_days='1', batch_uploads='1', fetch_log_ranges='1',
+		heart_rate_detail=args.heart_rate_detail, weigh_time='23:59:59', project_number='0',
+		google_discovery_file=discoveryFile)))
+	return config['params']
+
+def sync_async(accounts, params, dataTypes, date_stamps, start_date, end_date, syncActivities):
+	"""Syncs the accounts one after another with the asyncio engine, which has no pool of accounts"""
+	from asyncremote import AsyncRemote
+	for account in accounts:
+		account.Setup(params, dataTypes)
+		remote = account.remote
+		asyncRemote = AsyncRemote(remote, remote.helper.GetGoogleCredentials(), params.getint('fitbit_concurrency', 4),
+			params.getint('google_concurrency', 8), params.getint('connection_pool_size', 16))
+		for _ in asyncRemote.SyncFitbitDaysToGoogleFit(dataTypes, date_stamps):
+			pass
+		if syncActivities:
+			remote.SyncFitbitActivitiesToGoogleFit(start_date=start_date, end_date=end_date)
+
+def main():
+	parser = argparse.ArgumentParser("Multi-account sync load test against local fake servers")
+	parser.add_argument("--accounts", type=int, default=4, help="Number of accounts")
+	parser.add_argument("--days", type=int, default=365, help="Number of days to sync")
+	parser.add_argument("--end-date", default="2021-12-31", help="Last day to sync")
+	parser.add_argument("--types", default="steps,distance,heart_rate,weight,sleep", help="Data types to sync")
+	parser.add_argument("--activities", action="store_true", help="Sync activities too")
+	parser.add_argument("--heart-rate-detail", default="1min", help="Heart rate detail level")
+	parser.add_argument("--workers", type=int, default=4, help="Number of accounts synced at the same time")
+	parser.add_argument("--asyncio", action="store_true", help="Sync with the asyncio engine instead of the pool")
+	parser.add_argument("--days-per-turn", type=int, default=7, help="Max number of days synced in one turn")
+	parser.add_argument("--limit", type=int, default=150, help="Fitbit requests per window and account")
+	parser.add_argument("--window", type=float, default=60, help="Seconds of a Fitbit rate limit window")
+	parser.add_argument("--fitbit-latency", type=float, default=0.02, help="Seconds added to every Fitbit request")
+	parser.add_argument("--google-latency", type=float, default=0.02, help="Seconds added to every Google request")
+	parser.add_argument("--exhaust-rate", type=float, default=0,
+		help="Chance of a Fitbit request finding the budget used up by another app")
+	parser.add_argument("--drop-rate", type=float, default=0,
+		help="Chance of a Google Fit write losing its connection, e.g. with a BrokenPipeError")
+	parser.add_argument("-o", "--output", help="Write the report to this json file")
+	parser.add_argument("--verbose", action="store_true", help="Show the output of the sync")
+	args = parser.parse_args()
+
+	end_date = date.fromisoformat(args.end_date) + timedelta(days=1)
+	start_date = end_date - timedelta(days=args.days)
+	date_stamps = [(start_date + timedelta(days=i)).isoformat() for i in range(args.days)]
+	dataTypes = args.types.split(',')
+
+	fitbitServer = FakeFitbitServer(args.limit, args.window, args.fitbit_latency, args.exhaust_rate,
+		activities=fixtures.Activities(2 * args.days, start_date) if args.activities else ()).Start()
+	googleServer = FakeGoogleFitServer(args.google_latency, args.drop_rate).Start()
+	# The python client library builds all Fitbit urls from this endpoint, oauthlib only allows http locally
+	fitbit.Fitbit.API_ENDPOINT = fitbitServer.url
+	os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		accountsDir = os.path.join(tmpdir, 'accounts')
+		write_accounts(accountsDir, args.accounts, googleServer.url)
+		params = load_test_params(tmpdir, googleServer, args)
+		pool = AccountPool(LoadAccounts(accountsDir, params), params, args.workers, args.days_per_turn)
+
+		output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+		start = time.perf_counter()
+		with output:
+			if args.asyncio:
+				sync_async(pool.accounts, params, dataTypes, date_stamps, start_date, end_date, args.activities)
+			else:
+				pool.SyncRound(dataTypes, date_stamps, start_date, end_date, syncActivities=args.activities)
+		wall = time.perf_counter() - start
+
+	fitbitServer.Stop()
+	googleServer.Stop()
+	fitbitStats, googleStats = fitbitServer.stats, googleServer.stats
+	report = dict(
+		accounts=args.accounts, days=args.days, data_types=dataTypes, wall_s=wall,
+		fitbit=dict(fitbitStats, requests_per_s=fitbitStats['requests'] / wall),
+		google=dict(googleStats, requests_per_s=googleStats['requests'] / wall),
+		rate_limited_s=sum(pool.restSeconds.values()),
+		rate_limited_s_per_account=dict(pool.restSeconds),
+		account_days_per_s=args.accounts * args.days / wall)
+
+	print('{} accounts x {} days of {} in {:.1f}s ({:.1f} account days/s)'.format(
+		args.accounts, args.days, ', '.join(dataTypes), wall, report['account_days_per_s']))
+	print('Fitbit      {:>7} requests {:>8.1f} req/s  {} rate limited (429)  {:.1f} MB sent'.format(
+		fitbitStats['requests'], report['fitbit']['requests_per_s'], fitbitStats['rate_limited'],
+		fitbitStats['bytes_sent'] / 2**20))
+	print('Google Fit  {:>7} requests {:>8.1f} req/s  {} batches  {} points  {} sessions  {} dropped  {:.1f} MB received'.format(
+		googleStats['requests'], report['google']['requests_per_s'], googleStats['batches'], googleStats['points'],
+		googleStats['sessions'], googleStats['dropped'], googleStats['bytes_received'] / 2**20))
+	print('Rate limited {:.0f}s in total, {:.0f}s per account on average'.format(
+		report['rate_limited_s'], report['rate_limited_s'] / args.accounts))
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+	main()
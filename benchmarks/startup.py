@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Measures the cold start time of app.py: printing the version, a run with nothing to sync, and importing all
+modules that a real sync needs. Each case runs in a fresh interpreter, like cron.sh does.
+Run from the repository root: python3 benchmarks/startup.py
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import statistics
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from state import SyncState
+
+RUNS = 5
+
+
+def noop_config(tmpdir):
+	"""Writes a config and sync state in which the last 3 days of steps are final already"""
+	stateFile = os.path.join(tmpdir, 'state.db')
+	syncState = SyncState(stateFile)
+	for days_ago in range(1, 4):
+		syncState.MarkSynced('steps', (date.today() - timedelta(days=days_ago)).isoformat(), date.today() + timedelta(days=7))
+	configFile = os.path.join(tmpdir, 'config.ini')
+	with open(configFile, 'w') as f:
+		f.write('[params]\nstart_date=3 days ago\nend_date=today\nsync_steps=1\nsync_activities=0\n'
+			'state_file={}\nweigh_time=23:59:59\nproject_number=0\n'.format(stateFile))
+	return configFile
+
+def time_command(command):
+	"""Returns the min and median wall time of a command over RUNS runs"""
+	times = []
+	for _ in range(RUNS):
+		start = time.perf_counter()
+		subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+		times.append(time.perf_counter() - start)
+	return min(times), statistics.median(times)
+
+def main():
+	with tempfile.TemporaryDirectory() as tmpdir:
+		cases = (
+			('interpreter', [sys.executable, '-c', 'pass']),
+			('app.py --version', [sys.executable, 'app.py', '--version']),
+			('app.py, nothing to sync', [sys.executable, 'app.py', '-c', noop_config(tmpdir)]),
+			('sync imports', [sys.executable, '-c', 'import app, helpers, remote, googleapiclient.discovery']),
+		)
+		for name, command in cases:
+			fastest, median = time_command(command)
+			print('{:<25} min {:6.3f}s  median {:6.3f}s'.format(name, fastest, median))
+
+if __name__ == '__main__':
+	main()
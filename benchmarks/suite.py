@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the conversion and upload hot path on synthetic Fitbit data: single point conversion, whole day
+conversion (including DST days), zero filtering, building request bodies and splitting uploads, with a fake
+Google client. Results are written as json, and compared with an earlier run to catch regressions.
+
+Run from the repository root:
+	python3 benchmarks/suite.py -o results.json
+	python3 benchmarks/suite.py --baseline results.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import dateutil.tz
+from datetime import date, time as dtime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from convertors import Convertor
+from remote import Remote
+import fixtures
+
+TZ = dateutil.tz.gettz('Europe/Berlin')
+DAY = '2021-06-01'
+DST_SPRING, DST_FALL = '2021-03-28', '2021-10-31'
+
+
+def new_remote(**kwargs):
+	"""Returns a remote object that writes to a fake google client"""
+	convertor = Convertor(None, '0', TZ, dtime(23, 59, 59))
+	googleClient = fixtures.FakeGoogleClient()
+	return Remote(fixtures.FakeFitbitClient(), googleClient, convertor, None, TZ, **kwargs), googleClient
+
+def cases():
+	"""Returns a list of (name, number of points, setup) tuples. setup returns the function to time, and is
+	called before every run, so that every run starts from the same state."""
+	convertor = Convertor(None, '0', TZ, dtime(23, 59, 59))
+	hr_1sec = fixtures.IntradayPoints('heart_rate', DAY, 1)
+	steps_1min = fixtures.IntradayPoints('steps', DAY, 60)
+	distance_1min = fixtures.IntradayPoints('distance', DAY, 60)
+	hr_spring = fixtures.IntradayPoints('heart_rate', DST_SPRING, 1, TZ)
+	hr_fall = fixtures.IntradayPoints('heart_rate', DST_FALL, 1, TZ)
+	steps_spring = fixtures.IntradayPoints('steps', DST_SPRING, 60, TZ)
+	sleeps = [fixtures.SleepLog('2021-06-{:02d}'.format(day), day) for day in range(1, 8)]
+	sleep_points = [point for sleep in sleeps for point in sleep['levels']['data']]
+	weights = fixtures.BodyLogs('weight', ['2021-06-{:02d}'.format(day) for day in range(1, 31)])['weight']
+	activities = fixtures.Activities(5000, date(2015, 1, 1))
+	hr_dataset = convertor.ConvertFitbitIntraday(DAY, hr_1sec, 'heart_rate')
+	hr_nonzero = hr_dataset.NonZero()
+	hr_dicts = hr_nonzero.Points()
+
+	def convert_points(data, dataType, date_stamp=DAY):
+		return lambda: lambda: [convertor.ConvertFibitPoint(date_stamp, point, dataType) for point in data]
+
+	def convert_day(data, dataType, date_stamp=DAY):
+		return lambda: lambda: convertor.ConvertFitbitIntraday(date_stamp, data, dataType)
+
+	def convert_sleep():
+		remote, _ = new_remote()
+		return lambda: remote.ConvertFitbitSleepDay(DAY, sleeps)
+
+	def convert_activities():
+		return lambda: [convertor.ConvertFitbitActivityLog(activity) for activity in activities]
+
+	def payload(data_points):
+		remote, _ = new_remote()
+		return lambda: list(remote.DatasetRequests('raw:com.google.heart_rate.bpm', data_points))
+
+	def write(data_points):
+		remote, _ = new_remote()
+		return lambda: remote.WriteToGoogleFit('raw:com.google.heart_rate.bpm', data_points)
+
+	def write_week_batched():
+		remote, _ = new_remote(batchUploads=True)
+		days = [convertor.ConvertFitbitIntraday('2021-06-{:02d}'.format(day), steps_1min, 'steps').NonZero()
+			for day in range(1, 8)]
+		def run():
+			for points in days:
+				remote.QueueToGoogleFit('raw:com.google.step_count.delta', points)
+			remote.FlushToGoogleFit()
+		return run
+
+	return [
+		('convert_point.heart_rate_1sec', len(hr_1sec), convert_points(hr_1sec, 'heart_rate')),
+		('convert_point.steps_1min', len(steps_1min), convert_points(steps_1min, 'steps')),
+		('convert_point.distance_1min', len(distance_1min), convert_points(distance_1min, 'distance')),
+		('convert_point.heart_rate_1sec_dst_spring', len(hr_spring), convert_points(hr_spring, 'heart_rate', DST_SPRING)),
+		('convert_point.sleep_stages_week', len(sleep_points), lambda: lambda: [
+			convertor.ConvertFibitPoint(DAY, point, 'sleep', TZ) for point in sleep_points]),
+		('convert_point.weight_month', len(weights), convert_points(weights, 'weight')),
+		('convert_day.heart_rate_1sec', len(hr_1sec), convert_day(hr_1sec, 'heart_rate')),
+		('convert_day.heart_rate_1sec_dst_spring', len(hr_spring), convert_day(hr_spring, 'heart_rate', DST_SPRING)),
+		('convert_day.heart_rate_1sec_dst_fall', len(hr_fall), convert_day(hr_fall, 'heart_rate', DST_FALL)),
+		('convert_day.steps_1min', len(steps_1min), convert_day(steps_1min, 'steps')),
+		('convert_day.steps_1min_dst_spring', len(steps_spring), convert_day(steps_spring, 'steps', DST_SPRING)),
+		('convert_day.distance_1min', len(distance_1min), convert_day(distance_1min, 'distance')),
+		('convert_day.sleep_stages_week', len(sleep_points), convert_sleep),
+		('convert_day.activities_5000', len(activities), convert_activities),
+		('filter_zero.heart_rate_1sec', len(hr_dataset), lambda: lambda: hr_dataset.NonZero()),
+		('payload.heart_rate_1sec', len(hr_nonzero), lambda: payload(hr_nonzero)),
+		('payload.heart_rate_1sec_dicts', len(hr_dicts), lambda: payload(hr_dicts)),
+		('write.heart_rate_1sec', len(hr_nonzero), lambda: write(hr_nonzero)),
+		('write.steps_week_batched', 7 * len(steps_1min), write_week_batched),
+	]
+
+def measure(setup, repeat):
+	"""Returns the run times of a case in seconds"""
+	times = []
+	for _ in range(repeat):
+		run = setup()
+		start = time.perf_counter()
+		run()
+		times.append(time.perf_counter() - start)
+	return times
+
+def upload_counts():
+	"""Returns the number of requests and bytes sent by the write cases, to catch changes in how uploads are split"""
+	convertor = Convertor(None, '0', TZ, dtime(23, 59, 59))
+	points = convertor.ConvertFitbitIntraday(DAY, fixtures.IntradayPoints('heart_rate', DAY, 1), 'heart_rate').NonZero()
+	remote, googleClient = new_remote()
+	remote.WriteToGoogleFit('raw:com.google.heart_rate.bpm', points)
+	return dict(requests=len(googleClient.requests), bytes=googleClient.bytesSent)
+
+def environment():
+	try:
+		commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+	except OSError:
+		commit = None
+	return dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+		platform=platform.platform(), commit=commit)
+
+def main():
+	parser = argparse.ArgumentParser("Conversion and upload benchmarks")
+	parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs of every case")
+	parser.add_argument("-k", "--filter", default="", help="Only run cases whose name contains this text")
+	parser.add_argument("-o", "--output", help="Write the results to this json file")
+	parser.add_argument("-b", "--baseline", help="Compare with the results of an earlier run")
+	parser.add_argument("-t", "--tolerance", type=float, default=1.25,
+		help="Fail if a case is this many times slower than the baseline")
+	args = parser.parse_args()
+
+	results = dict(environment=environment(), repeat=args.repeat, uploads=upload_counts(), cases={})
+	for name, points, setup in cases():
+		if args.filter not in name:
+			continue
+		times = measure(setup, args.repeat)
+		results['cases'][name] = dict(points=points, min_s=min(times), median_s=statistics.median(times),
+			points_per_s=points / min(times))
+		print('{:<42} {:>7} pts  min {:8.4f}s  median {:8.4f}s  {:>12,.0f} pts/s'.format(
+			name, points, min(times), statistics.median(times), points / min(times)))
+	print('write.heart_rate_1sec uploads: {requests} requests, {bytes} bytes'.format(**results['uploads']))
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = [
+			(name, result['min_s'] / baseline['cases'][name]['min_s'])
+			for name, result in results['cases'].items()
+			if name in baseline['cases'] and result['min_s'] > baseline['cases'][name]['min_s'] * args.tolerance]
+		for name, factor in regressions:
+			print('REGRESSION {} is {:.2f}x slower than the baseline'.format(name, factor))
+		if baseline.get('uploads') != results['uploads']:
+			print('CHANGED uploads {} -> {}'.format(baseline.get('uploads'), results['uploads']))
+		if regressions:
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+
+class ResponseCache:
+	"""A gzip compressed on-disk cache of Fitbit API responses. Entries are addressed by a hash of the owner of the
+	cache, the api method and its arguments, and the least recently used entries are evicted once the cache grows
+	too big."""
+
+	def __init__(self, cacheDir, maxBytes=500*1024*1024, owner=''):
+		""" Intialize a response cache.
+
+		cacheDir -- directory to keep the cached responses in
+		maxBytes -- maximum size of all cached responses together
+		owner -- identity of the Fitbit account the responses belong to, e.g. the path of its credentials file. Fitbit
+			urls address the user as '-', so responses of different accounts are only told apart by their owner.
+		"""
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.owner = owner
+		self._lock = threading.Lock()
+		os.makedirs(cacheDir, exist_ok=True)
+		self._sizes = {path: os.path.getsize(path) for path in self._Entries()}
+		self._total = sum(self._sizes.values())
+
+	def _Entries(self):
+		for root, dirs, files in os.walk(self.cacheDir):
+			for name in files:
+				if name.endswith('.json.gz'):
+					yield os.path.join(root, name)
+
+	def Key(self, name, *args, **kwargs):
+		"""Returns the cache key of an api call
+
+		name -- name of the api method
+		args -- arguments of the api method
+		"""
+		request = json.dumps([self.owner, name, args, kwargs], sort_keys=True, default=str)
+		return hashlib.sha256(request.encode('utf8')).hexdigest()
+
+	def _Path(self, key):
+		return os.path.join(self.cacheDir, key[:2], key + '.json.gz')
+
+	def Get(self, key, maxAge=None):
+		"""Returns a cached response, or None if there is none or it is older than maxAge
+
+		key -- cache key of the api call
+		maxAge -- maximum age in seconds of the response, None if it never expires
+		"""
+		path = self._Path(key)
+		try:
+			with gzip.open(path, 'rt', encoding='utf8') as f:
+				entry = json.load(f)
+			if maxAge is not None and time.time() - entry['fetched'] > maxAge:
+				return None
+			# Eviction goes by modification time, as access times are not kept by all file systems
+			os.utime(path)
+		except (OSError, ValueError, KeyError):
+			return None
+		logging.debug("Fitbit response cache hit %s", key)
+		return entry['response']
+
+	def Put(self, key, response):
+		"""Caches a response
+
+		key -- cache key of the api call
+		response -- decoded json response
+		"""
+		path = self._Path(key)
+		fd, tmpPath = self._TempFile(path)
+		try:
+			with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf8') as f:
+				json.dump(dict(fetched=time.time(), response=response), f, separators=(',', ':'))
+		except BaseException:
+			self._Remove(tmpPath)
+			raise
+		os.replace(tmpPath, path)
+		self._Added(path)
+
+	def _TempFile(self, path):
+		"""Returns an open file descriptor and the path of a new temporary file next to an entry, unique across
+		threads and processes"""
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		return tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+
+	def _Remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+	def _Added(self, path):
+		size = os.path.getsize(path)
+		with self._lock:
+			self._total += size - self._sizes.get(path, 0)
+			self._sizes[path] = size
+			if self._total > self.maxBytes:
+				self._Evict()
+
+	def Stream(self, key, maxAge=None, chunkBytes=64*1024):
+		"""Returns a generator of the chunks of the json text of a cached response, or None if there is none or it
+		is older than maxAge. Lets large responses be parsed without decoding them as a whole, see jsonstream.py.
+
+		key -- cache key of the api call
+		maxAge -- maximum age in seconds of the response, None if it never expires
+		chunkBytes -- size of the chunks
+		"""
+		path = self._Path(key)
+		try:
+			f = gzip.open(path, 'rb')
+			head = f.read(chunkBytes)
+		except OSError:
+			return None
+		# Entries start with the time they were fetched, see Put
+		match = re.match(rb'\{"fetched":([0-9.e+-]+),"response":', head)
+		if match is None or maxAge is not None and time.time() - float(match.group(1)) > maxAge:
+			f.close()
+			return None
+		os.utime(path)
+		logging.debug("Fitbit response cache hit %s", key)
+		return self._Chunks(f, head[match.end():], chunkBytes)
+
+	def _Chunks(self, f, head, chunkBytes):
+		with f:
+			chunk = head
+			while chunk:
+				yield chunk
+				chunk = f.read(chunkBytes)
+
+	def PutStream(self, key, chunks):
+		"""Returns a generator of the chunks of the json text of a response, that caches the response once the last
+		chunk has been taken. Nothing is cached if the response is not read to the end.
+
+		key -- cache key of the api call
+		chunks -- iterable of the bytes of the response
+		"""
+		path = self._Path(key)
+		fd, tmpPath = self._TempFile(path)
+		try:
+			with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wb') as f:
+				f.write('{{"fetched":{},"response":'.format(time.time()).encode('utf8'))
+				for chunk in chunks:
+					f.write(chunk)
+					yield chunk
+				f.write(b'}')
+		except BaseException:
+			self._Remove(tmpPath)
+			raise
+		os.replace(tmpPath, path)
+		self._Added(path)
+
+	def _Evict(self):
+		"""Removes least recently used entries until the cache is below 90% of its maximum size"""
+		for path in sorted(self._sizes, key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0):
+			if self._total <= self.maxBytes * 0.9:
+				break
+			self._total -= self._sizes.pop(path)
+			self._Remove(path)
+		logging.debug("Fitbit response cache evicted down to %d bytes", self._total)
@@ -8,11 +8,14 @@ import datetime
 import time
 import dateutil.parser
 import json
+import numpy as np
+from bisect import bisect_right
 from datetime import timedelta, date
 from decimal import Decimal
-from oauth2client.file import Storage
 import parsedatetime as pdt
 
+from datasets import IntradayDataset
+
 class Convertor:
 	"""Methods for data type conversions. All fitbit conversion methods convert to google fit compatible data types"""
 
@@ -21,6 +24,7 @@ class Convertor:
 	METERS_PER_MILE = 1609.34
 	NANOS_PER_SECOND = 1000*1000*1000
 	NANOS_PER_MINUTE = NANOS_PER_SECOND*60
+	DAILY_TYPES = ('steps','distance','calories') # Data types that can be synced as daily totals, see DailyDataType
 
 	def __init__(self, googleCredsFile, googleDeveloperProjectNumber, tzinfo, weighTime):
 		""" Intialize a convertor object.
@@ -32,10 +36,12 @@ class Convertor:
 		self.googleDeveloperProjectNumber = googleDeveloperProjectNumber
 		self.tzinfo = tzinfo
 		self.weighTime = weighTime
+		self._dayClocks = {}
 
 	def UpdateTimezone(self, tzinfo):
 		"""Update user's timezone info"""
 		self.tzinfo = tzinfo
+		self._dayClocks = {}
 
 	#------------------------ General convertors ----------------------------
 
@@ -54,6 +60,77 @@ class Convertor:
 			logTime = dateutil.parser.parse(timestamp)
 		return int((logTime - dawnOfTime).total_seconds() * 1000)
 
+	def GetDayClock(self, date, tzinfo=None):
+		"""Returns the epoch seconds of a day's local midnight (as if it were UTC) and the list of
+		(second of day, utc offset in seconds) pairs in effect on that day. Resolved once per day and cached.
+
+		date -- date in "yyyy-mm-dd" format
+		tzinfo -- tzinfo to use, defaults to the timezone passed during construction
+		"""
+		tzinfo = tzinfo if tzinfo else self.tzinfo
+		# tzinfo objects are not always hashable, so key on identity and keep a reference to compare against
+		key = (date, id(tzinfo))
+		clock = self._dayClocks.get(key)
+		if clock is not None and clock[0] is tzinfo:
+			return clock[1:]
+
+		midnight = datetime.datetime.strptime(date, '%Y-%m-%d')
+		offsetOf = lambda second: tzinfo.utcoffset(midnight + timedelta(seconds=second)) // timedelta(seconds=1)
+
+		# Offsets only change at DST transitions, so sample every hour and bisect where they differ
+		samples = list(range(0, 86400, 3600)) + [86399]
+		offsets = [(0, offsetOf(0))]
+		for lo, hi in zip(samples, samples[1:]):
+			if offsetOf(hi) == offsets[-1][1]:
+				continue
+			while hi - lo > 1:
+				mid = (lo + hi) // 2
+				if offsetOf(mid) == offsets[-1][1]:
+					lo = mid
+				else:
+					hi = mid
+			offsets.append((hi, offsetOf(hi)))
+
+		if len(self._dayClocks) > 64:
+			self._dayClocks = {}
+		clock = (tzinfo, (midnight - datetime.datetime(1970, 1, 1)) // timedelta(seconds=1), offsets)
+		self._dayClocks[key] = clock
+		return clock[1:]
+
+	def EpochNanosOfFitbitTimes(self, date, times, tzinfo=None):
+		"""Returns a list of epoch time stamps (in nanoseconds) for a list of fitbit intraday times of a day.
+		Gives the same values as EpochOfFitbitTimestamp, but without parsing each time stamp.
+
+		date -- date to which the times belong to in "yyyy-mm-dd" format
+		times -- list of "hh:mm:ss" (24-hour) time strings
+		tzinfo -- tzinfo to use, defaults to the timezone passed during construction
+		"""
+		if not (tzinfo if tzinfo else self.tzinfo):
+			return [self.nano(self.EpochOfFitbitTimestamp("{} {}".format(date, t))) for t in times]
+		midnight, offsets = self.GetDayClock(date, tzinfo)
+		transitions = [second for second, _ in offsets]
+		epochs = []
+		for t in times:
+			if len(t) == 8:
+				second = int(t[0:2])*3600 + int(t[3:5])*60 + int(t[6:8])
+			elif len(t) == 5:
+				second = int(t[0:2])*3600 + int(t[3:5])*60
+			else:
+				epochs.append(self.nano(self.EpochOfFitbitTimestamp("{} {}".format(date, t), tzinfo=tzinfo)))
+				continue
+			offset = offsets[bisect_right(transitions, second) - 1][1] if len(offsets) > 1 else offsets[0][1]
+			epochs.append((midnight + second - offset) * self.NANOS_PER_SECOND)
+		return epochs
+
+	def EpochNanosOfFitbitTime(self, date, timeOfDay, tzinfo=None):
+		"""Returns a epoch time stamp (in nanoseconds) of a single fitbit intraday time of a day.
+
+		date -- date to which the time belongs to in "yyyy-mm-dd" format
+		timeOfDay -- "hh:mm:ss" (24-hour) time string
+		tzinfo -- tzinfo to use, defaults to the timezone passed during construction
+		"""
+		return self.EpochNanosOfFitbitTimes(date, [timeOfDay], tzinfo)[0]
+
 	def nano(self, val):
 		"""Converts epoch milliseconds to nano seconds precision"""
 		return int(val * (10**6))
@@ -100,14 +177,95 @@ class Convertor:
 		else:
 			raise ValueError("Unexpected data type given!")
 
+	def ConvertFitbitIntraday(self, date, intraday_data, dataType):
+		"""Converts a day of Fitbit intraday data points of a given data type to an IntradayDataset.
+		Gives the same points as ConvertFibitPoint, without building a dict for each of them.
+
+		date -- date to which the data points belong to in "yyyy-mm-dd" format
+		intraday_data -- list of Fitbit intraday data points
+		dataType -- data type of the points
+		"""
+		times = [point['time'] for point in intraday_data]
+		values = np.array([point['value'] for point in intraday_data])
+		if self.tzinfo and all(len(t) == 8 for t in times):
+			return self.ConvertFitbitIntradayColumns(date, self.SecondsOfFitbitTimes(times), values, dataType)
+		startTimeNanos = np.array(self.EpochNanosOfFitbitTimes(date, times), dtype=np.int64)
+		return self._IntradayDataset(dataType, startTimeNanos, values)
+
+	def ConvertFitbitIntradayColumns(self, date, seconds, values, dataType):
+		"""Converts a day of Fitbit intraday data of a given data type, given as columns, to an IntradayDataset.
+		Gives the same points as ConvertFitbitIntraday.
+
+		date -- date to which the data points belong to in "yyyy-mm-dd" format
+		seconds -- array of the seconds of the day of the points, as returned by SecondsOfFitbitTimes
+		values -- array of the values of the points
+		dataType -- data type of the points
+		"""
+		midnight, offsets = self.GetDayClock(date)
+		transitions = np.array([second for second, _ in offsets])
+		utcOffsets = np.array([offset for _, offset in offsets])
+		startTimeNanos = (midnight + seconds - utcOffsets[np.searchsorted(transitions, seconds, side='right') - 1]
+			) * self.NANOS_PER_SECOND
+		return self._IntradayDataset(dataType, startTimeNanos, values)
+
+	def SecondsOfFitbitTimes(self, times):
+		"""Returns an array of the seconds of the day of a list of fitbit intraday times
+
+		times -- list of "hh:mm:ss" (24-hour) time strings
+		"""
+		# "hh:mm:ss" digits of all points at once, as a n x 8 matrix
+		digits = np.frombuffer(''.join(times).encode('ascii'), dtype=np.uint8).reshape(-1, 8).astype(np.int64) - ord('0')
+		return (digits[:,0]*10 + digits[:,1])*3600 + (digits[:,3]*10 + digits[:,4])*60 + digits[:,6]*10 + digits[:,7]
+
+	def ConvertFitbitDailyPoint(self, date, data_point, dataType):
+		"""Converts a Fitbit daily total of a given data type to a single Google fit data point that spans the whole
+		day, from local midnight to the next
+
+		date -- date of the total in "yyyy-mm-dd" format
+		data_point -- a single Fitbit time series data point, e.g. {"dateTime": "2016-08-20", "value": "10234"}
+		dataType -- steps, distance or calories
+		"""
+		nextDate = (datetime.datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+		dataTypeName,valueKey,_ = self._IntradayDataType(dataType)
+		# Time series values are strings, e.g. "10234" or "7.0342"
+		value = float(data_point['value'])
+		if dataType == 'distance':
+			value *= self.METERS_PER_MILE
+
+		return dict(
+			dataTypeName=dataTypeName,
+			startTimeNanos=self.nano(self.EpochOfFitbitTimestamp("{} 00:00:00".format(date))),
+			endTimeNanos=self.nano(self.EpochOfFitbitTimestamp("{} 00:00:00".format(nextDate))),
+			value=[{valueKey: int(value) if valueKey == 'intVal' else value}]
+			)
+
+	def _IntradayDataType(self, dataType):
+		"""Returns the google fit data type name, value field and point duration of an intraday data type"""
+		if dataType == 'steps':
+			return 'com.google.step_count.delta','intVal',self.NANOS_PER_MINUTE
+		elif dataType == 'distance':
+			return 'com.google.distance.delta','fpVal',self.NANOS_PER_MINUTE
+		elif dataType == 'heart_rate':
+			return 'com.google.heart_rate.bpm','fpVal',0
+		elif dataType == 'calories':
+			return 'com.google.calories.expended','fpVal',self.NANOS_PER_MINUTE
+		else:
+			raise ValueError("Unexpected data type given!")
+
+	def _IntradayDataset(self, dataType, startTimeNanos, values):
+		dataTypeName,valueKey,duration = self._IntradayDataType(dataType)
+		dataset = IntradayDataset(dataTypeName, valueKey, startTimeNanos, startTimeNanos + duration, values)
+		if dataType == 'distance':
+			dataset = dataset.Scaled(self.METERS_PER_MILE)
+		return dataset
+
 	def ConvertFibitStepsPoint(self, date, data_point):
 		"""Converts a single Fitbit intraday steps data point to Google fit data point
 
 		date -- date to which the data_point belongs to in "yyyy-mm-dd" format
 		data_point -- a single Fitbit intraday step data point
 		"""
-		timestamp = "{} {}".format(date, data_point['time'])
-		epoch_time_nanos = self.nano(self.EpochOfFitbitTimestamp(timestamp))
+		epoch_time_nanos = self.EpochNanosOfFitbitTime(date, data_point['time'])
 
 		return dict(
 			dataTypeName='com.google.step_count.delta',
@@ -122,8 +280,7 @@ class Convertor:
 		date -- date to which the data_point belongs to in "yyyy-mm-dd" format
 		data_point -- a single Fitbit intraday step data point
 		"""
-		timestamp = "{} {}".format(date, data_point['time'])
-		epoch_time_nanos = self.nano(self.EpochOfFitbitTimestamp(timestamp))
+		epoch_time_nanos = self.EpochNanosOfFitbitTime(date, data_point['time'])
 		gfit_distance = data_point['value'] * self.METERS_PER_MILE
 
 		return dict(
@@ -139,8 +296,7 @@ class Convertor:
 		date -- date to which the data_point belongs to in "yyyy-mm-dd" format
 		data_point -- a single Fitbit intraday step data point
 		"""
-		timestamp = "{} {}".format(date, data_point['time'])
-		epoch_time_nanos = self.nano(self.EpochOfFitbitTimestamp(timestamp))
+		epoch_time_nanos = self.EpochNanosOfFitbitTime(date, data_point['time'])
 
 		return dict(
 			dataTypeName='com.google.heart_rate.bpm',
@@ -155,8 +311,7 @@ class Convertor:
 		date -- date to which the data_point belongs to in "yyyy-mm-dd" format
 		data_point -- a single Fitbit intraday step data point
 		"""
-		timestamp = "{} {}".format(date, data_point['time'])
-		epoch_time_nanos = self.nano(self.EpochOfFitbitTimestamp(timestamp))
+		epoch_time_nanos = self.EpochNanosOfFitbitTime(date, data_point['time'])
 
 		return dict(
 			dataTypeName='com.google.calories.expended',
@@ -336,13 +491,24 @@ class Convertor:
 
 	#------------------------  Google Fit data source generators ------------------------
 
+	def DailyDataType(self, dataType):
+		"""Returns the data type under which the daily totals of a data type are synced, e.g. steps_daily. Daily
+		totals have data sources and sync state of their own, apart from the minute level data of the same type.
+
+		dataType -- fitbit data type
+		"""
+		return dataType + '_daily' if dataType in self.DAILY_TYPES else dataType
+
 	def GetDataSource(self, type='steps'):
 		"""Returns a data source for Google Fit data logging
 
-		type - type of data. Possible options: steps, weight, heart_rate, activity
+		type - type of data. Possible options: steps, weight, heart_rate, activity, or a daily type of DailyDataType
 		"""
 		# Do NOT change these after the first sync!
 		model,device_type = 'charge-hr', 'watch'
+		streamName = None
+		if type.endswith('_daily') and type[:-len('_daily')] in self.DAILY_TYPES:
+			type,streamName = type[:-len('_daily')],'daily'
 		if type == 'steps':
 			dataType=dict(name='com.google.step_count.delta')
 		elif type == 'distance':
@@ -364,12 +530,15 @@ class Convertor:
 		else:
 			raise ValueError("Unexpected data type given!")
 
-		return dict(
+		dataSource = dict(
 			type='raw',
 			application=dict(name='fbit-gfit'),
 			dataType=dataType,
 			device=dict(type=device_type,manufacturer='fitbit',model=model,
 				uid='io.pkp.fbit-gfit',version='1'))
+		if streamName:
+			dataSource['dataStreamName'] = streamName
+		return dataSource
 
 	def GetDataSourceId(self, dataType):
 		"""Returns a data source id for Google Fit
@@ -386,5 +555,5 @@ class Convertor:
 			self.googleDeveloperProjectNumber,
 			dataSource['device']['manufacturer'],
 			dataSource['device']['model'],
-			dataSource['device']['uid']))
+			dataSource['device']['uid']) + ((dataSource['dataStreamName'],) if 'dataStreamName' in dataSource else ()))
 
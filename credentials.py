@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+	import fcntl
+except ImportError:
+	# No locking between processes on this platform, threads of this process are still serialised
+	fcntl = None
+
+
+class CredentialStore:
+	"""A json credentials file that is safe to read and update from many threads and processes. Updates are made
+	under an exclusive lock of a .lock file next to it and replace the file atomically, so a crash or a concurrent
+	update can never leave a truncated or stale file behind. The credentials are kept in memory and shared by all
+	users of the same file in this process."""
+
+	_stores = {}
+	_storesLock = threading.Lock()
+
+	@staticmethod
+	def Open(credsFile):
+		"""Returns the store of a credentials file, the same object for every call with the same file
+
+		credsFile -- json credentials file
+		"""
+		path = os.path.abspath(credsFile)
+		with CredentialStore._storesLock:
+			if path not in CredentialStore._stores:
+				CredentialStore._stores[path] = CredentialStore(path)
+			return CredentialStore._stores[path]
+
+	def __init__(self, credsFile):
+		""" Intialize a credential store. Use Open() to share the store of a file.
+
+		credsFile -- json credentials file
+		"""
+		self.credsFile = credsFile
+		self._lock = threading.RLock()
+		self._lockDepth = 0
+		self._lockFile = None
+		self._credentials = None
+
+	@contextmanager
+	def Lock(self):
+		"""Holds the store exclusively, against other threads and other processes. Can be nested."""
+		with self._lock:
+			if self._lockDepth == 0 and fcntl is not None:
+				self._lockFile = open(self.credsFile + '.lock', 'a')
+				fcntl.flock(self._lockFile, fcntl.LOCK_EX)
+			self._lockDepth += 1
+			try:
+				yield
+			finally:
+				self._lockDepth -= 1
+				if self._lockDepth == 0 and self._lockFile is not None:
+					fcntl.flock(self._lockFile, fcntl.LOCK_UN)
+					self._lockFile.close()
+					self._lockFile = None
+
+	def Load(self, reload=False):
+		"""Returns a copy of the credentials
+
+		reload -- read the file again, e.g. to see updates made by other processes
+		"""
+		with self._lock:
+			if self._credentials is None or reload:
+				with open(self.credsFile) as f:
+					self._credentials = json.load(f)
+			return dict(self._credentials)
+
+	def Update(self, **changes):
+		"""Updates some of the credentials and writes them to the file. Changes made by other processes since the
+		file was last read are kept.
+
+		changes -- credentials to update
+		"""
+		with self.Lock():
+			credentials = self.Load(reload=True)
+			credentials.update(changes)
+			tmpFile = '{}.{}.tmp'.format(self.credsFile, os.getpid())
+			with open(os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+				json.dump(credentials, f)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmpFile, self.credsFile)
+			self._credentials = credentials
+		logging.debug("Updated credentials in %s", self.credsFile)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import hashlib
+import numpy as np
+
+
+class IntradayDataset:
+	"""A day (or more) of Google Fit data points of a single data type, stored as parallel arrays.
+	Google Fit points are only built when a request body is being serialised."""
+
+	def __init__(self, dataTypeName, valueKey, startTimeNanos, endTimeNanos, values):
+		""" Intialize an intraday dataset.
+
+		dataTypeName -- google fit data type name, e.g. com.google.step_count.delta
+		valueKey -- google fit value field of the points, intVal or fpVal
+		startTimeNanos -- array of epoch start times in nano seconds
+		endTimeNanos -- array of epoch end times in nano seconds
+		values -- array of point values
+		"""
+		self.dataTypeName = dataTypeName
+		self.valueKey = valueKey
+		self.startTimeNanos = np.asarray(startTimeNanos, dtype=np.int64)
+		self.endTimeNanos = np.asarray(endTimeNanos, dtype=np.int64)
+		self.values = np.asarray(values)
+
+	@staticmethod
+	def Concatenate(datasets):
+		"""Returns a single dataset with the points of a list of datasets of the same data type
+
+		datasets -- list of datasets
+		"""
+		first = datasets[0]
+		return IntradayDataset(first.dataTypeName, first.valueKey,
+			np.concatenate([dataset.startTimeNanos for dataset in datasets]),
+			np.concatenate([dataset.endTimeNanos for dataset in datasets]),
+			np.concatenate([dataset.values for dataset in datasets]))
+
+	def __len__(self):
+		return len(self.values)
+
+	def __getitem__(self, index):
+		"""Returns a dataset of the points selected by a slice, boolean mask or index array"""
+		return IntradayDataset(self.dataTypeName, self.valueKey,
+			self.startTimeNanos[index], self.endTimeNanos[index], self.values[index])
+
+	def Fingerprint(self):
+		"""Returns a hash of the data type and all points, without building the points"""
+		digest = hashlib.sha256('{}:{}:{}'.format(self.dataTypeName, self.valueKey, self.values.dtype).encode('utf8'))
+		for array in (self.startTimeNanos, self.endTimeNanos, self.values):
+			digest.update(np.ascontiguousarray(array).tobytes())
+		return digest.hexdigest()
+
+	def MinStartTimeNanos(self):
+		"""Returns the smallest start time of all points"""
+		return int(self.startTimeNanos.min())
+
+	def MaxEndTimeNanos(self):
+		"""Returns the largest end time of all points"""
+		return int(self.endTimeNanos.max())
+
+	def NonZero(self):
+		"""Returns a dataset without the points whose value is zero"""
+		return self[self.values != 0]
+
+	def Scaled(self, factor):
+		"""Returns a dataset with all values multiplied by a given factor
+
+		factor -- unit conversion factor
+		"""
+		return IntradayDataset(self.dataTypeName, self.valueKey,
+			self.startTimeNanos, self.endTimeNanos, self.values * factor)
+
+	def Coalesce(self):
+		"""Returns a dataset in which runs of adjacent points with the same value are merged. Interval points
+		(deltas) that touch each other are merged into a single interval holding the sum of their values, so totals
+		stay the same. Instantaneous points (e.g. heart rate) are left as they are, as Google Fit averages them per
+		point and dropping points of a run would change the averages.
+		"""
+		if len(self) < 2 or not np.any(self.endTimeNanos != self.startTimeNanos):
+			return self
+		same = self.values[1:] == self.values[:-1]
+
+		firsts = np.flatnonzero(np.r_[True, ~(same & (self.endTimeNanos[:-1] == self.startTimeNanos[1:]))])
+		lasts = np.r_[firsts[1:], len(self)] - 1
+		return IntradayDataset(self.dataTypeName, self.valueKey, self.startTimeNanos[firsts], self.endTimeNanos[lasts],
+			np.add.reduceat(self.values, firsts))
+
+	def Points(self):
+		"""Returns the Google Fit data points of this dataset as a list of dicts"""
+		return [
+			dict(
+				dataTypeName=self.dataTypeName,
+				startTimeNanos=start,
+				endTimeNanos=end,
+				value=[{self.valueKey: value}])
+			for start, end, value in zip(
+				self.startTimeNanos.tolist(), self.endTimeNanos.tolist(), self.values.tolist())]
+
+
+def CoalesceSegments(points):
+	"""Returns a list of Google Fit segment points (e.g. sleep segments) in which adjacent segments of the same
+	type are merged into one.
+
+	points -- list of google fit points, ordered by time
+	"""
+	segments = []
+	for point in points:
+		last = segments[-1] if segments else None
+		if last is not None and last['value'] == point['value'] and last['endTimeNanos'] == point['startTimeNanos']:
+			segments[-1] = dict(last, endTimeNanos=point['endTimeNanos'])
+		else:
+			segments.append(point)
+	return segments
@@ -3,56 +3,151 @@
 __author__ = "Praveen Kumar Pendyala"
 __email__ = "mail@pkp.io"
 """
+import os
+import time
 import logging
 import json
 import fitbit
 import httplib2
 from oauth2client.file import Storage
-from apiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+
+from credentials import CredentialStore
 
 
 class Helper(object):
 	"""Helper methods to hide trivial methods"""
 
-	def __init__(self, fitbitCredsFile, googleCredsFile):
+	GFIT_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/fitness/v1/rest'
+	FITBIT_REFRESH_MARGIN_SECS = 300 # Fitbit tokens are refreshed this long before they expire
+
+	def __init__(self, fitbitCredsFile, googleCredsFile, googleDiscoveryFile=None):
 		""" Intialize a helper object.
 
 		fitbitCredsFile -- Fitbit credentials file
 		googleCredsFile -- Google Fits credentials file
+		googleDiscoveryFile -- local copy of the Google Fit API discovery document, fetched when missing
 		"""
 		self.fitbitCredsFile = fitbitCredsFile
+		self.fitbitStore = CredentialStore.Open(fitbitCredsFile)
 		self.googleCredsFile = googleCredsFile
+		self.googleDiscoveryFile = googleDiscoveryFile
+		self._googleCredentials = None
+		self._googleDiscovery = None
 
 	def GetFitbitClient(self):
 		"""Returns an authenticated fitbit client object"""
 		logging.debug("Creating Fitbit client")
-		credentials = json.load(open(self.fitbitCredsFile))
+		credentials = self.fitbitStore.Load()
+		# Files written before expires_at was kept get a token that is refreshed with the first request
+		credentials.setdefault('expires_at', time.time())
 		client = fitbit.Fitbit(
 			refresh_cb = lambda token: self.UpdateFitbitCredentials(token),
 			**credentials)
 
+		# python-fitbit refreshes the token by itself after a 401 response, and requests-oauthlib once it has
+		# expired. Both would bypass the lock of the credentials store, so all refreshes go through RefreshFitbitToken
+		session = client.client.session
+		session.auto_refresh_url = None
+		session.register_compliance_hook('protected_request', lambda url, headers, data:
+			self._BeforeFitbitRequest(client, url, headers, data))
+		client.client.refresh_token = lambda: self.RefreshFitbitToken(client, force=True)
+
 		# Use v1.2 sleep API: https://github.com/orcasgit/python-fitbit/issues/128
 		client.API_VERSION = 1.2
 
 		logging.debug("Fitbit client created")
 		return client
 
+	def GetGoogleCredentials(self):
+		"""Returns the stored google credentials, refreshed tokens are written back to the same file"""
+		if self._googleCredentials is None:
+			self._googleCredentials = Storage(self.googleCredsFile).get()
+		return self._googleCredentials
+
+	def GetGoogleDiscovery(self):
+		"""Returns the Google Fit API discovery document. It is read once per process from googleDiscoveryFile,
+		or from the copy that comes with the google api client library, and only fetched if neither exists."""
+		if self._googleDiscovery is not None:
+			return self._googleDiscovery
+
+		document = None
+		if self.googleDiscoveryFile and os.path.exists(self.googleDiscoveryFile):
+			with open(self.googleDiscoveryFile) as f:
+				document = f.read()
+		if document is None:
+			from googleapiclient.discovery_cache import get_static_doc
+			document = get_static_doc('fitness', 'v1')
+		if document is None:
+			logging.debug("Fetching Google Fit discovery document")
+			response, document = httplib2.Http().request(self.GFIT_DISCOVERY_URL)
+			if response.status != 200:
+				raise IOError("Failed to fetch the Google Fit discovery document: HTTP {}".format(response.status))
+			document = document.decode('utf8')
+		if self.googleDiscoveryFile and not os.path.exists(self.googleDiscoveryFile):
+			with open(self.googleDiscoveryFile + '.tmp', 'w') as f:
+				f.write(document)
+			os.replace(self.googleDiscoveryFile + '.tmp', self.googleDiscoveryFile)
+
+		self._googleDiscovery = json.loads(document)
+		return self._googleDiscovery
+
+	def GetGoogleFitUrl(self):
+		"""Returns the url of the Google Fit API for the authenticated user, from the same discovery document the
+		google fit client is built from"""
+		document = self.GetGoogleDiscovery()
+		return document['rootUrl'] + document['servicePath'] + 'me'
+
 	def GetGoogleClient(self):
 		"""Returns an authenticated google fit client object"""
 		logging.debug("Creating Google client")
-		credentials = Storage(self.googleCredsFile).get()
+		credentials = self.GetGoogleCredentials()
 		http = credentials.authorize(httplib2.Http())
-		client = build('fitness', 'v1', http=http)
+		client = build_from_document(self.GetGoogleDiscovery(), http=http)
 		logging.debug("Google client created")
 		return client
 
 	def UpdateFitbitCredentials(self, token):
 		"""Persists new fitbit credentials to local storage
 
-		fitbitClient -- fitbit client object that contains the latest credentials
+		token -- the new fitbit token
 		"""
 		logging.debug("Refreshed Fitbit token")
-		credentials = json.load(open(self.fitbitCredsFile))
-		for t in ('access_token', 'refresh_token'):
-			credentials[t] = token[t]
-		json.dump(credentials, open(self.fitbitCredsFile, 'w'))
+		self.fitbitStore.Update(**{t: token[t] for t in ('access_token', 'refresh_token', 'expires_at') if t in token})
+
+	def FitbitTokenExpiring(self, fitbitClient):
+		"""Returns True if the token of a fitbit client expires within FITBIT_REFRESH_MARGIN_SECS
+
+		fitbitClient -- fitbit client object
+		"""
+		expiresAt = fitbitClient.client.session.token.get('expires_at')
+		return expiresAt is not None and expiresAt - time.time() < self.FITBIT_REFRESH_MARGIN_SECS
+
+	def _BeforeFitbitRequest(self, fitbitClient, url, headers, data):
+		self.RefreshFitbitToken(fitbitClient)
+		return url, headers, data
+
+	def RefreshFitbitToken(self, fitbitClient, force=False):
+		"""Refreshes the token of a fitbit client if it is about to expire, so requests do not run into a 401 response
+		first. A Fitbit refresh token can only be used once, so the refreshes of all threads and processes that use the
+		same credentials file are serialised, and a token that was refreshed by another one is adopted instead.
+
+		fitbitClient -- fitbit client object
+		force -- refresh even if the token is not about to expire, e.g. after a 401 response
+		"""
+		session = fitbitClient.client.session
+		token = session.token
+		if not force and not self.FitbitTokenExpiring(fitbitClient):
+			return
+		with self.fitbitStore.Lock():
+			if session.token['access_token'] != token['access_token']:
+				# Refreshed by another thread while waiting for the lock
+				return
+			stored = self.fitbitStore.Load(reload=True)
+			if stored['access_token'] != token['access_token']:
+				logging.debug("Using Fitbit token refreshed by another process")
+				session.token = dict(token, **{t: stored[t]
+					for t in ('access_token', 'refresh_token', 'expires_at') if t in stored})
+			else:
+				# The refresh of python-fitbit itself, the client's refresh_token leads back here
+				fitbit.api.FitbitOauth2Client.refresh_token(fitbitClient.client)
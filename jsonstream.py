@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import re
+import json
+import codecs
+
+_SEPARATORS = re.compile(r'[\s,]*')
+_decoder = json.JSONDecoder()
+
+
+def StreamJsonArray(chunks, keys):
+	"""Returns a generator of lists of the elements of an array of objects in a json document, parsed while the
+	document is read. Only the part of the document that has not been parsed yet is held in memory, e.g. the
+	objects of a chunk or two. Each list holds the objects completed by the chunks read since the previous list.
+
+	The array is found by its keys, searched for one after the other in the text of the document, e.g.
+	('activities-heart-intraday', 'dataset'). The text of the document before the array should not contain these
+	keys in other places, like the values of other fields. Raises a KeyError if a key is not found.
+
+	chunks -- iterable of the bytes of the document, e.g. the iter_content() of a streamed response
+	keys -- keys of the objects leading to the array, outermost first
+	"""
+	decoder = codecs.getincrementaldecoder('utf8')()
+	chunks = iter(chunks)
+	buffer, pos = '', 0
+
+	def more():
+		nonlocal buffer, pos
+		chunk = next(chunks, None)
+		if chunk is None:
+			return False
+		buffer = buffer[pos:] + decoder.decode(chunk)
+		pos = 0
+		return True
+
+	# Find the start of the array
+	for key in keys:
+		pattern = re.compile(r'"{}"\s*:\s*'.format(re.escape(key)))
+		while True:
+			match = pattern.search(buffer, pos)
+			# Whitespace after the colon may continue in the next chunk
+			if match and match.end() < len(buffer):
+				pos = match.end()
+				break
+			if not more():
+				if match:
+					pos = match.end()
+					break
+				raise KeyError(key)
+	while pos == len(buffer) and more():
+		pass
+	if buffer[pos:pos+1] != '[':
+		raise ValueError("json value of {} is not an array".format(keys[-1]))
+	pos += 1
+
+	# Parse the complete objects of the buffer with a single call, the last object read may still be incomplete.
+	# If the array ends in the buffer, the text after it is left out by raw_decode.
+	while True:
+		pos = _SEPARATORS.match(buffer, pos).end()
+		if buffer[pos:pos+1] == ']':
+			return
+		end = buffer.rfind('}', pos)
+		if end >= 0:
+			text = '[' + buffer[pos:end+1] + ']'
+			try:
+				elements, parsed = _decoder.raw_decode(text)
+			except ValueError:
+				# Closing brace of an object nested in an incomplete one
+				elements = None
+			if elements is not None:
+				yield elements
+				if parsed < len(text):
+					return
+				pos = end + 1
+				continue
+		if not more():
+			raise ValueError("json document ended before the end of the {} array".format(keys[-1]))
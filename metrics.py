@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import Counter
+from datetime import datetime
+
+# Data type the current day sync, thread or asyncio task is working on
+_dataType = contextvars.ContextVar('dataType', default='')
+
+
+class Metrics:
+	"""Timings and counters of a sync run, per stage and data type. Stages are timed into latency histograms:
+	fetch (a Fitbit request), convert (a day of data), filter (dropping and coalescing the converted
+	points, part of convert) and upload (a Google Fit request). Counters keep track of
+	requests, bytes, data points, retries and rate limit waits. Both are written as a Prometheus textfile, for
+	the node exporter, and as a json report, see WriteReports."""
+
+	PREFIX = 'fitbit_googlefit'
+	LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # Seconds
+	COUNTERS = {
+		'fitbit_requests': 'Fitbit API requests sent',
+		'fitbit_cache_hits': 'Fitbit API requests answered by the response cache',
+		'fitbit_retries': 'Fitbit API requests retried after a 429 or 401 response',
+		'rate_limit_wait_seconds': 'Seconds waited for the reset of the Fitbit rate limit budget',
+		'points_converted': 'Fitbit data points converted to Google Fit data points',
+		'points_filtered': 'Converted data points dropped before upload, e.g. zero values',
+		'points_uploaded': 'Data points sent to Google Fit',
+		'google_requests': 'Google Fit write requests sent, a batch request counts once',
+		'google_bytes_sent': 'Bytes of the dataset bodies sent to Google Fit',
+		'google_retries': 'Google Fit requests retried after a broken connection or a server error',
+		'uploads_skipped': 'Datasets not uploaded because the very same dataset was uploaded before',
+		'sessions_uploaded': 'Sessions sent to Google Fit',
+	}
+
+	# Profiler with Enter(stage, data type) and Exit() methods to switch to while a stage runs, see profiling.py
+	profiler = None
+
+	def __init__(self, labels=None):
+		""" Intialize the metrics of a run.
+
+		labels -- labels added to every metric, e.g. the account name
+		"""
+		self.labels = dict(labels or {})
+		self.started = time.time()
+		self._histograms = {} # (stage, data type) -> [count per bucket..., count above all buckets, sum, max]
+		self._counters = Counter() # (name, data type) -> value
+		self._lock = threading.Lock()
+
+	@staticmethod
+	@contextmanager
+	def DataType(dataType):
+		"""Attributes everything measured by the current thread or task to a data type, unless given explicitly
+
+		dataType -- fitbit data type
+		"""
+		previous = _dataType.get()
+		token = _dataType.set(dataType)
+		try:
+			yield
+		finally:
+			try:
+				_dataType.reset(token)
+			except ValueError:
+				# A coroutine closed by the garbage collector, outside of the context of its task
+				_dataType.set(previous)
+
+	@contextmanager
+	def Time(self, stage, dataType=None):
+		"""Times a block of code into the latency histogram of a stage
+
+		stage -- fetch, filter, convert or upload
+		dataType -- fitbit data type, the one the current thread or task works on if not given
+		"""
+		profiler = self.profiler
+		if profiler is not None:
+			profiler.Enter(stage, dataType or _dataType.get())
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.Observe(stage, time.perf_counter() - start, dataType)
+			if profiler is not None:
+				profiler.Exit()
+
+	def Observe(self, stage, seconds, dataType=None):
+		"""Adds a duration to the latency histogram of a stage
+
+		stage -- fetch, filter, convert or upload
+		seconds -- duration
+		dataType -- fitbit data type, the one the current thread or task works on if not given
+		"""
+		key = (stage, dataType or _dataType.get())
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = [0] * (len(self.LATENCY_BUCKETS) + 1) + [0.0, 0.0]
+			histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+			histogram[-2] += seconds
+			histogram[-1] = max(histogram[-1], seconds)
+
+	def Count(self, name, value=1, dataType=None):
+		"""Adds to a counter
+
+		name -- one of COUNTERS
+		value -- amount to add
+		dataType -- fitbit data type, the one the current thread or task works on if not given
+		"""
+		if not value:
+			return
+		with self._lock:
+			self._counters[(name, dataType or _dataType.get())] += value
+
+	def Total(self, name, dataType=None):
+		"""Returns the value of a counter, summed over all data types if none is given"""
+		with self._lock:
+			return sum(value for (counter, counterType), value in self._counters.items()
+				if counter == name and dataType in (None, counterType))
+
+	def Report(self):
+		"""Returns the metrics as a dict, for the json report"""
+		with self._lock:
+			stages = {}
+			for (stage, dataType), histogram in sorted(self._histograms.items()):
+				count = sum(histogram[:-2])
+				stages.setdefault(stage, {})[dataType or 'all'] = dict(
+					count=count, total_s=histogram[-2], mean_s=histogram[-2] / count, max_s=histogram[-1],
+					buckets={str(le): n for le, n in zip(self.LATENCY_BUCKETS + ('+Inf',), histogram[:-2])})
+			counters = {}
+			for (name, dataType), value in sorted(self._counters.items()):
+				counters.setdefault(name, {})[dataType or 'all'] = value
+		return dict(labels=self.labels, started=datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+			duration_s=time.time() - self.started, stages=stages, counters=counters)
+
+	def PrometheusSamples(self):
+		"""Returns a dict of metric name -> list of sample lines, in the Prometheus text format"""
+		def labels(**extra):
+			merged = dict(self.labels, **{name: value for name, value in extra.items() if value})
+			return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+				for name, value in merged.items()) + '}' if merged else ''
+
+		samples = {}
+		name = self.PREFIX + '_stage_seconds'
+		with self._lock:
+			for (stage, dataType), histogram in sorted(self._histograms.items()):
+				cumulative = 0
+				for le, n in zip(self.LATENCY_BUCKETS + ('+Inf',), histogram[:-2]):
+					cumulative += n
+					samples.setdefault(name, []).append('{}_bucket{} {}'.format(
+						name, labels(stage=stage, data_type=dataType, le=le), cumulative))
+				samples[name].append('{}_sum{} {}'.format(name, labels(stage=stage, data_type=dataType), histogram[-2]))
+				samples[name].append('{}_count{} {}'.format(name, labels(stage=stage, data_type=dataType), cumulative))
+			for (counter, dataType), value in sorted(self._counters.items()):
+				name = '{}_{}_total'.format(self.PREFIX, counter)
+				samples.setdefault(name, []).append('{}{} {}'.format(name, labels(data_type=dataType), value))
+		for metric, value in (('run_duration_seconds', time.time() - self.started), ('last_run_timestamp_seconds', time.time())):
+			name = '{}_{}'.format(self.PREFIX, metric)
+			samples[name] = ['{}{} {}'.format(name, labels(), value)]
+		return samples
+
+
+def _WriteAtomically(path, content):
+	"""Writes a file through a temporary file, so readers like the node exporter never see a partial file"""
+	with open(path + '.tmp', 'w') as f:
+		f.write(content)
+	os.replace(path + '.tmp', path)
+
+def WriteReports(metricsList, prometheusFile=None, reportFile=None):
+	"""Writes the metrics of one or more runs, e.g. of all accounts, to a Prometheus textfile and a json report
+
+	metricsList -- list of Metrics objects
+	prometheusFile -- Prometheus textfile to write, not written if not given
+	reportFile -- json report to write, not written if not given
+	"""
+	if prometheusFile:
+		descriptions = dict(stage_seconds=('histogram', 'Latency of the fetch, filter, convert and upload stages'),
+			run_duration_seconds=('gauge', 'Seconds since the start of the run'),
+			last_run_timestamp_seconds=('gauge', 'Time the last run finished'),
+			**{name + '_total': ('counter', description) for name, description in Metrics.COUNTERS.items()})
+		samples = {}
+		for metrics in metricsList:
+			for name, lines in metrics.PrometheusSamples().items():
+				samples.setdefault(name, []).extend(lines)
+		lines = []
+		for name, metricSamples in samples.items():
+			kind, description = descriptions[name[len(Metrics.PREFIX) + 1:]]
+			lines += ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, kind)] + metricSamples
+		_WriteAtomically(prometheusFile, '\n'.join(lines) + '\n')
+		logging.debug("Metrics written to %s", prometheusFile)
+	if reportFile:
+		reports = [metrics.Report() for metrics in metricsList]
+		_WriteAtomically(reportFile, json.dumps(reports[0] if len(reports) == 1 else reports, indent=2))
+		logging.debug("Run report written to %s", reportFile)
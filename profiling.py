@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import io
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+
+class Profiler:
+	"""CPU and memory profile of a run, split per stage and data type. Every stage timed by Metrics (fetch,
+	filter, convert and upload) is profiled by a profiler of its own, the rest of the main thread by the run
+	profiler. cProfile only profiles the thread it is enabled in, so each thread gets its own profiler per stage.
+	Stages of the asyncio engine overlap on the event loop, they are profiled as part of the run.
+
+	From Python 3.12 on, cProfile is built on sys.monitoring, which allows only one active profiler per process and
+	profiles all threads with it. There the run profiler profiles everything, and stages are only timed."""
+
+	FRAMES = 1 # Stack frames kept by tracemalloc per allocation, 1 groups allocations by line
+	PER_THREAD = sys.version_info < (3, 12) # Whether a profiler can be enabled per thread, see above
+
+	def __init__(self, top=25):
+		""" Intialize a profiler.
+
+		top -- number of functions listed per stage, and of lines listed by memory
+		"""
+		self.top = top
+		self.duration = 0
+		self._run = cProfile.Profile()
+		self._runThread = None
+		self._profiles = {} # (stage, data type, thread id) -> cProfile.Profile
+		self._memory = {} # (stage, data type) -> [entries, net bytes allocated, peak bytes above the start, seconds]
+		self._active = 0 # stages running in any thread
+		self._peak = 0
+		self._local = threading.local()
+		self._lock = threading.Lock()
+
+	def Start(self):
+		"""Starts profiling the current thread and tracing memory allocations"""
+		tracemalloc.start(self.FRAMES)
+		self._startSnapshot = tracemalloc.take_snapshot()
+		self._started = time.perf_counter()
+		self._runThread = threading.get_ident()
+		self._run.enable()
+
+	def Stop(self):
+		"""Stops profiling and tracing"""
+		self._run.disable()
+		self.duration = time.perf_counter() - self._started
+		self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+		self._endSnapshot = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+
+	def _Stack(self):
+		if not hasattr(self._local, 'stack'):
+			self._local.stack = []
+		return self._local.stack
+
+	def _Current(self, stack):
+		"""Returns the profiler that profiles the current thread outside of the topmost stage"""
+		if stack:
+			return stack[-1][0]
+		return self._run if threading.get_ident() == self._runThread else None
+
+	def Enter(self, stage, dataType):
+		"""Switches the current thread to the profiler of a stage, until Exit is called
+
+		stage -- fetch, filter, convert or upload
+		dataType -- fitbit data type
+		"""
+		stack = self._Stack()
+		try:
+			asyncio.get_running_loop()
+			stack.append((self._Current(stack), None, 0, 0))
+			return
+		except RuntimeError:
+			pass
+		current = self._Current(stack)
+		if current is not None and self.PER_THREAD:
+			current.disable()
+		key = (stage, dataType)
+		with self._lock:
+			profile = None
+			if self.PER_THREAD:
+				profile = self._profiles.get(key + (threading.get_ident(),))
+				if profile is None:
+					profile = self._profiles[key + (threading.get_ident(),)] = cProfile.Profile()
+			startBytes, peak = tracemalloc.get_traced_memory()
+			if self._active == 0:
+				# Peaks of stages running at the same time in several threads add up
+				self._peak = max(self._peak, peak)
+				tracemalloc.reset_peak()
+			self._active += 1
+		stack.append((profile, key, startBytes, time.perf_counter()))
+		if profile is not None:
+			profile.enable()
+
+	def Exit(self):
+		"""Switches the current thread back to the profiler it used before the last Enter"""
+		stack = self._Stack()
+		profile, key, startBytes, started = stack.pop()
+		if key is None:
+			return
+		if profile is not None:
+			profile.disable()
+		with self._lock:
+			current, peak = tracemalloc.get_traced_memory()
+			self._active -= 1
+			memory = self._memory.setdefault(key, [0, 0, 0, 0])
+			memory[0] += 1
+			memory[1] += current - startBytes
+			memory[2] = max(memory[2], peak - startBytes)
+			memory[3] += time.perf_counter() - started
+		previous = self._Current(stack)
+		if previous is not None and self.PER_THREAD:
+			previous.enable()
+
+	def _StageStats(self):
+		"""Returns a dict of (stage, data type) -> pstats.Stats, merged over all threads"""
+		stats = {}
+		for (stage, dataType, thread), profile in sorted(self._profiles.items()):
+			if (stage, dataType) in stats:
+				stats[(stage, dataType)].add(profile)
+			else:
+				stats[(stage, dataType)] = pstats.Stats(profile)
+		return stats
+
+	def WriteReport(self, prefix):
+		"""Writes the raw profile of the whole run to <prefix>.prof, e.g. for snakeviz or pstats, and the hotspots
+		of every stage and data type, sorted by the time spent in them, to <prefix>.txt
+
+		prefix -- path and name of both files without the extension
+		"""
+		stageStats = self._StageStats()
+		runStats = pstats.Stats(self._run)
+		for stats in stageStats.values():
+			runStats.add(stats)
+		runStats.dump_stats(prefix + '.prof')
+
+		report = io.StringIO()
+		report.write('Profile of a {:.1f} second run, peak traced memory {:.1f} MB\n\n'.format(
+			self.duration, self._peak / 2**20))
+		if not self.PER_THREAD:
+			report.write('Python {}.{} profiles all threads with a single profiler, stages are only timed\n\n'.format(
+				*sys.version_info[:2]))
+		report.write('{:<10} {:<12} {:>8} {:>10} {:>12} {:>14} {:>12}\n'.format(
+			'stage', 'data type', 'entries', 'timed s', 'profiled s', 'net alloc MB', 'peak MB'))
+		for (stage, dataType), (entries, allocated, peak, seconds) in sorted(self._memory.items(),
+				key=lambda item: -item[1][3]):
+			stats = stageStats.get((stage, dataType))
+			report.write('{:<10} {:<12} {:>8} {:>10.3f} {:>12} {:>14.1f} {:>12.1f}\n'.format(
+				stage, dataType or '-', entries, seconds, '-' if stats is None else '{:.3f}'.format(stats.total_tt),
+				allocated / 2**20, peak / 2**20))
+
+		sections = sorted(stageStats.items(), key=lambda item: -item[1].total_tt)
+
+		sections.append((('other' if self.PER_THREAD else 'run', ''), pstats.Stats(self._run)))
+		for (stage, dataType), stats in sections:
+			report.write('\n{} {} - {:.3f} s\n'.format('=' * 20, ' / '.join(filter(None, (stage, dataType))),
+				stats.total_tt))
+			stats.stream = report
+			stats.strip_dirs().sort_stats('tottime').print_stats(self.top)
+
+		report.write('\n{} memory still allocated at the end of the run, by line\n'.format('=' * 20))
+		for stat in self._endSnapshot.compare_to(self._startSnapshot, 'lineno')[:self.top]:
+			report.write('{}\n'.format(stat))
+
+		with open(prefix + '.txt', 'w') as f:
+			f.write(report.getvalue())
+		logging.debug("Profile written to %s.prof and %s.txt", prefix, prefix)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import time
+import logging
+import threading
+
+
+class RateLimitExhausted(Exception):
+	"""Raised instead of waiting when the budget of a non-blocking rate limiter is used up"""
+
+	def __init__(self, seconds):
+		super().__init__("Fitbit rate limit budget used up for {:.0f} seconds".format(seconds))
+		self.seconds = seconds
+
+
+class RateLimiter:
+	"""A token bucket that tracks the Fitbit API request budget of a user. The bucket is kept in sync with
+	Fitbit's Fitbit-Rate-Limit-* response headers and requests wait for the hourly reset once it is empty,
+	instead of running into a 429 response."""
+
+	def __init__(self, limit=150, reserve=0, margin=5, notify=None, block=True):
+		""" Intialize a rate limiter.
+
+		limit -- requests per window, until the first response tells otherwise
+		reserve -- number of requests to always keep unused
+		margin -- seconds to wait in addition to the announced reset time
+		notify -- called with the number of seconds before waiting for a reset
+		block -- wait for the reset once the budget is used up, otherwise raise RateLimitExhausted
+		"""
+		self.limit = limit
+		self.reserve = reserve
+		self.margin = margin
+		self.notify = notify
+		self.block = block
+		self.tokens = limit
+		self.resetAt = None
+		self.sleptSeconds = 0
+		self._lock = threading.Lock()
+
+	def Update(self, headers):
+		"""Updates the budget from the rate limit headers of a Fitbit response
+
+		headers -- response headers
+		"""
+		try:
+			limit = int(headers['Fitbit-Rate-Limit-Limit'])
+			remaining = int(headers['Fitbit-Rate-Limit-Remaining'])
+			reset = int(headers['Fitbit-Rate-Limit-Reset'])
+		except (KeyError, ValueError):
+			return
+		with self._lock:
+			now = time.monotonic()
+			if self.resetAt is None or now >= self.resetAt:
+				self.tokens = remaining
+			else:
+				# Responses of requests sent in parallel may arrive out of order, trust the lowest count
+				self.tokens = min(self.tokens, remaining)
+			self.limit = limit
+			self.resetAt = now + reset
+
+	def Exhaust(self, retry_after_secs):
+		"""Marks the budget as used up, e.g. after an unexpected 429 response
+
+		retry_after_secs -- seconds until the budget is reset
+		"""
+		with self._lock:
+			self.tokens = 0
+			self.resetAt = time.monotonic() + retry_after_secs
+
+	def Remaining(self):
+		"""Returns the number of requests that can still be made in the current window"""
+		with self._lock:
+			if self.resetAt is not None and time.monotonic() >= self.resetAt:
+				return self.limit
+			return self.tokens
+
+	def SecondsUntilReset(self):
+		"""Returns the number of seconds until the budget is reset, if known"""
+		with self._lock:
+			if self.resetAt is None:
+				return None
+			return max(0, self.resetAt - time.monotonic())
+
+	def Reserve(self):
+		"""Takes a request from the budget if there is one left, without waiting. Returns 0 if a request was taken,
+		otherwise the number of seconds to wait before trying again."""
+		with self._lock:
+			now = time.monotonic()
+			if self.resetAt is not None and now >= self.resetAt:
+				# A new window has started, the next response will tell the exact budget
+				self.tokens, self.resetAt = self.limit, None
+			# Without any rate limit headers seen yet, there is nothing to wait for
+			if self.tokens > self.reserve or self.resetAt is None:
+				self.tokens -= 1
+				return 0
+			return self.resetAt - now + self.margin
+
+	def Waiting(self, seconds):
+		"""Reports and accounts a wait for the reset of the budget
+
+		seconds -- number of seconds that will be waited
+		"""
+		logging.info("Fitbit rate limit budget used up, waiting %d seconds", seconds)
+		if self.notify:
+			self.notify(seconds)
+		with self._lock:
+			self.sleptSeconds += seconds
+
+	def Acquire(self):
+		"""Takes a request from the budget, waiting for the reset if there is none left.
+		Returns the number of seconds waited."""
+		waited = 0
+		while True:
+			seconds = self.Reserve()
+			if seconds == 0:
+				return waited
+			if not self.block:
+				raise RateLimitExhausted(seconds)
+			self.Waiting(seconds)
+			time.sleep(seconds)
+			waited += seconds
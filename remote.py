@@ -4,45 +4,141 @@ __author__ = "Praveen Kumar Pendyala"
 __email__ = "mail@pkp.io"
 """
 import time
-import argparse
 import logging
 import dateutil.tz
 import dateutil.parser
-import configparser
 import json
+import queue
+import hashlib
+import itertools
+import threading
+import numpy as np
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import timedelta, date, datetime
 
-import fitbit
 from fitbit.exceptions import HTTPTooManyRequests
-from apiclient.discovery import build
-from oauth2client.file import Storage
-from oauth2client.client import OAuth2Credentials
 from googleapiclient.errors import HttpError
 
-from random import randint
+
+from datasets import IntradayDataset, CoalesceSegments
+from jsonstream import StreamJsonArray
+from ratelimit import RateLimiter
+from metrics import Metrics
 
 DATE_FORMAT = "%Y-%m-%d"
 
 class Remote:
 	"""Methods for remote api calls and synchronization from Fitbit to Google Fit"""
 	
-	FITBIT_API_URL = 'https://api.fitbit.com/1'
+	FITBIT_IMMUTABLE_AFTER_DAYS = 2 # Fitbit data of days this old is not expected to change anymore
+	FITBIT_CACHE_TTL_SECS = 600 # How long responses of more recent days are cached
+	FITBIT_MAX_BODY_LOG_RANGE_DAYS = 31 # Max number of days of weight and body fat logs in a single request
+	FITBIT_MAX_SLEEP_RANGE_DAYS = 100 # Max number of days of sleep logs in a single request
+	FITBIT_MAX_DAILY_RANGE_DAYS = 365 # Max number of days of daily totals in a single time series request
+	FITBIT_MAX_ACTIVITIES_PER_PAGE = 100 # Max number of activities returned by a single activities list request
+	FITBIT_STREAM_CHUNK_BYTES = 64*1024 # Size of the chunks intraday responses are read and parsed in
+	HEART_RATE_DETAIL_NANOS = {'1sec': 10**9, '1min': 60*10**9, '5min': 300*10**9} # Supported heart rate detail levels
 	GFIT_MAX_POINTS_PER_UPDATE = 8000 # Max number of data points that can be sent in a single update request
+	GFIT_MAX_BYTES_PER_UPDATE = 4*1024*1024 # Max size of the body of a single update request
+	GFIT_MAX_SESSIONS_PER_BATCH = 50 # Max number of session updates sent in a single batch request
+	GFIT_SESSION_RETRIES = 3 # Number of times failed session updates of a batch are retried
+	GFIT_SESSION_RETRY_SECS = 2 # Wait before the first retry of failed session updates, doubled for every retry
+	GFIT_SLEEP_ACTIVITY_TYPE = 72 # Activity type of sleep sessions, all other sessions are Fitbit activities
+	PIPELINE_QUEUE_DAYS = 4 # Max number of days waiting between two stages of the sync pipeline
+	PIPELINE_POLL_SECS = 0.5 # How often a blocked pipeline stage checks whether the sync was stopped
 
-	def __init__(self, fitbitClient, googleClient, convertor, helper, tzinfo):
+	def __init__(self, fitbitClient, googleClient, convertor, helper, tzinfo, syncState=None, responseCache=None,
+			batchUploads=False, fetchLogRanges=False, heartRateDetail='1sec', coalescePoints=False,
+			streamIntraday=False):
 		""" Intialize a remote object.
 		
-		fitbitClient -- authenticated fitbit client
+		fitbitClient -- authenticated fitbit client, None if data is only imported from an archive
 		googleClient -- authenticated google client
 		convertor -- a convertor object for type conversions
 		helper -- a helper object for fitbit credentials update
 		tzinfo -- Timezone information of the Fitbit user
+		syncState -- optional sync state store to skip days that were already synced
+		responseCache -- optional cache of Fitbit responses
+		batchUploads -- merge the data points of consecutive days into a single upload per data source
+		fetchLogRanges -- fetch weight, body fat and sleep logs of many days with a single request
+		heartRateDetail -- detail level of heart rate data, one of HEART_RATE_DETAIL_NANOS
+		coalescePoints -- merge runs of adjacent steps, distance, calories and sleep points with the same value
+			before upload
+		streamIntraday -- parse intraday responses into columns while they are read, see ReadFitbitIntradayDay
 		"""
 		self.fitbitClient = fitbitClient
-		self.googleClient = googleClient
 		self.convertor = convertor
 		self.helper = helper
 		self.tzinfo = tzinfo
+		self.syncState = syncState
+		self.responseCache = responseCache
+
+		# Number of google fit dataset uploads sent and skipped as unchanged during this run
+		self.uploadStats = Counter()
+		self._statsLock = threading.Lock()
+
+		# Timings and counters of the run, per stage and data type
+		self.metrics = Metrics()
+		self._sourceDataTypes = {}
+
+		# Data points waiting to be uploaded, per data source
+		self.batchUploads = batchUploads
+		self._uploadQueues = {}
+		self._writingQueues = {} # Queues taken by FlushToGoogleFit that are still being written, per data source
+		self._flushLocks = defaultdict(threading.Lock)
+		self._sessionQueue = []
+		self._writtenSessions = set() # Ids of the sessions written to google fit during this run
+		self._pendingSessions = set() # Ids of the sessions queued or being written by FlushSessionsToGoogleFit
+		self._sessionCallbacks = [] # (session ids, function) waiting for pending sessions, see AfterSessionsWritten
+		self._queueLock = threading.Lock()
+
+		# Logs fetched ahead with range requests, per (data type, day)
+		self.fetchLogRanges = fetchLogRanges
+		self._prefetchedLogs = {}
+
+		if heartRateDetail not in self.HEART_RATE_DETAIL_NANOS:
+			raise ValueError("Unexpected heart rate detail level given!")
+		self.heartRateDetail = heartRateDetail
+
+		# Number of points before and after coalescing, per data type
+		self.coalescePoints = coalescePoints
+		self.coalesceStats = defaultdict(lambda: [0, 0])
+
+		self.streamIntraday = streamIntraday
+
+		# Keep track of the Fitbit request budget from the rate limit headers of every response
+		self.rateLimiter = RateLimiter(notify=self._PrintRateLimitWait)
+		if fitbitClient is not None:
+			fitbitClient.client.session.hooks['response'].append(
+				lambda response, *args, **kwargs: self.rateLimiter.Update(response.headers))
+
+		# httplib2 connections are not thread-safe, so each thread gets its own google client
+		self._local = threading.local()
+		self.googleClient = googleClient
+
+	@staticmethod
+	def FromConfig(params, fitbitClient, googleClient, convertor, helper, syncState=None, responseCache=None):
+		"""Returns a remote object with the options of the [params] section of config.ini
+
+		params -- the [params] section of config.ini
+		"""
+		return Remote(fitbitClient, googleClient, convertor, helper, None, syncState, responseCache,
+			params.getboolean('batch_uploads', True), params.getboolean('fetch_log_ranges', True),
+			params.get('heart_rate_detail', '1sec'), params.getboolean('coalesce_points', False),
+			params.getboolean('stream_intraday', True))
+
+	@property
+	def googleClient(self):
+		"""Google client of the current thread, created on first use"""
+		if getattr(self._local, 'googleClient', None) is None:
+			self._local.googleClient = self.helper.GetGoogleClient()
+		return self._local.googleClient
+
+	@googleClient.setter
+	def googleClient(self, client):
+		self._local.googleClient = client
 
 	def UpdateTimezone(self, tzinfo):
 		"""Update user's timezone info"""
@@ -51,75 +147,425 @@ class Remote:
 	########################### Remote data read/write methods ############################
 
 	def ReadFromFitbit(self, api_call, *args, **kwargs):
-		"""Peforms a read request from Fitbit API. The request will be paused if API rate limiting has 
-		been reached!
+		"""Peforms a read request from Fitbit API. The request will be paused if the API rate limit budget
+		has been used up!
 
 		api_call -- api method to call
 		args -- arguments to pass for the method
 		"""
-		# res_url,date_stamp,detail_level
-		try:
-		 	resp = api_call(*args,**kwargs)
-		except HTTPTooManyRequests as e:
-			# retry between 5-10 minutes after the hour
-			seconds_till_retry = e.retry_after_secs + randint(300,600)
-			print('')
-			print('-------------------- Fitbit API rate limit reached -------------------')
-			retry_time = datetime.now()+timedelta(seconds=seconds_till_retry)
-			print('Will retry at {}'.format(retry_time.strftime('%H:%M:%S')))
-			print('')
-			time.sleep(seconds_till_retry)
-			resp = self.ReadFromFitbit(api_call,*args,**kwargs)
+		while True:
+			self.metrics.Count('rate_limit_wait_seconds', self.rateLimiter.Acquire())
+			self.helper.RefreshFitbitToken(self.fitbitClient)
+			self.metrics.Count('fitbit_requests')
+			try:
+				with self.metrics.Time('fetch'):
+					return api_call(*args,**kwargs)
+			except HTTPTooManyRequests as e:
+				# Budget was used up elsewhere, e.g. by another app of the same user
+				self.metrics.Count('fitbit_retries')
+				self.rateLimiter.Exhaust(e.retry_after_secs)
+
+	def ReadFromFitbitCached(self, date_stamp, api_call, *args, **kwargs):
+		"""Peforms a read request from Fitbit API, unless the response cache has it. Responses of days older than
+		FITBIT_IMMUTABLE_AFTER_DAYS are cached for good, others for FITBIT_CACHE_TTL_SECS.
+
+		date_stamp -- timestamp in yyyy-mm-dd format of the last day the request covers
+		api_call -- api method to call
+		args -- arguments to pass for the method
+		"""
+		if self.responseCache is None:
+			return self.ReadFromFitbit(api_call, *args, **kwargs)
+
+		key = self.responseCache.Key(api_call.__name__, *args, **kwargs)
+		resp = self.responseCache.Get(key, self.FitbitCacheMaxAge(date_stamp))
+		if resp is None:
+			resp = self.ReadFromFitbit(api_call, *args, **kwargs)
+			self.responseCache.Put(key, resp)
+		else:
+			self.metrics.Count('fitbit_cache_hits')
 		return resp
 
-	def WriteToGoogleFit(self, dataSourceId, data_points):
+	def FitbitCacheMaxAge(self, date_stamp):
+		"""Returns how long a response covering days up to a given day may be cached, None if for good
+
+		date_stamp -- timestamp in yyyy-mm-dd format of the last day the request covers
+		"""
+		age = (datetime.now(self.tzinfo).date() - datetime.strptime(date_stamp, DATE_FORMAT).date()).days
+		return None if age >= self.FITBIT_IMMUTABLE_AFTER_DAYS else self.FITBIT_CACHE_TTL_SECS
+
+	def RemainingFitbitRequests(self):
+		"""Returns the number of Fitbit requests left before the rate limit is reached"""
+		return self.rateLimiter.Remaining()
+
+	def _PrintRateLimitWait(self, seconds_till_retry):
+		print('')
+		print('-------------------- Fitbit API rate limit reached -------------------')
+		retry_time = datetime.now()+timedelta(seconds=seconds_till_retry)
+		print('Will retry at {}'.format(retry_time.strftime('%H:%M:%S')))
+		print('')
+
+	def DatasetRequests(self, dataSourceId, data_points):
+		"""Returns a generator of (datasetId, body, fingerprint, size) tuples of the update requests needed to write
+		data points to google fit, size being the number of bytes of the serialised body. Data points are split over
+		requests of less than GFIT_MAX_POINTS_PER_UPDATE points and GFIT_MAX_BYTES_PER_UPDATE bytes.
+
+		dataSourceId -- data source id for google fit
+		data_point -- google data points, as a list or an IntradayDataset
+		"""
+		# Ranges of points still to be sent, the next one last. Ranges are halved until they fit in a request,
+		# only the body of the current range is built at any time.
+		ranges = [(0, len(data_points))] if len(data_points) > 0 else []
+		while ranges:
+			start, end = ranges.pop()
+			half = start + int((end - start)/2)
+			if end - start >= self.GFIT_MAX_POINTS_PER_UPDATE:
+				ranges += [(half, end), (start, half)]
+				continue
+			points = data_points[start:end]
+
+			# max and min timestamps of any data point we will be adding to googlefit - required by gfit API.
+			if isinstance(points, IntradayDataset):
+				minLogNs,maxLogNs = points.MinStartTimeNanos(),points.MaxEndTimeNanos()
+			else:
+				minLogNs = min(point['startTimeNanos'] for point in points)
+				maxLogNs = max(point['endTimeNanos'] for point in points)
+			datasetId = '%s-%s' % (minLogNs, maxLogNs)
+			body = dict(
+				dataSourceId=dataSourceId,
+				maxEndTimeNs=maxLogNs,
+				minStartTimeNs=minLogNs,
+				point=points.Points() if isinstance(points, IntradayDataset) else points)
+
+			serialized = json.dumps(body, sort_keys=True)
+			if len(serialized) > self.GFIT_MAX_BYTES_PER_UPDATE and end - start > 1:
+				ranges += [(half, end), (start, half)]
+				continue
+			yield datasetId, body, hashlib.sha256(serialized.encode('utf8')).hexdigest(), len(serialized)
+
+	def IsUploaded(self, dataSourceId, datasetId, fingerprint):
+		"""Returns True, and counts the upload as skipped, if the very same dataset has been uploaded before
+
+		dataSourceId -- data source id for google fit
+		datasetId -- dataset id for google fit
+		fingerprint -- hash of the dataset
+		"""
+		if self.syncState is not None and self.syncState.UploadFingerprint(dataSourceId, datasetId) == fingerprint:
+			self._CountUpload('skipped')
+			self.metrics.Count('uploads_skipped', dataType=self.DataTypeOfSource(dataSourceId))
+			return True
+		return False
+
+	def RecordUpload(self, dataSourceId, datasetId, fingerprint):
+		"""Counts an upload as sent and records its fingerprint
+
+		dataSourceId -- data source id for google fit
+		datasetId -- dataset id for google fit
+		fingerprint -- hash of the dataset
+		"""
+		self._CountUpload('sent')
+		if self.syncState is not None:
+			self.syncState.RecordUpload(dataSourceId, datasetId, fingerprint)
+
+	def WriteToGoogleFit(self, dataSourceId, data_points, skipUploaded=True):
 		"""Write data to google fit
 
 		dataSourceId -- data source id for google fit
-		data_point -- google data points
+		data_point -- google data points, as a list or an IntradayDataset
+		skipUploaded -- skip requests identical to an earlier upload, and record the fingerprints of the others
 		"""
-		# max and min timestamps of any data point we will be adding to googlefit - required by gfit API.
-		if len(data_points) == 0:
-			return
+		dataType = self.DataTypeOfSource(dataSourceId)
+		for datasetId, body, fingerprint, size in self.DatasetRequests(dataSourceId, data_points):
+			if skipUploaded and self.IsUploaded(dataSourceId, datasetId, fingerprint):
+				continue
+			with self.metrics.Time('upload', dataType):
+				self._PatchDataset(dataSourceId, datasetId, body)
+			self.CountUploaded(dataType, len(body['point']), size)
+			if skipUploaded:
+				self.RecordUpload(dataSourceId, datasetId, fingerprint)
+			else:
+				self._CountUpload('sent')
+
+	def DatasetFingerprint(self, data_points):
+		"""Returns the datasetId and a hash of a list of data points or an IntradayDataset, e.g. those of a day
+
+		data_points -- google data points, as a list or an IntradayDataset
+		"""
+		if isinstance(data_points, IntradayDataset):
+			return '%s-%s' % (data_points.MinStartTimeNanos(), data_points.MaxEndTimeNanos()), data_points.Fingerprint()
 		minLogNs = min(point['startTimeNanos'] for point in data_points)
 		maxLogNs = max(point['endTimeNanos'] for point in data_points)
-		datasetId = '%s-%s' % (minLogNs, maxLogNs)
+		serialized = json.dumps(data_points, sort_keys=True)
+		return '%s-%s' % (minLogNs, maxLogNs), hashlib.sha256(serialized.encode('utf8')).hexdigest()
 
-		if len(data_points) < self.GFIT_MAX_POINTS_PER_UPDATE:
-			try:
-				self.googleClient.users().dataSources().datasets().patch(
-					userId='me',
-					dataSourceId=dataSourceId,
-					datasetId=datasetId,
-					body=dict(
-						dataSourceId=dataSourceId,
-						maxEndTimeNs=maxLogNs,
-						minStartTimeNs=minLogNs,
-						point=data_points)
-					).execute()
-			except BrokenPipeError as e:
-				# Re-create the googleClient since the last one is broken
-				self.googleClient = self.helper.GetGoogleClient()
-				self.WriteToGoogleFit(dataSourceId, data_points)
+	def _PatchDataset(self, dataSourceId, datasetId, body):
+		try:
+			self.googleClient.users().dataSources().datasets().patch(
+				userId='me',
+				dataSourceId=dataSourceId,
+				datasetId=datasetId,
+				body=body
+				).execute()
+		except (BrokenPipeError, ConnectionResetError) as e:
+			# Re-create the googleClient since the last one is broken
+			self.metrics.Count('google_retries', dataType=self.DataTypeOfSource(dataSourceId))
+			self.googleClient = self.helper.GetGoogleClient()
+			self._PatchDataset(dataSourceId, datasetId, body)
+
+	def CountUploaded(self, dataType, points, size):
+		"""Counts a dataset update request sent to google fit
+
+		dataType -- fitbit data type of the dataset
+		points -- number of data points of the request
+		size -- number of bytes of the request body
+		"""
+		self.metrics.Count('google_requests', dataType=dataType)
+		self.metrics.Count('points_uploaded', points, dataType)
+		self.metrics.Count('google_bytes_sent', size, dataType)
+
+	def DataTypeOfSource(self, dataSourceId):
+		"""Returns the fitbit data type that is written to a google fit data source
+
+		dataSourceId -- data source id for google fit
+		"""
+		if dataSourceId not in self._sourceDataTypes:
+			self._sourceDataTypes.update({self.convertor.GetDataSourceId(dataType): dataType for dataType in
+				('steps','distance','heart_rate','calories','weight','body_fat','sleep','activity') +
+				tuple(self.convertor.DailyDataType(dataType) for dataType in self.convertor.DAILY_TYPES)})
+		return self._sourceDataTypes.get(dataSourceId, '')
+
+	def SessionDataType(self, session_data):
+		"""Returns the fitbit data type of a google fit session, sleep or activity
+
+		session_data -- a session data
+		"""
+		return 'sleep' if session_data['activityType'] == self.GFIT_SLEEP_ACTIVITY_TYPE else 'activity'
+
+	def QueueToGoogleFit(self, dataSourceId, data_points):
+		"""Queue data to be written to google fit together with data of other days. The queue of a data source
+		is written once it reaches GFIT_MAX_POINTS_PER_UPDATE points or GFIT_MAX_BYTES_PER_UPDATE bytes, or when
+		it is flushed. Without batchUploads, data is written right away.
+
+		Which days end up in the same request depends on when the queue fills up, so uploads are fingerprinted per
+		queued chunk, e.g. the points of a day, rather than per request. Chunks identical to an earlier upload are
+		not queued at all.
+
+		dataSourceId -- data source id for google fit
+		data_point -- google data points, as a list or an IntradayDataset
+		"""
+		if not self.batchUploads:
+			return self.WriteToGoogleFit(dataSourceId, data_points)
+		if len(data_points) == 0:
+			return
+		datasetId, fingerprint = self.DatasetFingerprint(data_points)
+		if self.IsUploaded(dataSourceId, datasetId, fingerprint):
+			return
+
+		# Rough size estimate, the exact size is only known once the request body is serialised
+		first = data_points[:1].Points()[0] if isinstance(data_points, IntradayDataset) else data_points[0]
+		size = len(json.dumps(first)) * len(data_points)
+		with self._queueLock:
+			queue = self._uploadQueues.setdefault(dataSourceId,
+				dict(chunks=[], fingerprints=[], points=0, bytes=0, callbacks=[]))
+			queue['chunks'].append(data_points)
+			queue['fingerprints'].append((datasetId, fingerprint))
+			queue['points'] += len(data_points)
+			queue['bytes'] += size
+			full = queue['points'] >= self.GFIT_MAX_POINTS_PER_UPDATE or queue['bytes'] >= self.GFIT_MAX_BYTES_PER_UPDATE
+		if full:
+			self.FlushToGoogleFit(dataSourceId)
+
+	def AfterUploaded(self, dataSourceId, callback):
+		"""Calls a function once all data queued so far for a data source has been written to google fit. The
+		function is not called if writing the data fails.
+
+		dataSourceId -- data source id for google fit
+		callback -- function to call
+		"""
+		with self._queueLock:
+			# Data queued before may still be waiting, or be written by a flush in another thread right now
+			queue = self._uploadQueues.get(dataSourceId)
+			if queue is None or not queue['chunks']:
+				queue = self._writingQueues.get(dataSourceId)
+			if queue is not None:
+				queue['callbacks'].append(callback)
+				return
+		callback()
+
+	def FlushToGoogleFit(self, dataSourceId=None):
+		"""Write all queued data to google fit
+
+		dataSourceId -- data source to write the queued data of, all of them if not given
+		"""
+		# Sessions go first, so the callbacks of the data below are only called once everything is written
+		self.FlushSessionsToGoogleFit()
+
+		with self._queueLock:
+			dataSourceIds = [dataSourceId] if dataSourceId else list(self._uploadQueues)
+			flushLocks = [(dataSourceId, self._flushLocks[dataSourceId]) for dataSourceId in dataSourceIds]
+
+		for dataSourceId, flushLock in flushLocks:
+			# One flush per data source at a time, so that a queue being written is always the one in _writingQueues
+			with flushLock:
+				with self._queueLock:
+					queue = self._uploadQueues.pop(dataSourceId, None)
+					if queue is None:
+						continue
+					self._writingQueues[dataSourceId] = queue
+				try:
+					self._WriteQueue(dataSourceId, queue)
+				finally:
+					# Callbacks may still be added while the queue is written, they are taken together with it
+					with self._queueLock:
+						del self._writingQueues[dataSourceId]
+				for callback in queue['callbacks']:
+					callback()
+
+	def _WriteQueue(self, dataSourceId, queue):
+		chunks = queue['chunks']
+		if all(isinstance(chunk, IntradayDataset) for chunk in chunks):
+			data_points = IntradayDataset.Concatenate(chunks)
 		else:
-			half = int(len(data_points)/2)
-			self.WriteToGoogleFit(dataSourceId, data_points[:half])
-			self.WriteToGoogleFit(dataSourceId, data_points[half:])
+			data_points = [point for chunk in chunks
+				for point in (chunk.Points() if isinstance(chunk, IntradayDataset) else chunk)]
+		self.WriteToGoogleFit(dataSourceId, data_points, skipUploaded=False)
+		if self.syncState is not None:
+			for datasetId, fingerprint in queue['fingerprints']:
+				self.syncState.RecordUpload(dataSourceId, datasetId, fingerprint)
+
+	def _CountUpload(self, outcome):
+		with self._statsLock:
+			self.uploadStats[outcome] += 1
+
+	def _CountCoalesced(self, dataType, before, after):
+		with self._statsLock:
+			self.coalesceStats[dataType][0] += before
+			self.coalesceStats[dataType][1] += after
 
 	def WriteSessionToGoogleFit(self, session_data):
 		"""Write data to google fit
 
 		session_data -- a session data
 		"""
+		dataType = self.SessionDataType(session_data)
 		try:
-			self.googleClient.users().sessions().update(
+			with self.metrics.Time('upload', dataType):
+				self.googleClient.users().sessions().update(
+					userId='me',
+					sessionId=session_data['id'],
+					body=session_data).execute()
+		except (BrokenPipeError, ConnectionResetError) as e:
+			# Re-create the googleClient since the last one is broken
+			self.metrics.Count('google_retries', dataType=dataType)
+			self.googleClient = self.helper.GetGoogleClient()
+			return self.WriteSessionToGoogleFit(session_data)
+		self.metrics.Count('google_requests', dataType=dataType)
+		self.metrics.Count('sessions_uploaded', dataType=dataType)
+		with self._queueLock:
+			self._writtenSessions.add(session_data['id'])
+
+	def QueueSessionToGoogleFit(self, session_data):
+		"""Queue a session to be written to google fit in a batch request with other sessions. The queue is written
+		once it reaches GFIT_MAX_SESSIONS_PER_BATCH sessions, or when it is flushed. Without batchUploads, the
+		session is written right away.
+
+		session_data -- a session data
+		"""
+		if not self.batchUploads:
+			return self.WriteSessionToGoogleFit(session_data)
+		with self._queueLock:
+			self._sessionQueue.append(session_data)
+			self._pendingSessions.add(session_data['id'])
+			full = len(self._sessionQueue) >= self.GFIT_MAX_SESSIONS_PER_BATCH
+		if full:
+			self.FlushSessionsToGoogleFit()
+
+	def FlushSessionsToGoogleFit(self):
+		"""Write all queued sessions to google fit with batch requests. Sessions that fail are retried up to
+		GFIT_SESSION_RETRIES times, after a growing wait. Returns a dict of the session ids that could not be written
+		and their errors. Days with such sessions are not marked as synced, see AfterSessionsWritten.
+		"""
+		with self._queueLock:
+			sessions,self._sessionQueue = self._sessionQueue,[]
+		sessionIds = set(session_data['id'] for session_data in sessions)
+
+		failures = {}
+		for attempt in range(self.GFIT_SESSION_RETRIES + 1):
+			if not sessions:
+				break
+			if attempt > 0:
+				# Failures are mostly rate limits and server errors, retrying right away would fail the same way
+				time.sleep(self.GFIT_SESSION_RETRY_SECS * 2**(attempt - 1))
+				for session_data in sessions:
+					self.metrics.Count('google_retries', dataType=self.SessionDataType(session_data))
+			failures = {}
+			for i in range(0, len(sessions), self.GFIT_MAX_SESSIONS_PER_BATCH):
+				failures.update(self._WriteSessionBatch(sessions[i:i+self.GFIT_MAX_SESSIONS_PER_BATCH]))
+			sessions = [session_data for session_data in sessions if session_data['id'] in failures]
+
+		for sessionId, error in failures.items():
+			print('Failed to write session {} - {}'.format(sessionId, error))
+
+		with self._queueLock:
+			self._pendingSessions -= sessionIds
+			ready = [entry for entry in self._sessionCallbacks if not entry[0] & self._pendingSessions]
+			self._sessionCallbacks = [entry for entry in self._sessionCallbacks if entry[0] & self._pendingSessions]
+		for ids, callback in ready:
+			if self._AllSessionsWritten(ids):
+				callback()
+		return failures
+
+	def _WriteSessionBatch(self, sessions):
+		"""Write sessions to google fit with a single batch request. Returns a dict of the failed session ids
+		and their errors."""
+		failures = {}
+		def callback(request_id, response, exception):
+			if exception is not None:
+				failures[request_id] = exception
+
+		batch = self.googleClient.new_batch_http_request(callback=callback)
+		for session_data in sessions:
+			batch.add(self.googleClient.users().sessions().update(
 				userId='me',
 				sessionId=session_data['id'],
-				body=session_data).execute()
-		except BrokenPipeError as e:
+				body=session_data), request_id=session_data['id'])
+		# A batch is attributed to a data type only if all of its sessions are of that type
+		dataTypes = set(self.SessionDataType(session_data) for session_data in sessions)
+		batchDataType = dataTypes.pop() if len(dataTypes) == 1 else ''
+		try:
+			with self.metrics.Time('upload', batchDataType):
+				batch.execute()
+		except (BrokenPipeError, ConnectionResetError) as e:
 			# Re-create the googleClient since the last one is broken
+			self.metrics.Count('google_retries', dataType=batchDataType)
 			self.googleClient = self.helper.GetGoogleClient()
-			self.WriteSessionToGoogleFit(session_data)
+			return self._WriteSessionBatch(sessions)
+		self.metrics.Count('google_requests', dataType=batchDataType)
+		for session_data in sessions:
+			if session_data['id'] not in failures:
+				self.metrics.Count('sessions_uploaded', dataType=self.SessionDataType(session_data))
+		with self._queueLock:
+			self._writtenSessions.update(session_data['id'] for session_data in sessions
+				if session_data['id'] not in failures)
+		return failures
+
+	def AfterSessionsWritten(self, sessions, callback):
+		"""Calls a function once the given sessions have been written to google fit. The function is not called
+		if any of them could not be written.
+
+		sessions -- google sessions
+		callback -- function to call
+		"""
+		ids = set(session_data['id'] for session_data in sessions)
+		with self._queueLock:
+			if ids & self._pendingSessions:
+				self._sessionCallbacks.append((ids, callback))
+				return
+		if self._AllSessionsWritten(ids):
+			callback()
+
+	def _AllSessionsWritten(self, ids):
+		with self._queueLock:
+			return ids <= self._writtenSessions
 
 
 	def CreateGoogleFitDataSource(self, dataType):
@@ -138,109 +584,475 @@ class Remote:
 
 	########################################### Sync methods ########################################
 
+	def SyncFitbitDaysToGoogleFit(self, dataTypes, date_stamps, workers=1, force=False):
+		"""
+		Sync Fitbit data of the given types to Google fit for a list of days. Returns a generator of
+		(date_stamp, summaries) tuples in the order of the given days and types, irrespective of the number of workers.
+		Days are read from date_stamps as the sync goes, and only a few days are held in memory at any time, so
+		the memory used does not grow with the number of days.
+
+		With a single worker, days go through a pipeline of a fetch, a convert and an upload stage, each in its own
+		thread, so that the next days are fetched while a day is uploaded. With more workers, that many (day, data
+		type) jobs are run in parallel.
+
+		dataTypes -- fitbit data types to sync
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to sync, a list or any other iterable
+		workers -- number of (day, data type) jobs to run in parallel
+		force -- sync days again even if the sync state says they are final
+		"""
+		days = self._PrefetchedDays(dataTypes, date_stamps,
+			lambda dataType, date_stamp: self.NeedsSync(dataType, date_stamp, force))
+		if workers <= 1:
+			yield from self._SyncPipelined(dataTypes, days, force)
+		else:
+			sync = lambda dataType, date_stamp: self.SyncFitbitDayToGoogleFit(dataType, date_stamp, force)
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				# Days are submitted as results are taken, so that at most workers days are in flight
+				jobs = deque()
+				for date_stamp in days:
+					jobs.append((date_stamp, [executor.submit(sync, dataType, date_stamp) for dataType in dataTypes]))
+					if len(jobs) == workers:
+						date_stamp, futures = jobs.popleft()
+						yield date_stamp, [future.result() for future in futures]
+				for date_stamp, futures in jobs:
+					yield date_stamp, [future.result() for future in futures]
+
+		# Write whatever is still queued
+		self.FlushToGoogleFit()
+
+	def _PrefetchedDays(self, dataTypes, date_stamps, needed):
+		"""Returns a generator of the given days. With fetchLogRanges, the logs of the days for which
+		needed(dataType, date_stamp) is true are fetched ahead FITBIT_MAX_SLEEP_RANGE_DAYS days at a time, just before
+		the first of these days is synced."""
+		date_stamps = iter(date_stamps)
+		while True:
+			chunk = list(itertools.islice(date_stamps, self.FITBIT_MAX_SLEEP_RANGE_DAYS))
+			if not chunk:
+				return
+			if self.fetchLogRanges:
+				for dataType in dataTypes:
+					self.PrefetchFitbitLogs(dataType, [date_stamp for date_stamp in chunk
+						if needed(dataType, date_stamp)])
+			yield from chunk
+
+	def _SyncPipelined(self, dataTypes, date_stamps, force):
+		"""Generator behind SyncFitbitDaysToGoogleFit with a single worker. The fetch and convert stages run in
+		threads of their own and pass days on through queues of at most PIPELINE_QUEUE_DAYS days; uploads are done
+		by the thread that consumes the generator. Errors of a stage are raised once the days before are yielded."""
+		stop = threading.Event()
+		fetched,converted = queue.Queue(self.PIPELINE_QUEUE_DAYS),queue.Queue(self.PIPELINE_QUEUE_DAYS)
+
+		def fetch():
+			for date_stamp in date_stamps:
+				yield date_stamp, [(dataType, self.FetchFitbitDay(dataType, date_stamp)
+					if self.NeedsSync(dataType, date_stamp, force) else None) for dataType in dataTypes]
+
+		def convert():
+			for date_stamp, day in self._PipelineItems(fetched, stop):
+				yield date_stamp, [(dataType, None if records is None else
+					self.ConvertFitbitDay(dataType, date_stamp, records)) for dataType, records in day]
+
+		stages = [threading.Thread(target=self._PipelineStage, args=(stage(), output, stop), daemon=True)
+			for stage, output in ((fetch, fetched), (convert, converted))]
+		for stage in stages:
+			stage.start()
+		try:
+			for date_stamp, day in self._PipelineItems(converted, stop):
+				summaries = []
+				for dataType, result in day:
+					if result is None:
+						summaries.append("skipped {} - already synced".format(dataType))
+						continue
+					dataSourceId,pointSets,sessions,summary = result
+					self.UploadGoogleFitDay(dataType, pointSets, sessions)
+					self.AfterSynced(dataType, date_stamp, sessions)
+					summaries.append(summary)
+				yield date_stamp, summaries
+		finally:
+			# Stages still running stop at their next queue operation
+			stop.set()
+
+	def _PipelineStage(self, items, output, stop):
+		"""Puts the items of a generator into the queue of the next pipeline stage, followed by None, or by the
+		exception that stopped the generator"""
+		try:
+			for item in items:
+				if not self._PipelinePut(output, item, stop):
+					return
+			self._PipelinePut(output, None, stop)
+		except BaseException as e:
+			self._PipelinePut(output, e, stop)
+
+	def _PipelinePut(self, output, item, stop):
+		while not stop.is_set():
+			try:
+				output.put(item, timeout=self.PIPELINE_POLL_SECS)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _PipelineItems(self, source, stop):
+		"""Returns a generator of the items in the queue of a pipeline stage, until the end of the items. Raises the
+		exception that stopped the previous stage."""
+		while not stop.is_set():
+			try:
+				item = source.get(timeout=self.PIPELINE_POLL_SECS)
+			except queue.Empty:
+				continue
+			if item is None:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+
+	def NeedsSync(self, dataType, date_stamp, force=False):
+		"""Returns True unless the sync state says that the data of a given type and day is final
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		force -- sync the day even if it is final
+		"""
+		return force or self.syncState is None or not self.syncState.IsSynced(dataType, date_stamp)
+
+	def AfterSynced(self, dataType, date_stamp, sessions=()):
+		"""Marks the data of a given type and day as synced in the sync state, once it has been written to google fit.
+		The day is not marked if any of its sessions could not be written.
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		sessions -- google sessions of the day, as returned by ConvertFitbitDay
+		"""
+		if self.syncState is None:
+			return
+		today = datetime.now(self.tzinfo).date()
+		self.AfterUploaded(self.convertor.GetDataSourceId(dataType), lambda: self.AfterSessionsWritten(sessions,
+			lambda: self.syncState.MarkSynced(dataType, date_stamp, today)))
+
+	def SyncFitbitDayToGoogleFit(self, dataType, date_stamp, force=False):
+		"""
+		Sync Fitbit data to Google fit for a given day, unless the sync state says it is final.
+		Returns a one line summary of the sync.
+
+		dataType -- fitbit data type to sync
+		date_stamp -- timestamp in yyyy-mm-dd format of the day to sync
+		force -- sync the day even if it is final
+		"""
+		if not self.NeedsSync(dataType, date_stamp, force):
+			return "skipped {} - already synced".format(dataType)
+		records = self.FetchFitbitDay(dataType, date_stamp)
+		dataSourceId,pointSets,sessions,summary = self.ConvertFitbitDay(dataType, date_stamp, records)
+		self.UploadGoogleFitDay(dataType, pointSets, sessions)
+		self.AfterSynced(dataType, date_stamp, sessions)
+		return summary
+
 	def SyncFitbitToGoogleFit(self, dataType, date_stamp):
 		"""
-		Sync Fitbit data to Google fit for a given day.
+		Sync Fitbit data to Google fit for a given day. Returns a one line summary of the sync.
 
 		dataType -- fitbit data type to sync
 		date_stamp -- timestamp in yyyy-mm-dd format of the day to sync
 		"""
+		records = self.FetchFitbitDay(dataType, date_stamp)
+		dataSourceId,pointSets,sessions,summary = self.ConvertFitbitDay(dataType, date_stamp, records)
+		self.UploadGoogleFitDay(dataType, pointSets, sessions)
+		return summary
+
+	def FetchFitbitDay(self, dataType, date_stamp, columns=False):
+		"""
+		Returns the Fitbit data points or logs of a given type for a day, as returned by FitbitDayRecords. Streamed
+		intraday data points are returned as arrays of their seconds of the day and values, see ReadFitbitIntradayDay.
+
+		dataType -- fitbit data type to fetch
+		date_stamp -- timestamp in yyyy-mm-dd format of the day to fetch
+		columns -- return intraday data points as arrays of their seconds of the day and values in any case, see
+			FitbitIntradayColumns
+		"""
+		intraday = dataType in ('steps','distance','heart_rate','calories')
+		with self.metrics.DataType(dataType):
+			# Get the data of the day from fitbit, unless it was fetched ahead
+			records = self.PrefetchedLogs(dataType, date_stamp)
+			if records is None and self.streamIntraday and intraday:
+				records = self.ReadFitbitIntradayDay(dataType, date_stamp)
+			elif records is None:
+				fitbitResponse = self.ReadFromFitbitCached(date_stamp, self.fitbitClient.make_request,
+					self.FitbitDayUrl(dataType, date_stamp))
+				records = self.FitbitDayRecords(dataType, fitbitResponse)
+				if columns and intraday:
+					records = self.FitbitIntradayColumns(records)
+		return records
+
+	def ReadFitbitIntradayDay(self, dataType, date_stamp):
+		"""
+		Returns the intraday data of a given type for a day as arrays of the seconds of the day and the values of the
+		points. The response is parsed while it is read, a chunk of points at a time, so that neither the whole
+		decoded response nor a dict per point is ever held in memory. The arrays are converted by ConvertFitbitDay.
+		Responses are cached like those of ReadFromFitbitCached.
+
+		dataType -- fitbit intraday data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		"""
+		url = self.FitbitDayUrl(dataType, date_stamp)
+		chunks = None
+		if self.responseCache is not None:
+			key = self.responseCache.Key(self.fitbitClient.make_request.__name__, url)
+			chunks = self.responseCache.Stream(key, self.FitbitCacheMaxAge(date_stamp), self.FITBIT_STREAM_CHUNK_BYTES)
+			if chunks is not None:
+				self.metrics.Count('fitbit_cache_hits')
+				with closing(chunks):
+					seconds,values = self.ParseFitbitIntradayStream(dataType, chunks)
+
+		def read():
+			# The request of fitbitClient.make_request, without decoding the response
+			response = self.fitbitClient.client.make_request(url, headers={'Accept-Language': self.fitbitClient.system},
+				stream=True)
+			chunks = response.iter_content(self.FITBIT_STREAM_CHUNK_BYTES)
+			if self.responseCache is not None:
+				chunks = self.responseCache.PutStream(key, chunks)
+			with closing(response), closing(chunks):
+				return self.ParseFitbitIntradayStream(dataType, chunks)
+		if chunks is None:
+			seconds,values = self.ReadFromFitbit(read)
+		return seconds,values
+
+	def ParseFitbitIntradayStream(self, dataType, chunks):
+		"""
+		Returns the intraday data points of a Fitbit response as arrays of their seconds of the day and values,
+		parsed while the response is read.
+
+		dataType -- fitbit intraday data type
+		chunks -- iterable of the bytes of the json response
+		"""
+		parsed = []
+		try:
+			for points in StreamJsonArray(chunks, (self.FitbitIntradayResource(dataType)[2], 'dataset')):
+				parsed.append(self.FitbitIntradayColumns(points))
+		except KeyError:
+			self._PrintIntradayAccessHint()
+			exit()
+		# Read the rest of the response, for it to be cached
+		for _ in chunks:
+			pass
+		if not parsed:
+			return self.FitbitIntradayColumns([])
+		return tuple(np.concatenate(column) for column in zip(*parsed))
+
+	def FitbitIntradayColumns(self, intraday_data):
+		"""
+		Returns arrays of the seconds of the day and the values of a list of Fitbit intraday data points.
+
+		intraday_data -- fitbit intraday data points, as returned by FitbitDayRecords
+		"""
+		return (self.convertor.SecondsOfFitbitTimes([point['time'] for point in intraday_data]),
+			np.array([point['value'] for point in intraday_data]))
+
+	def ExportFitbitDaysToArchive(self, archive, dataTypes, date_stamps, force=False):
+		"""
+		Fetch Fitbit data of the given types for a list of days and add it to an archive, without writing anything to
+		Google fit. Returns a generator of (date_stamp, summaries) tuples. Days that were archived at least
+		FITBIT_IMMUTABLE_AFTER_DAYS days after the day are not fetched again.
+
+		archive -- Archive to add the data to
+		dataTypes -- fitbit data types to export
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to export, a list or any other iterable
+		force -- fetch days again even if the archived data is final
+		"""
+		needed = lambda dataType, date_stamp: force or not archive.IsFinal(dataType, date_stamp,
+			self.FITBIT_IMMUTABLE_AFTER_DAYS)
+		today = datetime.now(self.tzinfo).date()
+		try:
+			for date_stamp in self._PrefetchedDays(dataTypes, date_stamps, needed):
+				summaries = []
+				for dataType in dataTypes:
+					if not needed(dataType, date_stamp):
+						summaries.append("skipped {} - already archived".format(dataType))
+						continue
+					records = self.FetchFitbitDay(dataType, date_stamp, columns=True)
+					archive.Put(dataType, date_stamp, records, today)
+					if dataType in ('steps','distance','heart_rate','calories'):
+						summaries.append("archived {} - {} data points".format(dataType, len(records[0])))
+					else:
+						summaries.append("archived {} - {} logs".format(dataType, len(records)))
+				yield date_stamp, summaries
+		finally:
+			# Keep the days fetched so far, even if the export is interrupted
+			archive.Flush()
+
+	def ImportArchivedDaysToGoogleFit(self, archive, dataTypes, date_stamps, force=False):
+		"""
+		Sync Fitbit data of the given types from an archive to Google fit for a list of days, unless the sync state
+		says they are final. Returns a generator of (date_stamp, summaries) tuples. No Fitbit requests are made, days
+		that are not in the archive are skipped.
+
+		archive -- Archive written by ExportFitbitDaysToArchive
+		dataTypes -- fitbit data types to sync
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to sync, a list or any other iterable
+		force -- sync days again even if the sync state says they are final
+		"""
+		for date_stamp in date_stamps:
+			summaries = []
+			for dataType in dataTypes:
+				if not self.NeedsSync(dataType, date_stamp, force):
+					summaries.append("skipped {} - already synced".format(dataType))
+					continue
+				with self.metrics.Time('fetch', dataType):
+					records = archive.Get(dataType, date_stamp)
+				if records is None:
+					summaries.append("skipped {} - not archived".format(dataType))
+					continue
+				dataSourceId,pointSets,sessions,summary = self.ConvertFitbitDay(dataType, date_stamp, records)
+				self.UploadGoogleFitDay(dataType, pointSets, sessions)
+				self.AfterSynced(dataType, date_stamp, sessions)
+				summaries.append(summary)
+			yield date_stamp, summaries
+
+		# Write whatever is still queued
+		self.FlushToGoogleFit()
+
+	def UploadGoogleFitDay(self, dataType, pointSets, sessions):
+		"""
+		Write a day of converted Fitbit data to Google fit, or queue it to be written with the next days.
+
+		dataType -- fitbit data type
+		pointSets -- list of google data point collections, as returned by ConvertFitbitDay
+		sessions -- list of google sessions, as returned by ConvertFitbitDay
+		"""
+		with self.metrics.DataType(dataType):
+			for google_session in sessions:
+				self.QueueSessionToGoogleFit(google_session)
+			for googlePoints in pointSets:
+				self.QueueToGoogleFit(self.convertor.GetDataSourceId(dataType), googlePoints)
+
+	def FitbitDayUrl(self, dataType, date_stamp):
+		"""
+		Returns the url of the Fitbit API request for a day of data of a given type. The python client library
+		does not accept all detail levels of the intraday API, so all urls are built here.
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		"""
+		base_url = '{}/{}/user/-'.format(self.fitbitClient.API_ENDPOINT, self.fitbitClient.API_VERSION)
 		if dataType in ('steps','distance','heart_rate','calories'):
-			return self.SyncFitbitIntradayToGoogleFit(dataType, date_stamp)
-		elif dataType in ('weight','body_fat'):
-			return self.SyncFitbitLogToGoogleFit(dataType, date_stamp)
-		elif dataType in ('sleep'):
-			return self.SyncFitbitSleepToGoogleFit(date_stamp)
+			res_path,detail_level,_ = self.FitbitIntradayResource(dataType)
+			return '{}/{}/date/{}/1d/{}.json'.format(base_url, res_path, date_stamp, detail_level)
+		elif dataType == 'weight':
+			return '{}/body/log/weight/date/{}/{}.json'.format(base_url, date_stamp, date_stamp)
+		elif dataType == 'body_fat':
+			return '{}/body/log/fat/date/{}/{}.json'.format(base_url, date_stamp, date_stamp)
+		elif dataType == 'sleep':
+			return '{}/sleep/date/{}.json'.format(base_url, date_stamp)
 		else:
 			raise ValueError("Unexpected data type given!")
 
-	def SyncFitbitIntradayToGoogleFit(self, dataType, date_stamp):
+	def FitbitIntradayResource(self, dataType):
 		"""
-		Sync Fitbit data of a particular intraday type to Google fit for a given day.
+		Returns the resource path, detail level and response key of a Fitbit intraday data type.
 
-		dataType -- fitbit data type to sync
-		date_stamp -- timestamp in yyyy-mm-dd format of the day to sync
+		dataType -- fitbit data type
 		"""
 		if dataType == 'steps':
-			res_path,detail_level,resp_id  = 'activities/steps','1min','activities-steps-intraday'
+			return 'activities/steps','1min','activities-steps-intraday'
 		elif dataType == 'distance':
-			res_path,detail_level,resp_id  = 'activities/distance','1min','activities-distance-intraday'
+			return 'activities/distance','1min','activities-distance-intraday'
 		elif dataType == 'heart_rate':
-			res_path,detail_level,resp_id  = 'activities/heart','1sec','activities-heart-intraday'
+			return 'activities/heart',self.heartRateDetail,'activities-heart-intraday'
 		elif dataType == 'calories':
-			res_path,detail_level,resp_id  = 'activities/calories','1min','activities-calories-intraday'
+			return 'activities/calories','1min','activities-calories-intraday'
 		else:
 			raise ValueError("Unexpected data type given!")
-		dataSourceId = self.convertor.GetDataSourceId(dataType)
 
-		# Get intraday data from fitbit
-		interday_raw = self.ReadFromFitbit(self.fitbitClient.intraday_time_series, res_path, base_date=date_stamp,
-			detail_level=detail_level)
-		try:
-			intraday_data = interday_raw[resp_id]['dataset']
-		except KeyError as e:
-			print('')
-			print('Uh oh! Looks like you didn\'t set your "OAuth 2.0 Application Type" to "Personal" during Fitbit setup.')
-			print('For more information, refer https://github.com/praveendath92/fitbit-googlefit/issues/2')
-			print('')
-			exit()
-
-		# convert all fitbit data points to google fit data points
-		googlePoints = [self.convertor.ConvertFibitPoint(date_stamp,point,dataType) for point in intraday_data]
-		nonZeroPoints = [
-			point for point in googlePoints if not all(
-				('intVal' in v and v['intVal'] == 0) or ('fpVal' in v and v['fpVal'] == 0) for v in point['value'])]
-
-		# Write a day of fitbit data to Google fit
-		self.WriteToGoogleFit(dataSourceId, nonZeroPoints)
-		print("synced {} - {}/{} data points".format(dataType,len(nonZeroPoints),len(googlePoints)) )
-
-	def SyncFitbitLogToGoogleFit(self, dataType, date_stamp):
+	def FitbitDayRecords(self, dataType, fitbitResponse):
 		"""
-		Sync Fitbit logs of a particular type to Google Fit for a given day.
+		Returns the list of data points or logs in a Fitbit API response for data of a given type.
 
-		dataType -- fitbit data type to sync
-		date_stamp -- timestamp in yyyy-mm-dd format of the day to sync
+		dataType -- fitbit data type
+		fitbitResponse -- decoded json response of the request to FitbitDayUrl
 		"""
-		if dataType == 'weight':
-			callMethod,resp_id = self.fitbitClient.get_bodyweight,'weight'
+		if dataType in ('steps','distance','heart_rate','calories'):
+			try:
+				return fitbitResponse[self.FitbitIntradayResource(dataType)[2]]['dataset']
+			except KeyError as e:
+				self._PrintIntradayAccessHint()
+				exit()
+		elif dataType == 'weight':
+			return fitbitResponse['weight']
 		elif dataType == 'body_fat':
-			callMethod,resp_id = self.fitbitClient.get_bodyfat,'fat'
+			return fitbitResponse['fat']
+		elif dataType == 'sleep':
+			return fitbitResponse['sleep']
 		else:
 			raise ValueError("Unexpected data type given!")
-		dataSourceId = self.convertor.GetDataSourceId(dataType)
 
-		# Get intraday distance for date_stamp from fitbit
-		fitbitLogs = self.ReadFromFitbit(callMethod,base_date=date_stamp,end_date=date_stamp)[resp_id]
+	def _PrintIntradayAccessHint(self):
+		print('')
+		print('Uh oh! Looks like you didn\'t set your "OAuth 2.0 Application Type" to "Personal" during Fitbit setup.')
+		print('For more information, refer https://github.com/praveendath92/fitbit-googlefit/issues/2')
+		print('')
 
-		# convert all fitbit data points to google fit data points
-		googlePoints = [self.convertor.ConvertFibitPoint(date_stamp,point,dataType) for point in fitbitLogs]
+	def ConvertFitbitDay(self, dataType, date_stamp, records):
+		"""
+		Converts a day of Fitbit data of a given type to Google Fit. Returns a tuple of the data source id,
+		a list of google data point collections, a list of google sessions and a one line summary.
 
-		# Write a day of fitbit data to Google fit
-		self.WriteToGoogleFit(dataSourceId, googlePoints)
-		print("synced {} - {} logs".format(dataType,len(googlePoints)) )
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		records -- fitbit data points or logs of the day, as returned by FetchFitbitDay
+		"""
+		dataSourceId = self.convertor.GetDataSourceId(dataType)
+		with self.metrics.Time('convert', dataType):
+			if dataType in ('steps','distance','heart_rate','calories'):
+				pointSets,sessions,summary = self.ConvertFitbitIntradayDay(dataType, date_stamp, records)
+			elif dataType in ('weight','body_fat'):
+				# convert all fitbit data points to google fit data points
+				googlePoints = [self.convertor.ConvertFibitPoint(date_stamp,point,dataType) for point in records]
+				self.metrics.Count('points_converted', len(googlePoints), dataType)
+				pointSets,sessions,summary = [googlePoints],[],"synced {} - {} logs".format(dataType,len(googlePoints))
+			elif dataType == 'sleep':
+				pointSets,sessions,summary = self.ConvertFitbitSleepDay(date_stamp, records)
+			else:
+				raise ValueError("Unexpected data type given!")
+		return dataSourceId,pointSets,sessions,summary
 
-	def SyncFitbitSleepToGoogleFit(self, date_stamp):
+	def ConvertFitbitIntradayDay(self, dataType, date_stamp, intraday_data):
 		"""
-		Sync sleep data for a given day from Fitbit to Google fit.
+		Converts a day of Fitbit data of a particular intraday type to Google fit.
 
-		date_stamp -- timestamp in yyyy-mm-dd format of the start day
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		intraday_data -- fitbit intraday data points of the day, or arrays of their seconds of the day and values
 		"""
-		dataSourceId = self.convertor.GetDataSourceId('sleep')
-		date_obj = self.convertor.parseHumanReadableDate(date_stamp)
+		# convert all fitbit data points to google fit data points
+		if isinstance(intraday_data, tuple):
+			googlePoints = self.convertor.ConvertFitbitIntradayColumns(date_stamp, *intraday_data, dataType)
+		else:
+			googlePoints = self.convertor.ConvertFitbitIntraday(date_stamp,intraday_data,dataType)
+		with self.metrics.Time('filter', dataType):
+			nonZeroPoints = googlePoints.NonZero()
+			self.metrics.Count('points_converted', len(googlePoints), dataType)
+			self.metrics.Count('points_filtered', len(googlePoints) - len(nonZeroPoints), dataType)
+			summary = "synced {} - {}/{} data points".format(dataType,len(nonZeroPoints),len(googlePoints))
+			# Heart rate points are instantaneous, they are not coalesced, see IntradayDataset.Coalesce
+			if self.coalescePoints and len(nonZeroPoints) > 0 and dataType != 'heart_rate':
+				coalescedPoints = nonZeroPoints.Coalesce()
+				self._CountCoalesced(dataType, len(nonZeroPoints), len(coalescedPoints))
+				summary += ", coalesced to {} ({:.1f}x)".format(len(coalescedPoints), len(nonZeroPoints)/len(coalescedPoints))
+				nonZeroPoints = coalescedPoints
+		return [nonZeroPoints],[],summary
 
-		# Get sleep data for a given date
-		fitbitSleeps = self.ReadFromFitbit(self.fitbitClient.get_sleep,date_obj)['sleep']
+	def ConvertFitbitSleepDay(self, date_stamp, fitbitSleeps):
+		"""
+		Converts the Fitbit sleep logs of a day to Google fit sleep segments and sessions.
 
-		# Iterate over each sleep log for that day
-		sleep_count = 0
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		fitbitSleeps -- fitbit sleep logs of the day
+		"""
+		pointSets,sessions = [],[]
 		for sleep in fitbitSleeps:
 			start = dateutil.parser.parse(sleep['startTime']).replace(tzinfo=self.tzinfo)
 			# When DST occurs during a sleep, Fitbit prints datetimes using the offset of the
 			# TZ at the start of the sleep...
 			offset = dateutil.tz.tzoffset(None, self.tzinfo.utcoffset(start))
 			minute_points = sleep['levels']['data']
-			sleep_count += 1
 
 			# convert all fitbit data points to google fit data points
 			googlePoints = [
@@ -248,58 +1060,266 @@ class Remote:
 				for point in minute_points
 				if (gp := self.convertor.ConvertFibitPoint(date_stamp, point, 'sleep', offset)) is not None
 			]
+			self.metrics.Count('points_converted', len(googlePoints), 'sleep')
+			self.metrics.Count('points_filtered', len(minute_points) - len(googlePoints), 'sleep')
+			if self.coalescePoints and len(googlePoints) > 0:
+				coalescedPoints = CoalesceSegments(googlePoints)
+				self._CountCoalesced('sleep', len(googlePoints), len(coalescedPoints))
+				googlePoints = coalescedPoints
+
+			# 1. a fit session about sleep, 2. sleep segment data points of the session
+			sessions.append(self.convertor.ConvertGFitSleepSession(googlePoints, sleep['logId']))
+			pointSets.append(googlePoints)
+
+		return pointSets,sessions,"synced sleep - {} logs".format(len(fitbitSleeps))
+
+	def PrefetchFitbitLogs(self, dataType, date_stamps):
+		"""
+		Fetch the logs of a given type for a list of days with as few range requests as possible. The logs
+		are split per day and picked up by the sync of each day. Does nothing for non-log data types.
+
+		dataType -- fitbit data type to fetch
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to fetch
+		"""
+		with self.metrics.DataType(dataType):
+			for url, window in self.FitbitLogRangeRequests(dataType, date_stamps):
+				fitbitResponse = self.ReadFromFitbitCached(window[-1], self.fitbitClient.make_request, url)
+				self.StorePrefetchedLogs(dataType, window, fitbitResponse)
+
+	def FitbitLogRangeRequests(self, dataType, date_stamps):
+		"""
+		Returns a list of (url, date_stamps) tuples of the range requests needed to fetch the logs of a given type
+		for a list of days. Empty for non-log data types.
+
+		dataType -- fitbit data type to fetch
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to fetch
+		"""
+		if dataType == 'weight':
+			res_path,maxDays = 'body/log/weight',self.FITBIT_MAX_BODY_LOG_RANGE_DAYS
+		elif dataType == 'body_fat':
+			res_path,maxDays = 'body/log/fat',self.FITBIT_MAX_BODY_LOG_RANGE_DAYS
+		elif dataType == 'sleep':
+			res_path,maxDays = 'sleep',self.FITBIT_MAX_SLEEP_RANGE_DAYS
+		else:
+			return []
+
+		# Group the days into windows that fit in a single request
+		windows = []
+		for date_stamp in sorted(date_stamps):
+			day = datetime.strptime(date_stamp, DATE_FORMAT).date()
+			if windows and (day - windows[-1][0]).days < maxDays:
+				windows[-1][1].append(date_stamp)
+			else:
+				windows.append((day, [date_stamp]))
+
+		return [('{}/{}/user/-/{}/date/{}/{}.json'.format(self.fitbitClient.API_ENDPOINT,
+			self.fitbitClient.API_VERSION, res_path, window[0], window[-1]), window) for _, window in windows]
+
+	def StorePrefetchedLogs(self, dataType, date_stamps, fitbitResponse):
+		"""
+		Split the logs of a range request per day, for the sync of each day to pick up.
+
+		dataType -- fitbit data type
+		date_stamps -- timestamps in yyyy-mm-dd format of the days the request covers
+		fitbitResponse -- decoded json response of the range request
+		"""
+		date_key = 'dateOfSleep' if dataType == 'sleep' else 'date'
+		logsPerDay = {date_stamp: [] for date_stamp in date_stamps}
+		for log in self.FitbitDayRecords(dataType, fitbitResponse):
+			if log[date_key] in logsPerDay:
+				logsPerDay[log[date_key]].append(log)
+		self._prefetchedLogs.update({(dataType, date_stamp): logs for date_stamp, logs in logsPerDay.items()})
 
-			# 1. Write a fit session about sleep
-			google_session = self.convertor.ConvertGFitSleepSession(googlePoints, sleep['logId'])
-			self.WriteSessionToGoogleFit(google_session)
+	def PrefetchedLogs(self, dataType, date_stamp):
+		"""
+		Returns the prefetched logs of a given type for a day, or None if they were not fetched ahead. The logs are
+		only returned once.
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		"""
+		return self._prefetchedLogs.pop((dataType, date_stamp), None)
+
+	def SyncFitbitDailyTotalsToGoogleFit(self, dataTypes, date_stamps, force=False):
+		"""
+		Sync Fitbit data of the given types to Google fit for a list of days like SyncFitbitDaysToGoogleFit, but with
+		a single data point per day for steps, distance and calories: the daily totals, fetched for
+		FITBIT_MAX_DAILY_RANGE_DAYS days with a single request. Other data types are synced day by day as usual.
+		Daily totals go to data sources of their own and are kept in the sync state under their own data types, see
+		Convertor.DailyDataType. Days whose minute level data of a type was synced before are skipped for that type,
+		even with force, as Google Fit would count both. Returns a generator of (date_stamp, summaries) tuples.
+
+		dataTypes -- fitbit data types to sync
+		date_stamps -- timestamps in yyyy-mm-dd format of the days to sync, a list or any other iterable
+		force -- sync days again even if the sync state says they are final
+		"""
+		needed = lambda dataType, date_stamp: self.NeedsSync(self.convertor.DailyDataType(dataType), date_stamp, force)
+		minuteSynced = lambda dataType, date_stamp: self.syncState is not None and \
+			self.syncState.WasSynced(dataType, date_stamp)
+		dailyTypes = [dataType for dataType in dataTypes if dataType in self.convertor.DAILY_TYPES]
+		otherTypes = [dataType for dataType in dataTypes if dataType not in dailyTypes]
+		date_stamps = iter(date_stamps)
+		while True:
+			chunk = list(itertools.islice(date_stamps, self.FITBIT_MAX_DAILY_RANGE_DAYS))
+			if not chunk:
+				break
+			totals = {dataType: self.FetchFitbitDailyTotals(dataType,
+				[date_stamp for date_stamp in chunk if needed(dataType, date_stamp) and not minuteSynced(dataType, date_stamp)])
+				for dataType in dailyTypes}
+			for date_stamp in self._PrefetchedDays(otherTypes, chunk, needed):
+				summaries = []
+				for dataType in dataTypes:
+					if dataType not in totals:
+						summaries.append(self.SyncFitbitDayToGoogleFit(dataType, date_stamp, force))
+					elif minuteSynced(dataType, date_stamp):
+						summaries.append("skipped {} - minute level data synced already".format(dataType))
+					elif not needed(dataType, date_stamp):
+						summaries.append("skipped {} - already synced".format(dataType))
+					else:
+						summaries.append(self.SyncFitbitDailyTotalToGoogleFit(dataType, date_stamp,
+							totals[dataType].get(date_stamp)))
+				yield date_stamp, summaries
+
+		# Write whatever is still queued
+		self.FlushToGoogleFit()
 
-			# 2. create activity segment data points for the activity
-			self.WriteToGoogleFit(dataSourceId, googlePoints)
+	def FetchFitbitDailyTotals(self, dataType, date_stamps):
+		"""
+		Returns the Fitbit daily totals of a given type for the days from the first to the last of a list of days
+		with a single time series request, as a dict of date_stamp -> time series data point.
+
+		dataType -- steps, distance or calories
+		date_stamps -- timestamps in yyyy-mm-dd format of the days, at most FITBIT_MAX_DAILY_RANGE_DAYS days apart
+		"""
+		if not date_stamps:
+			return {}
+		res_path = self.FitbitIntradayResource(dataType)[0]
+		url = '{}/{}/user/-/{}/date/{}/{}.json'.format(self.fitbitClient.API_ENDPOINT, self.fitbitClient.API_VERSION,
+			res_path, min(date_stamps), max(date_stamps))
+		with self.metrics.DataType(self.convertor.DailyDataType(dataType)):
+			fitbitResponse = self.ReadFromFitbitCached(max(date_stamps), self.fitbitClient.make_request, url)
+		# e.g. {"activities-steps": [{"dateTime": "2016-08-20", "value": "10234"}, ...]}
+		return {point['dateTime']: point for point in fitbitResponse[res_path.replace('/', '-')]}
+
+	def SyncFitbitDailyTotalToGoogleFit(self, dataType, date_stamp, data_point):
+		"""
+		Write the Fitbit daily total of a given type for a day to Google fit, as a data point spanning the day.
+		Returns a one line summary of the sync.
 
-		print("synced sleep - {} logs".format(sleep_count))
+		dataType -- steps, distance or calories
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		data_point -- fitbit time series data point of the day, None if Fitbit has none
+		"""
+		dailyType = self.convertor.DailyDataType(dataType)
+		with self.metrics.Time('convert', dailyType):
+			googlePoints = [] if data_point is None or float(data_point['value']) == 0 else \
+				[self.convertor.ConvertFitbitDailyPoint(date_stamp, data_point, dataType)]
+			self.metrics.Count('points_converted', len(googlePoints), dailyType)
+		self.UploadGoogleFitDay(dailyType, [googlePoints], [])
+		self.AfterSynced(dailyType, date_stamp)
+		return "synced {} - daily total {}".format(dataType, data_point['value'] if googlePoints else 0)
 
-	def SyncFitbitActivitiesToGoogleFit(self, start_date='', callurl=None):
+	def ReadFitbitActivities(self, start_date, end_date=None):
 		"""
-		Sync activities data starting from a given day from Fitbit to Google fit.
+		Returns a generator of the Fitbit activities logged from a given day on, oldest first.
 
-		start_date -- timestamp in yyyy-mm-dd format of the start day
-		callurl -- url to fetch activities from
+		start_date -- date of the first day
+		end_date -- date of the day to stop at (exclusive), all activities since start_date if not given
 		"""
 		# Fitbit activities list endpoint is in beta stage. It may break in the future and not directly supported
-		# by the python client library.
+		# by the python client library. It takes either afterDate or beforeDate, so end_date is checked here.
+		end_stamp = end_date.strftime(DATE_FORMAT) if end_date else None
+		callurl = '{}/1/user/-/activities/list.json?afterDate={}&sort=asc&offset=0&limit={}'.format(
+			self.fitbitClient.API_ENDPOINT, start_date, self.FITBIT_MAX_ACTIVITIES_PER_PAGE)
+		while callurl:
+			activities_raw = self.ReadFromFitbit(self.fitbitClient.make_request, callurl)
+			for activity in activities_raw['activities']:
+				# startTime is in the user's time zone, e.g. 2019-01-03T12:08:23.000-08:00
+				if end_stamp and activity['startTime'][:10] >= end_stamp:
+					return
+				yield activity
+			callurl = activities_raw['pagination']['next']
+
+	def ExportFitbitActivitiesToArchive(self, archive, start_date, end_date):
+		"""
+		Fetch the Fitbit activities of a given range of days and add them to an archive, by the day they start on.
+
+		archive -- Archive to add the activities to
+		start_date -- date of the start day
+		end_date -- date of the end day (exclusive)
+		"""
+		activities = defaultdict(list)
+		with self.metrics.DataType('activity'):
+			for activity in self.ReadFitbitActivities(start_date, end_date):
+				activities[activity['startTime'][:10]].append(activity)
+		today = datetime.now(self.tzinfo).date()
+		for day in self.convertor.daterange(start_date, end_date):
+			date_stamp = day.strftime(DATE_FORMAT)
+			archive.Put('activity', date_stamp, activities.get(date_stamp, []), today)
+		archive.Flush()
+		print("Archived {} exercises between : {} -- {}".format(sum(map(len, activities.values())),
+			start_date.strftime(DATE_FORMAT), (end_date - timedelta(days=1)).strftime(DATE_FORMAT)))
+
+	def ArchivedActivities(self, archive, start_date, end_date):
+		"""
+		Returns a generator of the Fitbit activities of a given range of days in an archive, oldest first.
+
+		archive -- Archive written by ExportFitbitActivitiesToArchive
+		start_date -- date of the start day
+		end_date -- date of the end day (exclusive)
+		"""
+		for day in self.convertor.daterange(start_date, end_date):
+			yield from archive.Get('activity', day.strftime(DATE_FORMAT)) or []
+
+	def SyncFitbitActivitiesToGoogleFit(self, start_date='', end_date=None, activities=None):
+		"""
+		Sync activities data of a given range of days from Fitbit to Google fit.
+
+		start_date -- date of the start day
+		end_date -- date of the end day (exclusive), all activities since start_date are synced if not given
+		activities -- activities to sync instead of those read from Fitbit, e.g. ArchivedActivities
+		"""
 		dataSourceId = self.convertor.GetDataSourceId('activity')
-		if not callurl:
-			callurl = '{}/user/-/activities/list.json?afterDate={}&sort=asc&offset=0&limit=20'.format(self.FITBIT_API_URL,start_date)
-		activities_raw = self.ReadFromFitbit(self.fitbitClient.make_request, callurl)
-		activities = activities_raw['activities']
-
-		startTimeMillis,endTimeMillis = [],[]
-		for activity in activities:
-			# 1. write a fit session about the activity 
-			google_session = self.convertor.ConvertFitbitActivityLog(activity)
-			self.WriteSessionToGoogleFit(google_session)
-
-			# 2. create activity segment data points for the activity
-			activity_segment = dict(
-				dataTypeName='com.google.activity.segment',
-				startTimeNanos=self.convertor.nano(google_session['startTimeMillis']),
-				endTimeNanos=self.convertor.nano(google_session['endTimeMillis']),
-				value=[dict(intVal=google_session['activityType'])]
-				)
-			self.WriteToGoogleFit(dataSourceId, [activity_segment])
-
-			# Just for user output
-			startTimeMillis.append(google_session['startTimeMillis'])
-			endTimeMillis.append(google_session['endTimeMillis'])
-
-		if len(startTimeMillis) > 0:
-			print("Synced {} exercises between : {} -- {}".format(len(activities),
-				datetime.fromtimestamp(min(startTimeMillis)/1000).strftime('%Y-%m-%d'),
-				datetime.fromtimestamp(max(endTimeMillis)/1000).strftime('%Y-%m-%d')) )
-		else:
+
+		# Segments are written GFIT_MAX_POINTS_PER_UPDATE at a time, so that a long backfill is not kept in memory
+		activity_segments = []
+		synced,first,last = 0,None,None
+		sessionIds = set()
+		with self.metrics.DataType('activity'):
+			if activities is None:
+				activities = self.ReadFitbitActivities(start_date, end_date)
+			for activity in activities:
+				# 1. write a fit session about the activity
+				with self.metrics.Time('convert'):
+					google_session = self.convertor.ConvertFitbitActivityLog(activity)
+				self.QueueSessionToGoogleFit(google_session)
+				sessionIds.add(google_session['id'])
+
+				# 2. create activity segment data points for the activity
+				activity_segments.append(dict(
+					dataTypeName='com.google.activity.segment',
+					startTimeNanos=self.convertor.nano(google_session['startTimeMillis']),
+					endTimeNanos=self.convertor.nano(google_session['endTimeMillis']),
+					value=[dict(intVal=google_session['activityType'])]
+					))
+				self.metrics.Count('points_converted')
+				synced += 1
+				first = min(first or google_session['startTimeMillis'], google_session['startTimeMillis'])
+				last = max(last or google_session['endTimeMillis'], google_session['endTimeMillis'])
+				if len(activity_segments) == self.GFIT_MAX_POINTS_PER_UPDATE:
+					self.WriteToGoogleFit(dataSourceId, activity_segments)
+					activity_segments = []
+		self.FlushSessionsToGoogleFit()
+
+		if synced == 0:
 			print("No Fitbit exercises logged since {}".format(start_date))
 			return
 
-		if activities_raw['pagination']['next'] != '':
-		 	self.SyncFitbitActivitiesToGoogleFit(callurl=activities_raw['pagination']['next'])
-
+		self.WriteToGoogleFit(dataSourceId, activity_segments)
+		print("Synced {} exercises between : {} -- {}".format(synced,
+			datetime.fromtimestamp(first/10**3).strftime('%Y-%m-%d'),
+			datetime.fromtimestamp(last/10**3).strftime('%Y-%m-%d')) )
+		with self._queueLock:
+			failed = len(sessionIds - self._writtenSessions)
+		if failed:
+			print("Failed to write {} of these exercise sessions, sync them again later".format(failed))
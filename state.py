@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+__author__ = "Praveen Kumar Pendyala"
+__email__ = "mail@pkp.io"
+"""
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+class SyncState:
+	"""Local journal of the days synced for each data type, so that finalized days are not synced again,
+	and of the datasets uploaded to Google Fit, so that unchanged datasets are not uploaded again"""
+
+	def __init__(self, stateFile, finalizeAfterDays=2):
+		""" Intialize a sync state store.
+
+		stateFile -- sqlite database file to keep the state in
+		finalizeAfterDays -- a day is final, and is not synced again, once it was synced this many days later
+		"""
+		self.finalizeAfterDays = finalizeAfterDays
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(stateFile, check_same_thread=False)
+		with self._db:
+			self._db.execute("""CREATE TABLE IF NOT EXISTS synced (
+				data_type TEXT NOT NULL,
+				date TEXT NOT NULL,
+				synced_at TEXT NOT NULL,
+				final INTEGER NOT NULL,
+				PRIMARY KEY (data_type, date))""")
+			self._db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+				data_source_id TEXT NOT NULL,
+				dataset_id TEXT NOT NULL,
+				fingerprint TEXT NOT NULL,
+				PRIMARY KEY (data_source_id, dataset_id))""")
+		logging.debug("Sync state loaded from %s", stateFile)
+
+	def IsSynced(self, dataType, date_stamp):
+		"""Returns True if a day of a given data type has been synced after it was final
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		"""
+		with self._lock:
+			row = self._db.execute("SELECT final FROM synced WHERE data_type = ? AND date = ?",
+				(dataType, date_stamp)).fetchone()
+		return row is not None and row[0] == 1
+
+	def WasSynced(self, dataType, date_stamp):
+		"""Returns True if a day of a given data type has been synced, final or not
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		"""
+		with self._lock:
+			row = self._db.execute("SELECT 1 FROM synced WHERE data_type = ? AND date = ?",
+				(dataType, date_stamp)).fetchone()
+		return row is not None
+
+	def MarkSynced(self, dataType, date_stamp, today):
+		"""Records a day of a given data type as synced
+
+		dataType -- fitbit data type
+		date_stamp -- timestamp in yyyy-mm-dd format of the day
+		today -- the current date of the user
+		"""
+		final = (today - datetime.strptime(date_stamp, DATE_FORMAT).date()).days >= self.finalizeAfterDays
+		with self._lock, self._db:
+			self._db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?)",
+				(dataType, date_stamp, datetime.now().isoformat(timespec='seconds'), int(final)))
+
+	def UploadFingerprint(self, dataSourceId, datasetId):
+		"""Returns the fingerprint of the last upload of a Google Fit dataset, or None
+
+		dataSourceId -- data source id for google fit
+		datasetId -- dataset id for google fit
+		"""
+		with self._lock:
+			row = self._db.execute("SELECT fingerprint FROM uploads WHERE data_source_id = ? AND dataset_id = ?",
+				(dataSourceId, datasetId)).fetchone()
+		return row[0] if row else None
+
+	def RecordUpload(self, dataSourceId, datasetId, fingerprint):
+		"""Records the fingerprint of an uploaded Google Fit dataset
+
+		dataSourceId -- data source id for google fit
+		datasetId -- dataset id for google fit
+		fingerprint -- hash of the uploaded dataset
+		"""
+		with self._lock, self._db:
+			self._db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)", (dataSourceId, datasetId, fingerprint))
+
+	def FinalRanges(self, dataType):
+		"""Returns the contiguous ranges of final days of a given data type, oldest first, as "yyyy-mm-dd -- yyyy-mm-dd"
+		strings, or just the day for a range of a single day
+
+		dataType -- fitbit data type
+		"""
+		with self._lock:
+			dates = [row[0] for row in self._db.execute(
+				"SELECT date FROM synced WHERE data_type = ? AND final = 1 ORDER BY date", (dataType,))]
+		ranges = []
+		for date_stamp in dates:
+			day = datetime.strptime(date_stamp, DATE_FORMAT).date()
+			if ranges and (day - ranges[-1][1]).days == 1:
+				ranges[-1][1] = day
+			else:
+				ranges.append([day, day])
+		return [str(first) if first == last else '{} -- {}'.format(first, last) for first, last in ranges]